@@ -4,6 +4,8 @@ and extended to control project creation in more detail
 """
 import logging
 
+from flywheel import ApiException
+
 logger = logging.getLogger("dynagefw")
 
 
@@ -18,18 +20,16 @@ def handle_project(fw, project_label, group_id, create=False, raise_on=None):
     if raise_on not in [None, "missing", "existing"]:
         raise Exception("raise_on value not valid {}".format(raise_on))
 
-    # Get all projects
-    existing_projs = fw.get_all_projects()
-    # Determine if project_label with group_id already exists
-    found = False
-    for ep in existing_projs:
-        if (ep['label'] == project_label) and (ep['group'] == group_id):
-            logger.info('Project (%s) was found. Working withexisting '
-                        'project.' % project_label)
-            # project exists
-            project = ep
-            found = True
-            break
+    # Look up project_label with group_id directly, instead of listing all projects
+    try:
+        project = fw.lookup(f"{group_id}/{project_label}")
+        logger.info('Project (%s) was found. Working withexisting '
+                    'project.' % project_label)
+        found = True
+    except ApiException as e:
+        if e.status != 404:
+            raise
+        found = False
 
     if found and raise_on == "existing":
         raise Exception("Project {} found but raise_on='existing'".format(project_label))
@@ -53,19 +53,50 @@ def handle_project(fw, project_label, group_id, create=False, raise_on=None):
     return project.to_dict()
 
 
-def get_subject_session(fw, project_id, subject_name):
-    """ Returns a Flywheel session based on project_id and session_label
-    If session exists, session will be retrieved,
-     else session will be created
+def get_subject_index(fw, project_id):
+    """ Returns {subject_name: [session, ...]} with all sessions of a project, listed with one request
+    """
+    subject_index = {}
+    for es in fw.get_project_sessions(project_id):
+        subject_index.setdefault(es['subject']['code'], []).append(es.to_dict())
+    return subject_index
+
+
+def get_subject_session(fw, project_id, subject_name, subject_index=None):
+    """ Returns the first Flywheel session of a subject (or None)
+    subject_index: {subject_name: [session, ...]} (see get_subject_index) that is shared between calls.
+     The project's sessions are only listed (and the index refreshed) if subject_name is not in it, so that
+     a run lists them once instead of once per subject.
     """
-    # Get all sessions
-    existing_sessions = fw.get_project_sessions(project_id)
-    # Determine if session_name within project project_id already exists, with same subject_name...
+    if subject_index is None or subject_name not in subject_index:
+        fresh_index = get_subject_index(fw, project_id)
+        if subject_index is None:
+            subject_index = fresh_index
+        else:
+            subject_index.update(fresh_index)
+
+    sessions = subject_index.get(subject_name)
+    if sessions:
+        logger.info('Subject {} was found. Adding data to existing session.'.format(subject_name))
+        return sessions[0]
 
-    for es in existing_sessions:
-        if es['subject']['code'] == subject_name:
-            logger.info('Subject {} was found. Adding data to existing session.'.format(subject_name))
-            # Session exists
-            session = es
-            return session.to_dict()
 
+def add_session(fw, project_id, session_name, subject_name):
+    """ Creates a Flywheel session (and its subject, if needed) without listing the project's sessions first.
+    Same body as flywheel_bids.upload_bids.handle_session. Only use if you know that the session does not exist yet.
+    """
+    logger.info('Session {} not found. Creating new session for project {}.'.format(session_name, project_id))
+    session_id = fw.add_session({
+        'label': session_name,
+        'project': project_id,
+        'subject': {'code': subject_name},
+        'info': {
+            'BIDS': {
+                'Subject': subject_name[4:],
+                'Label': session_name[4:],
+                'ignore': False
+            }
+        }
+    })
+    session = fw.get_session(session_id)
+    return session.to_dict()
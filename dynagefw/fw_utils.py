@@ -1,13 +1,18 @@
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import pandas as pd
 import flywheel
+import requests
 from flywheel_bids import upload_bids
 
 from .utils import get_info_dict, flatten_dict, compare_info_dicts, nest_dict, \
     prepare_info_dict, clean_nan, \
-    load_tabular_file
-from .fw_bids_utils import handle_project, get_subject_session
+    load_tabular_file, iter_tabular_file, diff_info_frames, compact_frame
+from .fw_bids_utils import handle_project, get_subject_session, add_session
+from .instrumentation import instrument_client, trace
 import logging
 
 logger = logging.getLogger("dynagefw")
@@ -19,24 +24,216 @@ def get_flat_info(fw, project_id, subject_name, session_name, level):
     """
     creates a session if it does not exist
     """
-    session = upload_bids.handle_session(fw, project_id, session_name,
-                                         subject_name)
+    with trace(fw, "handle_session"):
+        session = upload_bids.handle_session(fw, project_id, session_name,
+                                             subject_name)
     info_nested = get_info_dict(level, fw.get_session(session["id"]))
     info_flat = flatten_dict(info_nested)
     return info_flat
 
 
+def list_all(list_func, container_id, page_size=1000, **kwargs):
+    """
+    calls a container listing (e.g., fw.get_project_sessions) page by page (one request per page_size items)
+    and returns all items
+    """
+    items = []
+    page_kwargs = {}
+    while True:
+        page = list_func(container_id, limit=page_size, **page_kwargs, **kwargs)
+        items += page
+        if len(page) < page_size:
+            return items
+        page_kwargs["after_id"] = page[-1].id
+
+
+class SessionIndex(dict):
+    """
+    dict {(subject_name, session_name): session} that also keeps the session names of each subject
+    (in insertion order), so that the first session of a subject is found without scanning the index
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__()
+        self.subject_sessions = {}
+        self.update(*args, **kwargs)
+
+    def __setitem__(self, key, session):
+        if key not in self:
+            self.subject_sessions.setdefault(key[0], []).append(key[1])
+        super().__setitem__(key, session)
+
+    def update(self, *args, **kwargs):
+        for key, session in dict(*args, **kwargs).items():
+            self[key] = session
+
+
+def get_session_index(fw, project_id):
+    """
+    fetches all subjects and sessions of a project (incl. info) with two (paged) listings
+    returns a SessionIndex {(subject_name, session_name): session}
+    sessions of one subject share the same subject dict, so subject info is only held once
+    """
+    subjects = {}
+    for es in list_all(fw.get_project_subjects, project_id, include_all_info=True):
+        subjects[es["id"]] = es.to_dict()
+
+    session_index = SessionIndex()
+    for es in list_all(fw.get_project_sessions, project_id, include_all_info=True):
+        session = es.to_dict()
+        session["subject"] = subjects.setdefault(session["subject"]["id"], session["subject"])
+        session_index[(session["subject"]["code"], session["label"])] = session
+    return session_index
+
+
+def get_indexed_subject_session(session_index, subject_name):
+    """
+    returns the first indexed session of a subject (or None), like get_subject_session
+    """
+    if isinstance(session_index, SessionIndex):
+        session_names = session_index.subject_sessions.get(subject_name)
+        return session_index[(subject_name, session_names[0])] if session_names else None
+    for (s, _), session in list(session_index.items()):  # copy, other upload threads might add sessions
+        if s == subject_name:
+            return session
+
+
+def get_indexed_session(fw, project_id, subject_name, session_name, session_index):
+    """
+    returns session from session_index
+    creates the session on the server (and adds it to the index) if it does not exist
+    """
+    key = (subject_name, session_name)
+    if key not in session_index:
+        session = add_session(fw, project_id, session_name, subject_name)
+        subject_session = get_indexed_subject_session(session_index, subject_name)
+        if subject_session:
+            session["subject"] = subject_session["subject"]
+        session_index[key] = session
+    return session_index[key]
+
+
+def update_indexed_info(session, level, info_flat):
+    """
+    merges uploaded values into an indexed session, the same way the server merges them
+    """
+    info_flat_updated = dict(flatten_dict(get_info_dict(level, session)))
+    info_flat_updated.update(info_flat)
+    info_nested = nest_dict(info_flat_updated)
+    if level == "session":
+        session["info"] = info_nested
+    else:
+        session["subject"]["info"] = info_nested
+
+
+class InfoBuffer:
+    """
+    write-behind buffer for info uploads (see upload_info and upload_tabular_file)
+    values to upload are coalesced per container (subject or session), across rows and files, and only sent by
+    flush(), with one modify_session (session level) or modify_subject (subject level) per container
+        buffer = InfoBuffer()
+        upload_tabular_file(fw, "data.csv", project_id, buffer=buffer)
+        upload_tabular_file(fw, "missings.csv", project_id, buffer=buffer)
+        buffer.flush(fw)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # {(level, container_id): info_flat}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
+
+    @staticmethod
+    def _key(level, session):
+        if level == "session":
+            return level, session["id"]
+        return level, session["subject"]["id"]
+
+    def add(self, level, session, info_flat):
+        """adds values to upload to the session or (level subject) the session's subject"""
+        with self._lock:
+            self._pending.setdefault(self._key(level, session), {}).update(info_flat)
+
+    def pending(self, level, session):
+        """values of the session or its subject that are not flushed yet"""
+        with self._lock:
+            return dict(self._pending.get(self._key(level, session), {}))
+
+    def apply(self, session_index):
+        """merges the pending values into the sessions of a session_index, as if they were flushed"""
+        for session in list(session_index.values()):
+            for level in ["session", "subject"]:
+                info_flat = self.pending(level, session)
+                if info_flat:
+                    update_indexed_info(session, level, info_flat)
+
+    def flush(self, fw, n_jobs=1):
+        """
+        uploads all pending values, one request per container (with n_jobs threads)
+        values of failed requests stay pending and a RuntimeError is raised
+        returns the number of modified containers
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        def modify(item):
+            (level, container_id), info_flat = item
+            info = {"info": nest_dict(info_flat)}
+            try:
+                if level == "session":
+                    fw.modify_session(container_id, info)
+                else:
+                    fw.modify_subject(container_id, info)
+            except Exception as e:
+                logger.error("Upload failed for {} {}: {}".format(level, container_id, e))
+                return item, e
+
+        with trace(fw, "flush_info", n_containers=len(pending)):
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                failures = [f for f in executor.map(modify, pending.items()) if f]
+
+        if failures:
+            with self._lock:
+                for (key, info_flat), _ in failures:
+                    # values added after the flush started are newer
+                    self._pending[key] = {**info_flat, **self._pending.get(key, {})}
+            failures_str = "\n".join(["{} {}: {}".format(*key, e) for (key, _), e in failures])
+            raise RuntimeError("Upload failed for {} containers:\n{}".format(len(failures), failures_str))
+        logger.info("Uploaded pending values of {} containers".format(len(pending)))
+        return len(pending)
+
+
 def upload_info(fw, project_id, subject_name, session_name, level, info_flat,
-                update_values=False):
+                update_values=False, session_index=None, session=None, buffer=None):
     """
     uploads info_flat (e.g., {"age": 33, "c.a1": "x",  "c.a2": "y"}) into db
     level: upload to "subject" or "session"
     update_vals: if False, will not overwrite values that are already in db with new values
+    session_index: if passed (see get_session_index), current values are taken from the index instead of the db.
+     The index is updated after uploading.
+    session: if passed (without session_index), the existing session to upload to. It is not looked up by name.
+    buffer: if passed (see InfoBuffer), values are added to the buffer instead of being uploaded.
+     Values that are pending in the buffer count as current values.
     """
 
     # check that already existing db values are not overwritten
-    current_info_flat = get_flat_info(fw, project_id, subject_name,
-                                      session_name, level)
+    if session_index is not None:
+        session = get_indexed_session(fw, project_id, subject_name,
+                                      session_name, session_index)
+        current_info_flat = flatten_dict(get_info_dict(level, session))
+    elif session is not None or buffer is not None:
+        if session is None:
+            with trace(fw, "handle_session"):
+                session = upload_bids.handle_session(fw, project_id, session_name,
+                                                     subject_name)
+        current_info_flat = flatten_dict(get_info_dict(level, fw.get_session(session["id"])))
+    else:
+        current_info_flat = get_flat_info(fw, project_id, subject_name,
+                                          session_name, level)
+    if buffer is not None:
+        current_info_flat = {**current_info_flat, **buffer.pending(level, session)}
     diff, new = compare_info_dicts(current_info_flat, clean_nan(info_flat))
     if diff and not update_values:
         raise Exception(
@@ -55,52 +252,200 @@ def upload_info(fw, project_id, subject_name, session_name, level, info_flat,
 
         info_flat_upload = clean_nan(
             info_flat_upload)  # replace np.nan with "", otherwise the db won't take them
-        info_nested = nest_dict(info_flat_upload)
-        info = prepare_info_dict(level, info_nested)
-        session = upload_bids.handle_session(fw, project_id, session_name,
-                                             subject_name)
-        fw.modify_session(session["id"], info)
+        if buffer is not None:
+            buffer.add(level, session, info_flat_upload)
+        else:
+            info_nested = nest_dict(info_flat_upload)
+            info = prepare_info_dict(level, info_nested)
+            if session is None:
+                with trace(fw, "handle_session"):
+                    session = upload_bids.handle_session(fw, project_id, session_name,
+                                                         subject_name)
+            fw.modify_session(session["id"], info)
+        if session_index is not None:
+            update_indexed_info(session, level, info_flat_upload)
     else:
         logger.info("No new or changed values found. Do nothing. {} {}".format(
             subject_name, session_name))
 
 
-def upload_tabular_file(fw, filename, project_id, update_values=False, create_emtpy_entry=False,
-                        subject_col="subject_id", session_col="session_id"):
-    df = load_tabular_file(filename, subject_col, session_col)
+def upload_row(fw, project_id, subject_name, session_name, info, update_values=False, session_index=None,
+               subject_index=None, buffer=None):
+    """
+    uploads the info of one table row
+    if session_name is "ses-", info goes to the subject level (via the subject's first session)
+    subject_index: {subject_name: [session, ...]} shared between rows to find the first session of a subject
+     without a session_index (see get_subject_session)
+    buffer: InfoBuffer that collects the values instead of uploading them (see upload_info)
+    """
+    session = None
+    if session_name == "ses-":
+        if session_index is None:
+            with trace(fw, "get_subject_session"):
+                session = get_subject_session(fw, project_id, subject_name, subject_index)
+        else:
+            session = get_indexed_subject_session(session_index, subject_name)
+        if not session:
+            raise Exception(
+                "Cannot find session for subject {}. Before uploading to the subject tab, "
+                "create at least one session for this subject.".format(
+                    subject_name))
+        session_name = session["label"]
+        level = "subject"
+    else:
+        level = "session"
+
+    logger.info(
+        "Preparing {} {} for {} level".format(subject_name, session_name,
+                                              level))
+    logger.debug("Uploading {}".format(info))
 
-    for i, row in df.iterrows():
-        subject_name = row[subject_col]
-        session_name = row[session_col]
-        if not create_emtpy_entry:
-            row = row.dropna()
-        info = row.drop([subject_col, session_col]).to_dict()
+    upload_info(fw, project_id, subject_name, session_name, level, info,
+                update_values, session_index, session, buffer)
+
+
+def drop_unchanged_rows(info_df, rows, session_index, create_emtpy_entry=False):
+    """
+    compares all rows of the table with the session index at once (see diff_info_frames)
+    info_df: table without subject and session columns, rows: [(subject_name, session_name, info), ...]
+    returns the rows with new or changed values. Rows that cannot be checked locally (container not in index,
+     container in more than one row) are kept and checked in upload_info.
+    """
+    containers, current_infos = [], []
+    for subject_name, session_name, _ in rows:
+        if session_name == "ses-":
+            session = get_indexed_subject_session(session_index, subject_name)
+            level = "subject"
+        else:
+            session = session_index.get((subject_name, session_name))
+            level = "session"
+        if session:
+            containers.append((subject_name, session["label"], level))
+            current_infos.append(flatten_dict(get_info_dict(level, session)))
+        else:
+            containers.append(None)
+            current_infos.append(None)
+
+    if create_emtpy_entry:
+        info_df = info_df.astype(object).where(info_df.notna(), "")
+    info_df = info_df.reset_index(drop=True)
+    current_df = pd.DataFrame.from_records([c or {} for c in current_infos], columns=info_df.columns)
+    changes, new = diff_info_frames(current_df, info_df)
+    upload = (changes | new).any(axis=1)
+
+    containers_s = pd.Series(containers, dtype=object)
+    upload |= containers_s.isna() | containers_s.duplicated(keep=False)
+
+    logger.info("{} of {} rows have new or changed values".format(upload.sum(), len(rows)))
+    return [row for row, u in zip(rows, upload) if u]
+
+
+def upload_rows_parallel(fw, project_id, rows, update_values=False, session_index=None, n_jobs=4,
+                         subject_index=None, buffer=None):
+    """
+    uploads rows [(subject_name, session_name, info), ...] with n_jobs threads
+    all rows of a subject are handled by the same thread, in file order
+    failing rows do not stop the upload; returns the failures [(subject_name, session_name, exception), ...]
+    """
+    rows_per_subject = {}
+    for row in rows:
+        rows_per_subject.setdefault(row[0], []).append(row)
+
+    def upload_subject(subject_rows):
+        failures = []
+        for subject_name, session_name, info in subject_rows:
+            try:
+                with trace(fw, "upload_row"):
+                    upload_row(fw, project_id, subject_name, session_name, info, update_values, session_index,
+                               subject_index, buffer)
+            except Exception as e:
+                logger.error("Upload failed for {} {}: {}".format(subject_name, session_name, e))
+                failures.append((subject_name, session_name, e))
+        return failures
+
+    start = time.monotonic()
+    failures = []
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for f in executor.map(upload_subject, rows_per_subject.values()):
+            failures += f
+    duration = time.monotonic() - start
+
+    logger.info("Uploaded {} rows of {} subjects in {:.1f}s ({:.1f} rows/s) with {} threads. {} failed.".format(
+        len(rows), len(rows_per_subject), duration, len(rows) / duration if duration else 0, n_jobs,
+        len(failures)))
+    return failures
+
+
+def get_rows(df, subject_col, session_col, create_emtpy_entry=False):
+    """
+    yields one (subject_name, session_name, info) tuple per table row
+    sub- and ses- prefixes are added if not there. Missing values are dropped from info,
+     unless create_emtpy_entry is True
+    """
+    info_cols = [c for c in df.columns if c not in [subject_col, session_col]]
+    for subject_name, session_name, *values in df[[subject_col, session_col] + info_cols].itertuples(
+            index=False, name=None):
+        if create_emtpy_entry:
+            info = dict(zip(info_cols, values))
+        else:
+            info = {k: v for k, v in zip(info_cols, values) if not pd.isna(v)}
 
         # preprend sub- and ses- prefix if not there
         if not subject_name.startswith("sub-"):
             subject_name = "sub-" + subject_name
         if not session_name.startswith("ses-"):
             session_name = "ses-" + session_name
+        yield subject_name, session_name, info
 
-        if session_name == "ses-":
-            session = get_subject_session(fw, project_id, subject_name)
-            if not session:
-                raise Exception(
-                    "Cannot find session for subject {}. Before uploading to the subject tab, "
-                    "create at least one session for this subject.".format(
-                        subject_name))
-            session_name = session["label"]
-            level = "subject"
-        else:
-            level = "session"
 
-        logger.info(
-            "Preparing {} {} for {} level".format(subject_name, session_name,
-                                                  level))
-        logger.debug("Uploading {}".format(info))
+def upload_tabular_file(fw, filename, project_id, update_values=False, create_emtpy_entry=False,
+                        subject_col="subject_id", session_col="session_id", prefetch=False, n_jobs=1,
+                        chunksize=None, dtype=None, buffer=None):
+    """
+    prefetch: if True, all sessions of the project are fetched once before the upload (see get_session_index),
+     the table is compared with them at once (see drop_unchanged_rows) and the db is only contacted for sessions
+     with new or changed values
+    n_jobs: number of threads used for uploading (see upload_rows_parallel). If 1, rows are uploaded one after
+     the other and the upload stops at the first error.
+    chunksize: if given, the file is read and uploaded in chunks of chunksize rows (see iter_tabular_file),
+     so that large files do not have to be held in memory
+    dtype: dtype hints for reading the file in chunks
+    buffer: if given (see InfoBuffer), values are collected per container (also across files) instead of being
+     uploaded row by row. Call buffer.flush(fw) to upload them.
+    """
+    if chunksize:
+        chunks = iter_tabular_file(filename, subject_col, session_col, chunksize, dtype)
+    else:
+        chunks = [load_tabular_file(filename, subject_col, session_col)]
+    session_index = None
+    if prefetch:
+        with trace(fw, "get_session_index"):
+            session_index = get_session_index(fw, project_id)
+        if buffer is not None:
+            buffer.apply(session_index)
+    # without prefetch, the first sessions of subjects are looked up in one shared listing (see get_subject_session)
+    subject_index = {}
+
+    failures = []
+    for df in chunks:
+        rows = list(get_rows(df, subject_col, session_col, create_emtpy_entry))
+
+        if session_index is not None:
+            rows = drop_unchanged_rows(df.drop(columns=[subject_col, session_col]), rows, session_index,
+                                       create_emtpy_entry)
+
+        if n_jobs > 1:
+            failures += upload_rows_parallel(fw, project_id, rows, update_values, session_index, n_jobs,
+                                             subject_index, buffer)
+        else:
+            for subject_name, session_name, info in rows:
+                with trace(fw, "upload_row"):
+                    upload_row(fw, project_id, subject_name, session_name, info, update_values, session_index,
+                               subject_index, buffer)
 
-        upload_info(fw, project_id, subject_name, session_name, level, info,
-                    update_values)
+    if failures:
+        failures_str = "\n".join(["{} {}: {}".format(*f) for f in failures])
+        raise RuntimeError("Upload failed for {} rows:\n{}".format(len(failures), failures_str))
 
 
 def get_fw_api(api_key=None):
@@ -112,11 +457,87 @@ def get_fw_api(api_key=None):
     return api_key
 
 
-def fix_timestamps(project_label, group_id, api_key=None):
+# connections per host of the sdk's requests session (requests' default)
+DEFAULT_POOL_SIZE = 10
+
+
+def set_pool_size(fw, pool_size):
+    """
+    lets the client's http session keep pool_size connections per host open, so that pool_size threads can reuse
+    connections instead of opening new ones (the retry settings of the sdk are kept)
+    """
+    api_client = getattr(fw, "api_client", None)
+    if api_client is None:
+        return
+    session = api_client.rest_client.session
+    for prefix in ["http://", "https://"]:
+        max_retries = session.get_adapter(prefix).max_retries
+        session.mount(prefix, requests.adapters.HTTPAdapter(pool_maxsize=pool_size, max_retries=max_retries))
+
+
+class FlywheelContext:
+    """
+    one client for a run, shared by the entry points via context=..., e.g.
+        context = FlywheelContext(api_key, pool_size=8)
+        upload_tabular_file_wrapper(file_1, project_label, group_id, context=context)
+        upload_tabular_file_wrapper(file_2, project_label, group_id, context=context)
+    behaves like the client. group/project lookups are cached and the connection pool is grown to the number of
+    threads an entry point uses
+    stats: RequestStats that records all requests of the client (see instrumentation.instrument_client)
+    fw: existing client, if None a flywheel.Client is created with api_key
+    """
+
+    def __init__(self, api_key=None, pool_size=DEFAULT_POOL_SIZE, stats=None, fw=None):
+        if fw is None:
+            fw = flywheel.Client(get_fw_api(api_key))
+        self.fw = instrument_client(fw, stats)
+        self.stats = stats
+        self.pool_size = DEFAULT_POOL_SIZE
+        self._projects = {}
+        self._lock = threading.Lock()
+        self.ensure_pool_size(pool_size)
+
+    def __getattr__(self, name):
+        return getattr(self.fw, name)
+
+    def ensure_pool_size(self, pool_size):
+        with self._lock:
+            if pool_size > self.pool_size:
+                set_pool_size(self.fw, pool_size)
+                self.pool_size = pool_size
+
+    def lookup(self, path):
+        """fw.lookup, group/project paths are only looked up once"""
+        if path.startswith("gears/"):
+            return self.fw.lookup(path)
+        with self._lock:
+            project = self._projects.get(path)
+        if project is None:
+            project = self.fw.lookup(path)
+            with self._lock:
+                self._projects[path] = project
+        return project
+
+
+def get_client(api_key=None, stats=None, context=None, pool_size=DEFAULT_POOL_SIZE):
+    """
+    client of the entry points in fw_utils, gears and upload_analysis, which take stats=None and context=None and
+    pass them on:
+    stats: RequestStats that records all requests of the run (see instrumentation.instrument_client)
+    context: FlywheelContext shared with other calls, reuses its client, connection pool and project lookups
+    returns context, with a connection pool for at least pool_size threads, or a new FlywheelContext if context is
+    None (stats is only used for a new context)
+    """
+    if context is not None:
+        context.ensure_pool_size(pool_size)
+        return context
+    return FlywheelContext(api_key, pool_size, stats)
+
+
+def fix_timestamps(project_label, group_id, api_key=None, stats=None, context=None):
     from datetime import datetime, timezone
 
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+    fw = get_client(api_key, stats, context)
     project = fw.lookup(f"{group_id}/{project_label}")
 
     print(f"Fixing timestamps for {group_id} {project_label}.")
@@ -131,12 +552,11 @@ def fix_timestamps(project_label, group_id, api_key=None):
     print("Done")
 
 
-def create_views(project_label, group_id, api_key=None):
+def create_views(project_label, group_id, api_key=None, stats=None, context=None):
     """
     Creates predefined views on site level
     """
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+    fw = get_client(api_key, stats, context)
     project = fw.lookup(f"{group_id}/{project_label}")
 
     std_cols = [("subject.label", "subject_id"), ("session.label", "session_id"), ("subject.sex", "sex"),
@@ -196,19 +616,23 @@ def create_views(project_label, group_id, api_key=None):
 
 def upload_tabular_file_wrapper(filename, project_label, group_id, api_key=None, create=False, raise_on=None,
                                 update_values=False, create_emtpy_entry=False, subject_col="subject_id",
-                                session_col="session_id"):
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+                                session_col="session_id", prefetch=False, n_jobs=1, chunksize=None,
+                                stats=None, context=None, buffer=None):
+    """
+    buffer: InfoBuffer that collects the values of this and other files, flush it to upload them
+     (see upload_tabular_file)
+    """
+    fw = get_client(api_key, stats, context, n_jobs)
 
     project = handle_project(fw, project_label, group_id, create, raise_on)
     project_id = project["id"]
 
-    upload_tabular_file(fw, filename, project_id, update_values, create_emtpy_entry, subject_col, session_col)
+    upload_tabular_file(fw, filename, project_id, update_values, create_emtpy_entry, subject_col, session_col,
+                        prefetch, n_jobs, chunksize, buffer=buffer)
 
 
-def download_tabular_file_wrapper(filename, project_label, group_id, api_key):
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Flywheel(api_key)
+def download_tabular_file_wrapper(filename, project_label, group_id, api_key, stats=None, context=None):
+    fw = get_client(api_key, stats, context)
 
     project = handle_project(fw, project_label, group_id, create=False,
                              raise_on="missing")
@@ -221,58 +645,55 @@ def download_tabular_file_wrapper(filename, project_label, group_id, api_key):
     df.to_csv(filename, index=False, sep="\t")
 
 
-def get_info_for_all(fw, project_id, add_age_sex=True):
+def get_info_for_all(fw, project_id, add_age_sex=True, compact=False):
     """
+    returns a DataFrame with the session info of all sessions of a project (one row per session)
+    compact: if True, mostly empty numeric columns are made sparse and repetitive string columns categorical
+     (see compact_frame)
     """
-    df = pd.DataFrame([])
+    records = []
 
-    # Get all sessions
-    existing_sessions = fw.get_project_sessions(project_id)
-
-    for es in existing_sessions:
-        session = fw.get_session(es.id)
-        session_name = session['label']
-        subject_name = session['subject']['code']
+    # Get all sessions incl. info (a few paged requests instead of one request per session)
+    existing_sessions = list_all(fw.get_project_sessions, project_id, include_all_info=True)
 
+    for session in existing_sessions:
         info_nested_session = get_info_dict("session", session)
-        info_flat_session = flatten_dict(info_nested_session)
+        record = dict(flatten_dict(info_nested_session))
         # remove "subject_raw.sex"
-        _ = info_flat_session.pop("subject_raw.sex", "")
-
-        df_ = pd.DataFrame(info_flat_session, index=[subject_name])
+        _ = record.pop("subject_raw.sex", "")
 
-        # add session, age and sex
-        df_["session"] = session_name
+        # add subject, session, age and sex
+        record["subject"] = session['subject']['code']
+        record["session"] = session['label']
         if add_age_sex:
-            df_["age"] = session.age_years
-            df_["sex"] = session.subject.sex
-        df = df.append(df_, sort=True)
+            record["age"] = session.age_years
+            record["sex"] = session.subject.sex
+        records.append(record)
 
-    df.index.name = "subject"
-    df = df.sort_index().reset_index()
+    # build the frame once, instead of appending row by row
+    df = pd.DataFrame.from_records(records)
+    df = df.sort_values("subject", kind="stable").reset_index(drop=True)
 
     # bring important stuff to front
-    c = df.columns.tolist()
     first_vars = ["subject", "session"]
     if add_age_sex:
         first_vars += ["sex", "age"]
-    for f in first_vars:
-        c.remove(f)
-    c = first_vars + c
+    c = first_vars + sorted(set(df.columns) - set(first_vars))
     df = df[c]
 
+    if compact:
+        df = compact_frame(df)
     return df
 
 
 def delete_lhab_info(group_id, project_label, api_key=None, delete_subject_info_keys=["missing_info"],
                      delete_session_info_keys=['cognition', 'health', 'demographics', 'motorskills',
-                                               'questionnaires']):
+                                               'questionnaires'], stats=None, context=None):
     """
     Removes keys from the info dict on subject and session levels
     Needs to be run in case variables are discontinued
     """
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+    fw = get_client(api_key, stats, context)
     project = fw.lookup(f"{group_id}/{project_label}")
 
     print(f"Deleting LHAB-related values (phenotype) in info dict for {group_id} {project_label}.")
@@ -1,23 +1,178 @@
-import flywheel
-from .fw_utils import get_fw_api
+from .fw_utils import get_client
+from .instrumentation import trace
+from .job_ledger import DEFAULT_LEDGER, open_ledger, add_jobs, update_states, select_jobs, config_hash
+import csv
+import threading
+import json
+from collections import ChainMap, Counter
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 from datetime import datetime
-from pathlib import Path
+from pathlib import Path, PurePosixPath
+from fnmatch import fnmatch
 import pickle
-import os
-from zipfile import ZipFile
+import re
+from zipfile import ZipFile, is_zipfile
 import shutil
 from warnings import warn
 import time
 from datetime import datetime
+import backoff
+from flywheel import ApiException
+
+
+JOB_DONE_STATES = ["complete", "failed", "cancelled"]
+
+
+def rate_limiter(max_rate=None):
+    """
+    returns a function that blocks, so that it returns at most max_rate times per second (over all threads)
+    """
+    lock = threading.Lock()
+    next_time = [time.monotonic()]
+
+    def wait():
+        if not max_rate:
+            return
+        with lock:
+            now = time.monotonic()
+            t = max(now, next_time[0])
+            next_time[0] = t + 1 / max_rate
+        time.sleep(t - now)
+
+    return wait
+
+
+def submit_gear_runs(gear, analysis_label, gear_config, containers, n_jobs=4, max_tries=5, max_rate=None,
+                     retry_delay=10):
+    """
+    submits gear to containers with n_jobs threads
+    a failed submission is retried up to max_tries times per container, with exponential backoff and jitter
+     (retry_delay, 2 * retry_delay, 4 * retry_delay, ... seconds, max. 5 minutes)
+    max_rate: max. number of submissions per second (over all threads)
+    returns one dict per container with the keys container_id, container_label, status ("submitted" or "failed"),
+     analysis_id, error
+    """
+    wait = rate_limiter(max_rate)
+
+    def on_backoff(details):
+        container = details["args"][0]
+        print(f"Could not submit analysis {container.id}. Wait {details['wait']:.0f} seconds and retry "
+              f"{datetime.now()}")
+
+    @backoff.on_exception(backoff.expo, Exception, max_tries=max_tries, factor=retry_delay, max_value=300,
+                          jitter=backoff.full_jitter, on_backoff=on_backoff)
+    def submit(container):
+        wait()
+        return gear.run(analysis_label=analysis_label, config=gear_config, inputs={}, destination=container)
+
+    def submit_container(n_container):
+        n, container = n_container
+        result = {"container_id": container.id, "container_label": container.label}
+        try:
+            result["analysis_id"] = submit(container)
+            result["status"] = "submitted"
+            result["error"] = ""
+            print(n, container.label)
+        except Exception as e:
+            result["analysis_id"] = ""
+            result["status"] = "failed"
+            result["error"] = str(e).replace("\n", " ")
+            print(f"Could not submit analysis {n} {container.id}. Giving up. {e}")
+        return result
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(submit_container, enumerate(containers)))
+    return results
+
+
+def save_results(results, results_file):
+    with open(results_file, "w", newline="") as fi:
+        writer = csv.DictWriter(fi, fieldnames=["container_id", "container_label", "status", "analysis_id",
+                                                "error"], delimiter="\t")
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def load_failed_container_ids(results_file):
+    with open(results_file, newline="") as fi:
+        return [r["container_id"] for r in csv.DictReader(fi, delimiter="\t") if r["status"] == "failed"]
+
+
+def find_jobs(fw, field, values, chunk_size=100):
+    """
+    returns all jobs whose field (e.g., "_id" or "destination.id") is one of values,
+    with one request per chunk_size values
+    """
+    values = sorted(set(values))
+    jobs = []
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:i + chunk_size]
+        jobs += fw.jobs.iter_find(f"{field}=|[{','.join(chunk)}]")
+    return jobs
+
+
+def get_job_states(fw, job_ids, chunk_size=100):
+    """
+    returns {job_id: state} for job_ids, with one request per chunk_size jobs
+    """
+    return {job.id: job.state for job in find_jobs(fw, "_id", job_ids, chunk_size)}
+
+
+def get_existing_analyses(fw, project, level, analysis_label):
+    """
+    returns {container_id: [analysis, ...]} for all analyses labeled analysis_label on the subjects or sessions
+    (level) of a project, with one request
+    """
+    analyses = {}
+    for analysis in fw.get_analyses("projects", project.id, f"{level}s"):
+        if analysis.label == analysis_label:
+            analyses.setdefault(analysis.parent.id, []).append(analysis)
+    return analyses
+
+
+def drop_analysed_containers(fw, project, level, analysis_label, containers):
+    """
+    removes containers that already have an analysis labeled analysis_label, unless all their analyses have
+     failed or were cancelled
+    returns remaining containers and {state: number of skipped containers}
+    """
+    existing_analyses = get_existing_analyses(fw, project, level, analysis_label)
+    job_ids = [a.job for analyses in existing_analyses.values() for a in analyses if a.job]
+    job_states = get_job_states(fw, job_ids)
+
+    remaining = []
+    skipped = Counter()
+    for container in containers:
+        states = [job_states.get(a.job) for a in existing_analyses.get(container.id, [])]
+        active_states = [s for s in states if s not in ["failed", "cancelled"]]
+        if active_states:
+            skipped[active_states[0]] += 1
+        else:
+            remaining.append(container)
+    return remaining, skipped
 
 
 def run_gear(group_id, project_label, gear, save_dir="~/fw_jobs", config=None, gear_version=None,
-             analysis_label_suffix="default", api_key=None, level="subject", subjects=[]):
+             analysis_label_suffix="default", api_key=None, level="subject", subjects=[], n_jobs=4, max_tries=5,
+             max_rate=None, retry_results_file=None, skip_existing=False, dry_run=False, ledger_file=DEFAULT_LEDGER,
+             stats=None, context=None):
+    """
+    submits gear to all subjects or sessions of a project (see submit_gear_runs)
+    n_jobs: number of parallel submissions
+    max_tries: number of tries per container
+    max_rate: max. number of submissions per second
+    retry_results_file: results file of an earlier run_gear call. If given, only the containers whose submission
+     failed in that run are used.
+    skip_existing: if True, containers that already have an analysis with the same label are skipped, unless its
+     job has failed or was cancelled (see drop_analysed_containers)
+    dry_run: only print what would be submitted
+    submitted jobs are added to the job ledger (see job_ledger) and the status of every submission is saved to
+    {save_dir}/{timestamp}__{analysis_label}.tsv
+    """
     assert level in ["subject", "session"], f'level needs to be "subject" or "session", not {level}'
 
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+    fw = get_client(api_key, stats, context, n_jobs)
     project = fw.lookup(f"{group_id}/{project_label}")
 
     if gear_version:
@@ -35,6 +190,7 @@ def run_gear(group_id, project_label, gear, save_dir="~/fw_jobs", config=None, g
                 raise RuntimeError(f"Key {k} not part of config.\n\n{gear.get_default_config()}")
 
     containers = []
+    subject_labels = {}
     for subject in project.subjects():
         if subjects:
             if subject.label in subjects:
@@ -47,13 +203,25 @@ def run_gear(group_id, project_label, gear, save_dir="~/fw_jobs", config=None, g
             if level == "session":
                 for session in subject.sessions():
                     containers.append(session)
+                    subject_labels[session.id] = subject.label
             else:
                 containers.append(subject)
+                subject_labels[subject.id] = subject.label
+
+    if retry_results_file:
+        failed_ids = load_failed_container_ids(retry_results_file)
+        containers = [c for c in containers if c.id in failed_ids]
 
     if analysis_label_suffix:
         analysis_label_suffix = "__" + analysis_label_suffix
     analysis_label = f'{gear.gear.name}__{gear.gear.version}{analysis_label_suffix}'
 
+    if skip_existing:
+        n_containers = len(containers)
+        containers, skipped = drop_analysed_containers(fw, project, level, analysis_label, containers)
+        print(f"Skipping {n_containers - len(containers)} of {n_containers} {level}s with existing analysis "
+              f"{analysis_label}: {dict(skipped)}")
+
     print(f"project: {project_label}")
     print(f"{gear.gear.name}:{gear.gear.version}")
     print(f"analysis label: {analysis_label}")
@@ -63,67 +231,58 @@ def run_gear(group_id, project_label, gear, save_dir="~/fw_jobs", config=None, g
     print(f"\n\nConfig:\n")
     pprint(gear_config)
 
+    if dry_run:
+        print("Dry run. Doing nothing.")
+        return
+
     c = input("\n\nContinue (y): ")
     if c == "y":
-        analysis_ids = []
-        for n, container in enumerate(containers):
-            try:
-                analysis_id = gear.run(analysis_label=analysis_label, config=gear_config, inputs={},
-                                       destination=container)
-                print(n, container.label)
-            except:
-                try:
-                    t = 10
-                    print(f"Could not submit analysis {n} {container.id}. Wait {t} seconds and retry {datetime.now()}")
-                    time.sleep(t)
-                    analysis_id = gear.run(analysis_label=analysis_label, config=gear_config, inputs={},
-                                           destination=container)
-                    print(n, container.label)
-                except:
-                    try:
-                        t = 20
-                        print(f"Could not submit analysis {n} {container.id}. \
-                            Wait {t} seconds and retry {datetime.now()}")
-                        time.sleep(t)
-                        analysis_id = gear.run(analysis_label=analysis_label, config=gear_config, inputs={},
-                                               destination=container)
-                        print(n, container.label)
-                    except:
-                        t = 60
-                        print(
-                            f"Could not submit analysis {n} {container.id}. Wait {t} seconds and retry. \
-                            last try! {datetime.now()}")
-                        time.sleep(t)
-                        analysis_id = gear.run(analysis_label=analysis_label, config=gear_config, inputs={},
-                                               destination=container)
-                        print(n, container.label)
-
-            analysis_ids.append(analysis_id)
+        start = time.monotonic()
+        results = submit_gear_runs(gear, analysis_label, gear_config, containers, n_jobs=n_jobs,
+                                   max_tries=max_tries, max_rate=max_rate)
+        duration = time.monotonic() - start
+        submitted = [r for r in results if r["status"] == "submitted"]
+        n_failed = len(results) - len(submitted)
+        print(f"Submitted {len(submitted)} analyses in {duration:.0f}s. {n_failed} failed.")
+
+        print(f"Saving jobs to {ledger_file}")
+        con = open_ledger(ledger_file)
+        c_hash = config_hash(gear_config)
+        add_jobs(con, [{"analysis_id": r["analysis_id"], "group_id": group_id, "project_label": project_label,
+                        "container_type": level, "container_id": r["container_id"],
+                        "container_label": r["container_label"], "subject_label": subject_labels[r["container_id"]],
+                        "gear_name": gear.gear.name, "gear_version": gear.gear.version,
+                        "analysis_label": analysis_label, "config_hash": c_hash} for r in submitted])
+        con.close()
 
         save_dir = Path(save_dir).expanduser()
-        out_file = Path(save_dir) / f'{datetime.now().strftime("%Y-%m-%d_%H%M%S")}__{analysis_label}.pkl'
+        results_file = Path(save_dir) / f'{datetime.now().strftime("%Y-%m-%d_%H%M%S")}__{analysis_label}.tsv'
         Path(save_dir).mkdir(parents=True, exist_ok=True)
-        print(f"Saving ids to {out_file}")
-        pickle.dump(analysis_ids, open(out_file, "wb"))
-
+        print(f"Saving submission results to {results_file}")
+        save_results(results, results_file)
+        if n_failed:
+            warn(f"{n_failed} submissions failed. Retry them with retry_results_file='{results_file}'")
 
     else:
         print("OK. Doing nothing.")
 
 
-def check_jobs(analysis_id_file, api_key=None):
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+def get_analysis_jobs(fw, analysis_ids):
+    """
+    returns {analysis_id: job} for the analyses' (latest) jobs, looked up in bulk by job destination
+    """
+    jobs = {}
+    for job in find_jobs(fw, "destination.id", analysis_ids):
+        analysis_id = job.destination.id
+        if analysis_id not in jobs or (job.attempt or 0) > (jobs[analysis_id].attempt or 0):
+            jobs[analysis_id] = job
+    return jobs
 
-    analysis_ids = pickle.load(open(analysis_id_file, "rb"))
 
+def print_job_info(states):
     info = {'cancelled': [], 'complete': [], 'failed': [], 'running': [], 'pending': []}
-
-    for analysis_id in analysis_ids:
-        analysis = fw.get_analysis(analysis_id)
-        job_id = analysis.job.id
-        job = fw.get_job(job_id)
-        info[job.state].append(job_id)
+    for job_id, state in states.items():
+        info.setdefault(state, []).append(job_id)
 
     print("JOB INFO\n")
     for k, v in info.items():
@@ -133,133 +292,517 @@ def check_jobs(analysis_id_file, api_key=None):
         print(info["failed"])
 
 
-def cancle_jobs(pending=True, running=True, api_key=None):
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+def check_jobs(analysis_id_file=None, api_key=None, watch=False, interval=60, ledger_file=DEFAULT_LEDGER,
+               analysis_label=None, gear_name=None, state=None, subject_label=None, stats=None, context=None):
+    """
+    prints the job states of analyses and updates them in the job ledger
+    the analyses are selected from the job ledger by analysis_label, gear_name, state and subject_label
+     (see job_ledger.select_jobs), or read from analysis_id_file (pickle of analysis ids, written by older versions
+     of run_gear)
+    watch: if True, polls every interval seconds until all jobs are done. Only unfinished jobs are queried again,
+     state changes, throughput and the estimated time until all jobs are done are printed.
+    """
+    fw = get_client(api_key, stats, context)
+    con = open_ledger(ledger_file)
+
+    if analysis_id_file:
+        analysis_ids = pickle.load(open(analysis_id_file, "rb"))
+    else:
+        analysis_ids = [j["analysis_id"] for j in select_jobs(con, analysis_label=analysis_label,
+                                                              gear_name=gear_name, state=state,
+                                                              subject_label=subject_label)]
+
+    jobs = get_analysis_jobs(fw, analysis_ids)
+    update_states(con, {analysis_id: (job.id, job.state) for analysis_id, job in jobs.items()})
+    states = {job.id: job.state for job in jobs.values()}
+    if len(jobs) < len(analysis_ids):
+        print(f"No job found for {len(analysis_ids) - len(jobs)} analyses")
+    print_job_info(states)
+
+    if watch:
+        analysis_ids = {job.id: analysis_id for analysis_id, job in jobs.items()}
 
-    searches = []
+        def on_change(job_id, state):
+            update_states(con, {analysis_ids[job_id]: (job_id, state)})
+
+        watch_jobs(fw, states, interval, on_change)
+    con.close()
+
+
+def watch_jobs(fw, states, interval=60, on_change=None):
+    """
+    polls states ({job_id: state}) until all jobs are done
+    on_change: optional function, called with (job_id, new_state)
+    """
+    start = time.monotonic()
+    n_done_start = len([s for s in states.values() if s in JOB_DONE_STATES])
+    while True:
+        open_job_ids = [j for j, s in states.items() if s not in JOB_DONE_STATES]
+        if not open_job_ids:
+            print("All jobs done")
+            break
+        time.sleep(interval)
+
+        for job_id, state in get_job_states(fw, open_job_ids).items():
+            if state != states[job_id]:
+                print(f"{datetime.now():%H:%M:%S} {job_id}: {states[job_id]} -> {state}")
+                states[job_id] = state
+                if on_change:
+                    on_change(job_id, state)
+
+        n_done = len([s for s in states.values() if s in JOB_DONE_STATES]) - n_done_start
+        n_open = len([s for s in states.values() if s not in JOB_DONE_STATES])
+        hours = (time.monotonic() - start) / 3600
+        rate = n_done / hours
+        eta = f"{n_open / rate:.1f}h" if rate else "unknown"
+        print(f"{dict(Counter(states.values()))} | {rate:.1f} jobs/h | ETA {eta}")
+
+
+def find_jobs_to_cancel(fw, states, gear_name=None, project_id=None, analysis_ids=None):
+    """
+    returns jobs in states (e.g., ["pending", "running"])
+    analysis_ids: only jobs of these analyses
+    gear_name, project_id: only jobs of this gear/project
+    """
+    if analysis_ids is not None:
+        jobs = [j for j in get_analysis_jobs(fw, analysis_ids).values() if j.state in states]
+        if gear_name:
+            jobs = [j for j in jobs if j.gear_info.name == gear_name]
+        if project_id:
+            jobs = [j for j in jobs if j.parents.project == project_id]
+        return jobs
+
+    filters = []
+    if gear_name:
+        filters.append(f"gear_info.name={gear_name}")
+    if project_id:
+        filters.append(f"parents.project={project_id}")
+    jobs = []
+    for state in states:
+        jobs += fw.jobs.iter_find(f"state={state}", *filters)
+    return jobs
+
+
+def cancel_jobs_parallel(jobs, n_jobs=8):
+    """
+    cancels jobs with n_jobs threads
+    returns {previous state: number of cancelled jobs} and the ids of jobs that could not be cancelled
+    """
+    def cancel(job):
+        try:
+            job.change_state('cancelled')
+            return job.state, None
+        except Exception as e:
+            print(f"Could not cancel {job.id}: {e}")
+            return job.state, job.id
+
+    cancelled = Counter()
+    failed = []
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for state, failed_id in executor.map(cancel, jobs):
+            if failed_id:
+                failed.append(failed_id)
+            else:
+                cancelled[state] += 1
+    return cancelled, failed
+
+
+def cancle_jobs(pending=True, running=True, api_key=None, gear_name=None, group_id=None, project_label=None,
+                analysis_label=None, from_ledger=False, ledger_file=DEFAULT_LEDGER, n_jobs=8, stats=None,
+                context=None):
+    """
+    cancels pending and/or running jobs, with n_jobs threads
+    the jobs can be restricted to
+        a gear (gear_name)
+        a project (group_id and project_label)
+        jobs in the job ledger (from_ledger=True), optionally with analysis_label
+    without restrictions, all jobs visible to the api key are cancelled
+    """
+    if project_label and not group_id:
+        raise ValueError("project_label requires group_id")
+    fw = get_client(api_key, stats, context, n_jobs)
+
+    states = []
     if pending:
-        searches.append('state=pending')
+        states.append('pending')
     if running:
-        searches.append('state=running')
+        states.append('running')
 
-    for search_str in searches:
-        jobs = fw.jobs.find(search_str)
-        print(f"Cancelling {len(jobs)} jobs")
+    project_id = None
+    if project_label:
+        project_id = fw.lookup(f"{group_id}/{project_label}").id
+
+    con = None
+    analysis_ids = None
+    if from_ledger or analysis_label:
+        con = open_ledger(ledger_file)
+        analysis_ids = [j["analysis_id"] for j in select_jobs(con, analysis_label=analysis_label,
+                                                              gear_name=gear_name, project_label=project_label)]
+
+    jobs = find_jobs_to_cancel(fw, states, gear_name, project_id, analysis_ids)
+    print(f"Cancelling {len(jobs)} jobs")
+    start = time.monotonic()
+    cancelled, failed = cancel_jobs_parallel(jobs, n_jobs)
+    print(f"Cancelled {sum(cancelled.values())} jobs in {time.monotonic() - start:.0f}s: {dict(cancelled)}")
+    if failed:
+        warn(f"{len(failed)} jobs could not be cancelled {failed}")
+
+    if con:
+        update_states(con, {j.destination.id: (j.id, "cancelled") for j in jobs if j.id not in failed})
+        con.close()
+
+
+def ledger_analysis_ids(ledger_file=DEFAULT_LEDGER, **criteria):
+    """
+    ids of the analyses in the job ledger that match criteria (see job_ledger.select_jobs)
+    """
+    con = open_ledger(ledger_file)
+    analysis_ids = [j["analysis_id"] for j in select_jobs(con, **criteria)]
+    con.close()
+    return analysis_ids
+
+
+def get_project_analyses(fw, project):
+    """
+    returns all subject and session analyses of a project, with two requests
+    """
+    return fw.get_analyses("projects", project.id, "subjects") + fw.get_analyses("projects", project.id, "sessions")
 
-        for job in jobs:
-            print(job.id)
-            job.change_state('cancelled')
 
+def delete_analyses_parallel(fw, analyses, n_jobs=8):
+    """
+    deletes analyses with n_jobs threads, returns the ids of analyses that could not be deleted
+    """
+    def delete(analysis):
+        try:
+            fw.delete_container_analysis(analysis.parent.id, analysis.id)
+            print(analysis.id)
+        except Exception as e:
+            print(f"Could not delete {analysis.id}: {e}")
+            return analysis.id
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return [a for a in executor.map(delete, analyses) if a]
 
-def delete_canceled_analysis(group_id, project_label, api_key=None):
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+
+def cleanup_analyses(fw, project, analysis_label=None, states=None, dry_run=False, n_jobs=8, analysis_ids=None):
+    """
+    deletes the subject and session analyses of a project that have the label analysis_label (if given)
+    and whose job is in one of states (if given)
+    analysis_ids: only these analyses (e.g., selected from the job ledger)
+    analyses and job states are fetched in bulk, the deletion set is computed locally and deleted with n_jobs threads
+    dry_run: only print what would be deleted
+    returns the analyses to delete
+    """
+    analyses = get_project_analyses(fw, project)
+    if analysis_label:
+        analyses = [a for a in analyses if a.label == analysis_label]
+    if analysis_ids is not None:
+        analysis_ids = set(analysis_ids)
+        analyses = [a for a in analyses if a.id in analysis_ids]
+
+    job_states = get_job_states(fw, [a.job for a in analyses if a.job])
+    if states:
+        analyses = [a for a in analyses if job_states.get(a.job) in states]
+
+    summary = Counter((a.parent.type, a.label, job_states.get(a.job)) for a in analyses)
+    print(f"{len(analyses)} analyses to delete (container, label, job state):")
+    for k, n in sorted(summary.items(), key=str):
+        print(f"    {k}: {n}")
+
+    if dry_run:
+        print("Dry run. Doing nothing.")
+    elif analyses:
+        failed = delete_analyses_parallel(fw, analyses, n_jobs)
+        print(f"Deleted {len(analyses) - len(failed)} analyses")
+        if failed:
+            warn(f"{len(failed)} analyses could not be deleted {failed}")
+    return analyses
+
+
+def delete_canceled_analysis(group_id, project_label, api_key=None, dry_run=False, n_jobs=8, from_ledger=False,
+                             ledger_file=DEFAULT_LEDGER, stats=None, context=None):
+    """
+    deletes subject and session analyses whose job has been cancelled or has failed
+    from_ledger: only analyses of the project in the job ledger
+    """
+    fw = get_client(api_key, stats, context, n_jobs)
     project = fw.lookup(f"{group_id}/{project_label}")
 
-    for subject in project.subjects():
-        print(subject.label)
-        ana_list = fw.get_container_analyses(subject.id)
-        for analysis in ana_list:
-            job = fw.get_job(analysis.job)
-            if (job.state == "cancelled") or (job.state == "failed"):
-                print(analysis.id)
-                fw.delete_container_analysis(subject.id, analysis.id)
-
-def delete_analyses(group_id, project_label, analysis_label, api_key=None):
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+    analysis_ids = ledger_analysis_ids(ledger_file, project_label=project_label) if from_ledger else None
+    cleanup_analyses(fw, project, states=["cancelled", "failed"], dry_run=dry_run, n_jobs=n_jobs,
+                     analysis_ids=analysis_ids)
+
+
+def delete_analyses(group_id, project_label, analysis_label, api_key=None, dry_run=False, n_jobs=8, from_ledger=False,
+                    ledger_file=DEFAULT_LEDGER, stats=None, context=None):
+    """
+    deletes subject and session analyses with analysis_label
+    from_ledger: only analyses of the project in the job ledger
+    """
+    fw = get_client(api_key, stats, context, n_jobs)
     project = fw.lookup(f"{group_id}/{project_label}")
 
-    for subject in project.subjects():
-        print(subject.label)
-        ana_list = fw.get_container_analyses(subject.id, filter=f'label="{analysis_label}"')
-        for analysis in ana_list:
-            print(analysis.id)
-            fw.delete_container_analysis(subject.id, analysis.id)
+    analysis_ids = None
+    if from_ledger:
+        analysis_ids = ledger_analysis_ids(ledger_file, project_label=project_label, analysis_label=analysis_label)
+    cleanup_analyses(fw, project, analysis_label=analysis_label, dry_run=dry_run, n_jobs=n_jobs,
+                     analysis_ids=analysis_ids)
+
+
+def manifest_journal(manifest_file):
+    """entries added since manifest_file was saved, one json line [key, entry] per file (see add_manifest_entry)"""
+    return Path(manifest_file).with_suffix(".jsonl")
+
+
+def load_manifest(manifest_file):
+    """manifest_file with the entries of its journal, a last line cut off by an interruption is ignored"""
+    manifest = json.loads(Path(manifest_file).read_text()) if Path(manifest_file).is_file() else {}
+    journal = manifest_journal(manifest_file)
+    if journal.is_file():
+        for line in journal.read_text().splitlines():
+            try:
+                key, entry = json.loads(line)
+            except ValueError:
+                continue
+            manifest[key] = entry
+    return manifest
+
+
+def add_manifest_entry(manifest, key, entry, manifest_file):
+    """adds entry to manifest and appends it to the journal, without rewriting manifest_file"""
+    manifest[key] = entry
+    with open(manifest_journal(manifest_file), "a") as f:
+        f.write(json.dumps([key, entry]) + "\n")
+
+
+def save_manifest(manifest, manifest_file):
+    """writes the whole manifest (including the journal entries) and removes the journal"""
+    # write to a tmp file first, so that an interruption does not leave a broken manifest
+    tmp_file = Path(str(manifest_file) + ".tmp")
+    tmp_file.write_text(json.dumps(manifest, indent=1))
+    tmp_file.replace(manifest_file)
+    manifest_journal(manifest_file).unlink(missing_ok=True)
+
+
+def extract_zip(zip_file, out_dir, member_filter=None, extracted=None, owner=None):
+    """
+    extracts zip_file into out_dir, member by member and without staging directory
+    the first path component is removed on the fly ('5f34/sub-x/anat/x.nii.gz' -> 'sub-x/anat/x.nii.gz')
+    member_filter: optional list of glob patterns (matched against the path without first component);
+     only matching members are extracted
+    extracted: dict {out_file: owner} of already extracted files (e.g., from other zips); updated in place
+    owner: recorded in extracted for the files of this zip (default: zip_file)
+    returns files that are overwritten (extracted before by another owner or more than once in this zip), they are
+    found from the central directory before anything is written
+    """
+    extracted = {} if extracted is None else extracted
+    owner = zip_file if owner is None else owner
+    out_dir = Path(out_dir)
+    with ZipFile(zip_file, "r") as zip_ref:
+        # plan from the central directory, before writing anything
+        members = []
+        for member in zip_ref.infolist():
+            parts = PurePosixPath(member.filename).parts[1:]
+            if member.is_dir() or not parts:
+                continue
+            if ".." in parts:
+                raise RuntimeError(f"Invalid path in {zip_file}: {member.filename}")
+            rel_path = "/".join(parts)
+            if member_filter and not any(fnmatch(rel_path, f) for f in member_filter):
+                continue
+            members.append((member, out_dir / rel_path))
+
+        out_files = [out_file for _, out_file in members]
+        file_overwritten = [f for f in out_files if extracted.get(f, owner) != owner]
+        file_overwritten += [f for f, n in Counter(out_files).items() if n > 1]
+
+        for member, out_file in members:
+            out_file.parent.mkdir(parents=True, exist_ok=True)
+            with zip_ref.open(member) as fi, open(out_file, "wb") as fo:
+                shutil.copyfileobj(fi, fo, 2 ** 20)
+            extracted[out_file] = owner
+    return file_overwritten
+
+
+def extracted_outputs(out_dir, out_files):
+    """{path relative to out_dir: [size, mtime_ns]} of extracted files"""
+    outputs = {}
+    for out_file in out_files:
+        stat = out_file.stat()
+        outputs[out_file.relative_to(out_dir).as_posix()] = [stat.st_size, stat.st_mtime_ns]
+    return outputs
+
+
+def upload_order(files):
+    """
+    files of an analysis in the order they were uploaded: by their created timestamp, or if that is missing, full
+    zips before incremental zips ({label}_{container}_{YYYYmmdd-HHMMSS}.zip, see upload_analysis.prepare_upload)
+    and by name
+    """
+    if all(getattr(f, "created", None) is not None for f in files):
+        return sorted(files, key=lambda f: (f.created, f.name))
+
+    def key(f):
+        delta = re.search(r"_(\d{8}-\d{6})(_part\d+of\d+)?\.zip$", f.name)
+        return delta.group(1) if delta else "", f.name
+    return sorted(files, key=key)
 
-def download_analysis(group_id, project_label, analysis_label, save_dir, file_starts_with=None, api_key=None):
+
+def find_intact_analyses(out_dir, manifest, analyses_files):
+    """
+    analyses_files: [(analysis, files)] in the order in which they are extracted
+    returns the ids of analyses whose files are all in the manifest (with the same size) and whose extracted outputs
+    are unchanged (same size and modification time). an output is checked against the analysis that extracted it last.
+    """
+    last_extracted = {}
+    for analysis, files in analyses_files:
+        for file_obj in files:
+            entry = manifest.get(f"{analysis.id}/{file_obj.name}") or {}
+            for path, stat in entry.get("outputs", {}).items():
+                last_extracted[path] = (analysis.id, stat)
+
+    intact = set()
+    for analysis, files in analyses_files:
+        entries = [manifest.get(f"{analysis.id}/{file_obj.name}") for file_obj in files]
+        if not all(e and e["size"] == file_obj.size and "outputs" in e for e, file_obj in zip(entries, files)):
+            continue
+        paths = {path for e in entries for path in e["outputs"]}
+        unchanged = True
+        for path in paths:
+            analysis_id, stat = last_extracted[path]
+            out_file = out_dir / path
+            if analysis_id == analysis.id and not (
+                    out_file.is_file() and [out_file.stat().st_size, out_file.stat().st_mtime_ns] == stat):
+                unchanged = False
+                break
+        if unchanged:
+            intact.add(analysis.id)
+    return intact
+
+
+def download_analysis(group_id, project_label, analysis_label, save_dir, file_starts_with=None, api_key=None,
+                      n_jobs=4, member_filter=None, from_ledger=False, ledger_file=DEFAULT_LEDGER, stats=None,
+                      context=None):
     """
     Looks for analysis matching the {analysis_label}
     if they cannot be found on the subject levle, the sessions are queried
     inside the analysis containers, looks for files that have names that start with {file_starts_with} [if None
     downloads all]
-    downloads to save_dir, extracts and cleans up tree
+    downloads to save_dir with n_jobs threads and extracts zips directly into their final place (see extract_zip)
+    zips are extracted while other downloads are still running, in the order they were uploaded (see upload_order),
+    so that incremental zips overwrite the older files of the full zip of the same analysis. files of other analyses
+    that a zip overwrites are found from its central directory before extracting it, and reported in a warning
+    member_filter: list of glob patterns, if given only matching files are extracted from the zips
+     (e.g., ["*/stats/*"] for FreeSurfer stats files)
+    from_ledger: the analyses are taken from the job ledger (by project_label and analysis_label, one request per
+     analysis) instead of looking into all subjects and sessions of the project
+    finished files are recorded in {save_dir}/{analysis_label}/00_manifest.json (with size and the extracted
+    outputs), while downloading they are appended to its journal (see add_manifest_entry). if download_analysis is
+    run again, analyses are skipped if all their files are recorded and their outputs are unchanged, otherwise all
+    files of the analysis are downloaded again (see find_intact_analyses)
+    files that are not zips are ignored
     """
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+    fw = get_client(api_key, stats, context, n_jobs)
     project = fw.lookup(f"{group_id}/{project_label}")
 
-    orig_dir = Path.cwd()
     out_dir = Path(save_dir) / analysis_label
     zip_out_dir = out_dir / "00_zip"
-    extract_out_dir = out_dir / "00_extract"
     zip_out_dir.mkdir(parents=True, exist_ok=True)
-    extract_out_dir.mkdir(parents=True, exist_ok=True)
 
-    os.chdir(zip_out_dir)
+    manifest_file = out_dir / "00_manifest.json"
+    manifest = load_manifest(manifest_file)
+    # the journal of an interrupted run may end with a cut off line, start a new one
+    save_manifest(manifest, manifest_file)
 
-    print("DOWNLOAD")
-    for subject in project.subjects():
-        print(subject.label)
-        analyses = fw.get_container_analyses(subject.id, filter=f'label="{analysis_label}"')
-        assert len(analyses) <= 1, "More than one analysis found"
-
-        # if no analyses on subject level, look into sessions
-        if not analyses:
-            analyses = []
-            for session in subject.sessions():
-                analyses_session = fw.get_container_analyses(session.id, filter=f'label="{analysis_label}"')
-                assert len(analyses_session) <= 1, "More than one analysis found"
-                analyses += analyses_session
-
-        if analyses:
-            for analysis in analyses:
-                if analysis.files:
-                    files = [file_obj.name for file_obj in analysis.files]
-                else:
-                    files = []
-
-                # filter files
-                download_files = []
-                if file_starts_with:
-                    for f in files:
-                        if f.startswith(file_starts_with):
-                            download_files.append(f)
-                else:
-                    download_files = files
-
-                for file in download_files:
-                    print(file)
-                    analysis.download_file(file, file)
-
-    print("UNZIP")
-    zipfiles = list(zip_out_dir.glob("*.zip"))
-    for file in zipfiles:
-        with ZipFile(file, "r") as zip_ref:
-            zip_ref.extractall(extract_out_dir)
-
-    print("MOVE AND CLEAN UP")
-    # remove id hierarchy and move to out_dir
-    # e.g., '5f34/sub-x/ses-y/func/*bold.json'
-    #       'sub-x/ses-y/func/*bold.json'
-    os.chdir(extract_out_dir)
-    file_tree = [f for f in Path(".").rglob("*") if f.is_file()]
+    print("COLLECT FILES")
+    all_analyses = []
+    if from_ledger:
+        for analysis_id in ledger_analysis_ids(ledger_file, project_label=project_label,
+                                               analysis_label=analysis_label):
+            try:
+                all_analyses.append(fw.get_analysis(analysis_id))
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+                print(f"Analysis {analysis_id} from the job ledger not found")
+    else:
+        for subject in project.subjects():
+            print(subject.label)
+            analyses = fw.get_container_analyses(subject.id, filter=f'label="{analysis_label}"')
+            assert len(analyses) <= 1, "More than one analysis found"
+
+            # if no analyses on subject level, look into sessions
+            if not analyses:
+                analyses = []
+                for session in subject.sessions():
+                    analyses_session = fw.get_container_analyses(session.id, filter=f'label="{analysis_label}"')
+                    assert len(analyses_session) <= 1, "More than one analysis found"
+                    analyses += analyses_session
+            all_analyses += analyses
+
+    analyses_files = []
+    for analysis in all_analyses:
+        files = analysis.files if analysis.files else []
+
+        # filter files
+        files = [f for f in files if not file_starts_with or f.name.startswith(file_starts_with)]
+        analyses_files.append((analysis, upload_order(files)))
+
+    intact = find_intact_analyses(out_dir, manifest, analyses_files)
+    downloads = [(analysis, file_obj) for analysis, files in analyses_files if analysis.id not in intact
+                 for file_obj in files]
+    n_done = sum(len(files) for analysis, files in analyses_files if analysis.id in intact)
+    print(f"DOWNLOAD AND UNZIP {len(downloads)} files ({n_done} already downloaded)")
+
+    def download(analysis, file_obj):
+        zip_file = zip_out_dir / analysis.id / file_obj.name
+        # zips from an interrupted run that have not been extracted yet
+        if not (zip_file.is_file() and zip_file.stat().st_size == file_obj.size):
+            zip_file.parent.mkdir(parents=True, exist_ok=True)
+            analysis.download_file(file_obj.name, str(zip_file))
+        return zip_file
+
+    failed = []
+    extracted = {}  # out_file: analysis id
     file_overwritten = []
-    for in_file in file_tree:
-        out_file = out_dir / Path(*in_file.parts[1:])
-        out_file.parent.mkdir(parents=True, exist_ok=True)
-        print(in_file, out_file)
-        if out_file.is_file():
-            file_overwritten.append(out_file)
-        in_file.rename(out_file)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [(executor.submit(download, analysis, file_obj), analysis, file_obj)
+                   for analysis, file_obj in downloads]
+        for future, analysis, file_obj in futures:
+            try:
+                zip_file = future.result()
+            except Exception as e:
+                print(f"Download failed {analysis.id} {file_obj.name}: {e}")
+                failed.append(file_obj.name)
+                continue
+
+            print(file_obj.name)
+            zip_extracted = {}
+            if is_zipfile(zip_file):
+                # files of this zip are recorded in zip_extracted, collisions are checked against all zips
+                with trace(fw, "extract_zip"):
+                    overwritten = extract_zip(zip_file, out_dir, member_filter, ChainMap(zip_extracted, extracted),
+                                              analysis.id)
+                if overwritten:
+                    print(f"{file_obj.name} overwrites {len(overwritten)} files of other analyses")
+                file_overwritten += overwritten
+                extracted.update(zip_extracted)
+            else:
+                print(f"{file_obj.name} is not a zip. Ignored.")
+            zip_file.unlink()
+
+            add_manifest_entry(manifest, f"{analysis.id}/{file_obj.name}",
+                               {"size": file_obj.size, "outputs": extracted_outputs(out_dir, zip_extracted)},
+                               manifest_file)
+    save_manifest(manifest, manifest_file)
 
     if file_overwritten:
         file_overwritten_str = '\n'.join([str(f) for f in set(file_overwritten)])
         warn(f"{len(set(file_overwritten))} have been overwritten, because of multiple files with the same name in "
-             f"different analyses.\n{file_overwritten_str}")
-    shutil.rmtree(extract_out_dir)
+             f"different analyses or in the same zip.\n{file_overwritten_str}")
     shutil.rmtree(zip_out_dir)
 
+    if failed:
+        warn(f"{len(failed)} files could not be downloaded. Run again to retry.\n{failed}")
     print("DONE")
-    os.chdir(orig_dir)
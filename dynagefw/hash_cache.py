@@ -0,0 +1,69 @@
+"""
+Local sqlite cache of file hashes, keyed by absolute path, mtime and size.
+Files are only rehashed if they changed since they were last hashed.
+"""
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+DEFAULT_HASH_CACHE = "~/fw_jobs/file_hashes.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER,
+    size INTEGER,
+    sha256 TEXT
+);
+"""
+
+
+def file_sha256(file, block_size=2 ** 20):
+    h = hashlib.sha256()
+    with open(file, "rb") as fi:
+        for block in iter(lambda: fi.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def open_hash_cache(cache_file=DEFAULT_HASH_CACHE):
+    """
+    opens (and if needed creates) the cache, returns a sqlite3 connection
+    """
+    cache_file = Path(cache_file).expanduser()
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(cache_file)
+    con.executescript(SCHEMA)
+    return con
+
+
+def hash_files(con, root_dir, files, n_jobs=4):
+    """
+    returns {file: (sha256, size)} for files (paths relative to root_dir)
+    hashes are taken from the cache if path, mtime and size match, otherwise files are hashed in n_jobs threads
+    and the cache is updated
+    """
+    stats = {}
+    for file in files:
+        st = os.stat(Path(root_dir) / file)
+        stats[file] = (str((Path(root_dir) / file).resolve()), st.st_mtime_ns, st.st_size)
+
+    hashes, to_hash = {}, []
+    for file, (path, mtime_ns, size) in stats.items():
+        row = con.execute("SELECT sha256 FROM hashes WHERE path = ? AND mtime_ns = ? AND size = ?",
+                          (path, mtime_ns, size)).fetchone()
+        if row:
+            hashes[file] = (row[0], size)
+        else:
+            to_hash.append(file)
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        new_hashes = list(executor.map(lambda f: file_sha256(Path(root_dir) / f), to_hash))
+    with con:
+        for file, sha256 in zip(to_hash, new_hashes):
+            path, mtime_ns, size = stats[file]
+            con.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?)", (path, mtime_ns, size, sha256))
+            hashes[file] = (sha256, size)
+    return hashes
@@ -0,0 +1,240 @@
+"""
+Request-level instrumentation of the Flywheel client
+    stats = RequestStats()
+    fw = instrument_client(flywheel.Client(api_key), stats)
+    ...
+    stats.print_summary()
+    stats.save_json("requests.json")
+
+calls, errors, retries, latencies and bytes are recorded per sdk method (e.g. get_project_sessions) and, for the
+real sdk, per http endpoint (e.g. "GET /api/projects/{id}/sessions"). Containers returned by the client call back
+into the instrumented client, so that e.g. subject.sessions() or analysis.upload_output() are recorded as well.
+Finders (e.g. fw.jobs.iter_find) are recorded per requested page (e.g. get_all_jobs).
+A call is counted as retry if it follows a failed call of the same method for the same container in the same thread.
+Blocks of package code are recorded as spans (e.g. upload_row, see trace). If on_span is given, every request and
+span is passed to it as dict (name, kind, start_time, end_time, attributes, error), e.g. to export them as
+OpenTelemetry spans (see otel_span_handler).
+"""
+import inspect
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import numpy as np
+import pandas as pd
+from flywheel.finder import Finder
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")]
+
+
+class RequestStats:
+    def __init__(self, on_span=None):
+        self.on_span = on_span
+        self._lock = threading.Lock()
+        self._durations = defaultdict(list)
+        self._kinds = {}
+        self._errors = defaultdict(int)
+        self._retries = defaultdict(int)
+        self._bytes = defaultdict(int)
+
+    def record(self, name, start, duration, kind="sdk", n_bytes=0, error=None, attributes=None):
+        """start: time.time() at the beginning of the request, duration in seconds"""
+        with self._lock:
+            self._durations[name].append(duration)
+            self._kinds[name] = kind
+            self._bytes[name] += n_bytes
+            if error is not None:
+                self._errors[name] += 1
+        if self.on_span:
+            self.on_span({"name": name, "kind": kind, "start_time": start, "end_time": start + duration,
+                          "attributes": {**(attributes or {}), "bytes": n_bytes},
+                          "error": None if error is None else repr(error)})
+
+    def record_retry(self, name):
+        with self._lock:
+            self._retries[name] += 1
+
+    @contextmanager
+    def span(self, name, **attributes):
+        start, t0 = time.time(), time.perf_counter()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.record(name, start, time.perf_counter() - t0, "span", error=error, attributes=attributes)
+
+    def histogram(self, name):
+        """number of calls per latency bucket {upper bound in s: count}"""
+        with self._lock:
+            durations = list(self._durations[name])
+        counts = np.histogram(durations, [0] + LATENCY_BUCKETS)[0]
+        return dict(zip(LATENCY_BUCKETS, counts.tolist()))
+
+    def summary(self):
+        """DataFrame with one row per sdk method, http endpoint and span, sorted by total time"""
+        with self._lock:
+            names = list(self._durations)
+            rows = []
+            for name in names:
+                d = np.array(self._durations[name])
+                rows.append({"name": name, "kind": self._kinds[name], "calls": len(d), "errors": self._errors[name],
+                             "retries": self._retries[name], "total_s": d.sum(), "mean_ms": d.mean() * 1000,
+                             "p50_ms": np.percentile(d, 50) * 1000, "p95_ms": np.percentile(d, 95) * 1000,
+                             "max_ms": d.max() * 1000, "bytes": self._bytes[name]})
+        columns = ["name", "kind", "calls", "errors", "retries", "total_s", "mean_ms", "p50_ms", "p95_ms", "max_ms",
+                   "bytes"]
+        df = pd.DataFrame(rows, columns=columns)
+        return df.sort_values("total_s", ascending=False, kind="stable").reset_index(drop=True)
+
+    def to_dict(self):
+        out = {}
+        for row in self.summary().to_dict("records"):
+            name = row.pop("name")
+            out[name] = {**row, "histogram": {str(k): v for k, v in self.histogram(name).items()}}
+        return out
+
+    def save_json(self, filename):
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        with open(filename, "w") as fi:
+            json.dump(self.to_dict(), fi, indent=2, default=float)
+
+    def print_summary(self, kind=None):
+        df = self.summary()
+        if kind:
+            df = df[df.kind == kind]
+        print(df.round(3).to_string(index=False))
+
+
+class InstrumentedClient:
+    """
+    proxy around a flywheel client (or FakeFlywheel), records every call of a client method in stats
+    """
+
+    def __init__(self, fw, stats):
+        self._fw = fw
+        self.stats = stats
+        self._last_failed = threading.local()
+        # containers returned by the client get the proxy as context, so that their methods are recorded, too
+        api_client = getattr(fw, "api_client", fw)
+        if hasattr(api_client, "set_context"):
+            api_client.set_context(self)
+        if hasattr(api_client, "request"):
+            instrument_http(api_client, stats)
+
+    def __getattr__(self, name):
+        attr = getattr(self._fw, name)
+        # finders (fw.jobs) call the client they were created with, so they are bound to the proxy instead
+        if isinstance(attr, Finder) and hasattr(self._fw, f"get_all_{name}"):
+            return Finder(self, f"get_all_{name}")
+        # only methods are recorded, View builds an object without a request
+        if name.startswith("_") or name[0].isupper() or not inspect.ismethod(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            key = (name, args[0] if args and isinstance(args[0], str) else None)
+            if getattr(self._last_failed, "key", None) == key:
+                self.stats.record_retry(name)
+            start, t0 = time.time(), time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                self._last_failed.key = key
+                self.stats.record(name, start, time.perf_counter() - t0, error=e)
+                raise
+            self._last_failed.key = None
+            self.stats.record(name, start, time.perf_counter() - t0, n_bytes=payload_size(name, args))
+            return result
+
+        return call
+
+
+def payload_size(name, args):
+    """size of uploaded (FileSpec or path) or downloaded (destination path) files, 0 for other calls"""
+    if name.startswith("upload"):
+        for a in args:
+            if hasattr(a, "contents") and hasattr(a, "size"):
+                return a.size or 0
+            if isinstance(a, (str, Path)) and os.path.isfile(a):
+                return os.path.getsize(a)
+    if name.startswith("download") and args and isinstance(args[-1], (str, Path)) and os.path.isfile(args[-1]):
+        return os.path.getsize(args[-1])
+    return 0
+
+
+def endpoint_path(url):
+    """
+    >>> endpoint_path("https://fw.uzh.ch/api/projects/5e7c7e6bbd0a3d0028c0e9ad/sessions?limit=10")
+    '/api/projects/{id}/sessions'
+    >>> endpoint_path("https://fw.uzh.ch/api/analyses/5e7c7e6bbd0a3d0028c0e9ad/files/fs_sub-1.zip")
+    '/api/analyses/{id}/files/{name}'
+    """
+    path = urlsplit(url).path
+    path = re.sub(r"/[0-9a-f]{24}(?=/|$)", "/{id}", path)
+    return re.sub(r"/files/[^/]+", "/files/{name}", path)
+
+
+def instrument_http(api_client, stats):
+    """records every http request of the sdk's ApiClient, incl. request and response bytes"""
+    request = api_client.request
+
+    def instrumented_request(method, url, *args, **kwargs):
+        name = f"{method} {endpoint_path(url)}"
+        start, t0 = time.time(), time.perf_counter()
+        try:
+            response = request(method, url, *args, **kwargs)
+        except Exception as e:
+            stats.record(name, start, time.perf_counter() - t0, "http", error=e)
+            raise
+        headers = kwargs.get("headers") or {}
+        n_bytes = int(headers.get("Content-Length", 0) or 0)
+        if kwargs.get("_preload_content", True):
+            n_bytes += len(getattr(response, "data", b"") or b"")
+        elif hasattr(response, "getheader"):
+            n_bytes += int(response.getheader("Content-Length") or 0)
+        stats.record(name, start, time.perf_counter() - t0, "http", n_bytes=n_bytes,
+                     attributes={"status": getattr(response, "status", None)})
+        return response
+
+    api_client.request = instrumented_request
+
+
+def instrument_client(fw, stats=None):
+    """returns fw wrapped in an InstrumentedClient that records into stats, or fw itself if stats is None"""
+    if stats is None or isinstance(fw, InstrumentedClient):
+        return fw
+    return InstrumentedClient(fw, stats)
+
+
+def trace(fw, name, **attributes):
+    """context manager that records a block as span, if fw is instrumented"""
+    stats = getattr(fw, "stats", None)
+    if isinstance(stats, RequestStats):
+        return stats.span(name, **attributes)
+    return nullcontext()
+
+
+def otel_span_handler(tracer=None):
+    """on_span callback that exports spans with OpenTelemetry (needs opentelemetry-api and a configured provider)"""
+    from opentelemetry import trace as otel_trace
+
+    tracer = tracer or otel_trace.get_tracer("dynagefw")
+
+    def on_span(s):
+        span = tracer.start_span(s["name"], start_time=int(s["start_time"] * 1e9),
+                                 attributes={"kind": s["kind"], **{k: v for k, v in s["attributes"].items()
+                                                                   if v is not None}})
+        if s["error"]:
+            span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, s["error"]))
+        span.end(end_time=int(s["end_time"] * 1e9))
+
+    return on_span
@@ -0,0 +1,125 @@
+"""
+Local sqlite ledger of submitted gear jobs (one row per analysis), plus a history of job state changes.
+Lets check/cancel/delete commands select jobs by analysis label, gear, state or subject without querying flywheel.
+"""
+import hashlib
+import json
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+DEFAULT_LEDGER = "~/fw_jobs/jobs.sqlite"
+
+JOB_COLUMNS = ["analysis_id", "job_id", "group_id", "project_label", "container_type", "container_id",
+               "container_label", "subject_label", "gear_name", "gear_version", "analysis_label", "config_hash",
+               "submitted", "state", "state_updated"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    analysis_id TEXT PRIMARY KEY,
+    job_id TEXT,
+    group_id TEXT,
+    project_label TEXT,
+    container_type TEXT,
+    container_id TEXT,
+    container_label TEXT,
+    subject_label TEXT,
+    gear_name TEXT,
+    gear_version TEXT,
+    analysis_label TEXT,
+    config_hash TEXT,
+    submitted TEXT,
+    state TEXT,
+    state_updated TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_analysis_label ON jobs (analysis_label);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE INDEX IF NOT EXISTS jobs_subject_label ON jobs (subject_label);
+CREATE INDEX IF NOT EXISTS jobs_gear_name ON jobs (gear_name);
+CREATE INDEX IF NOT EXISTS jobs_job_id ON jobs (job_id);
+CREATE TABLE IF NOT EXISTS state_history (
+    analysis_id TEXT,
+    state TEXT,
+    time TEXT
+);
+CREATE INDEX IF NOT EXISTS state_history_analysis_id ON state_history (analysis_id);
+"""
+
+
+def open_ledger(ledger_file=DEFAULT_LEDGER):
+    """
+    opens (and if needed creates) the ledger, returns a sqlite3 connection
+    """
+    ledger_file = Path(ledger_file).expanduser()
+    ledger_file.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(ledger_file)
+    con.row_factory = sqlite3.Row
+    con.executescript(SCHEMA)
+    return con
+
+
+def config_hash(config):
+    """
+    >>> config_hash({"b": 1, "a": 2}) == config_hash({"a": 2, "b": 1})
+    True
+    """
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def add_jobs(con, jobs):
+    """
+    jobs: list of dicts with (a subset of) JOB_COLUMNS, analysis_id is required
+    """
+    now = datetime.now().isoformat(timespec="seconds")
+    with con:
+        for job in jobs:
+            row = {c: job.get(c) for c in JOB_COLUMNS}
+            row["submitted"] = row["submitted"] or now
+            row["state"] = row["state"] or "submitted"
+            row["state_updated"] = row["state_updated"] or now
+            con.execute(f"INSERT OR REPLACE INTO jobs ({', '.join(JOB_COLUMNS)}) "
+                        f"VALUES ({', '.join(['?'] * len(JOB_COLUMNS))})", [row[c] for c in JOB_COLUMNS])
+            con.execute("INSERT INTO state_history VALUES (?, ?, ?)", (row["analysis_id"], row["state"], now))
+
+
+def update_states(con, states):
+    """
+    states: {analysis_id: (job_id, state)}
+    only changed states are written (and added to the state history)
+    """
+    now = datetime.now().isoformat(timespec="seconds")
+    with con:
+        for analysis_id, (job_id, state) in states.items():
+            cur = con.execute("UPDATE jobs SET job_id = ?, state = ?, state_updated = ? "
+                              "WHERE analysis_id = ? AND (state IS NOT ? OR job_id IS NOT ?)",
+                              (job_id, state, now, analysis_id, state, job_id))
+            if cur.rowcount:
+                con.execute("INSERT INTO state_history VALUES (?, ?, ?)", (analysis_id, state, now))
+
+
+def select_jobs(con, analysis_label=None, gear_name=None, state=None, subject_label=None, project_label=None):
+    """
+    returns jobs (list of dicts) matching all given criteria
+    state can be a str or a list of states
+    """
+    where, params = [], []
+    for column, value in [("analysis_label", analysis_label), ("gear_name", gear_name),
+                          ("subject_label", subject_label), ("project_label", project_label)]:
+        if value:
+            where.append(f"{column} = ?")
+            params.append(value)
+    if state:
+        states = [state] if isinstance(state, str) else list(state)
+        where.append(f"state IN ({', '.join(['?'] * len(states))})")
+        params += states
+
+    query = "SELECT * FROM jobs"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    return [dict(r) for r in con.execute(query + " ORDER BY submitted", params)]
+
+
+def get_state_history(con, analysis_id):
+    return [(r["state"], r["time"]) for r in
+            con.execute("SELECT state, time FROM state_history WHERE analysis_id = ? ORDER BY rowid",
+                        (analysis_id,))]
@@ -1,18 +1,29 @@
 import flywheel
-from .fw_utils import get_fw_api
+from .fw_utils import get_client
+from .hash_cache import DEFAULT_HASH_CACHE, open_hash_cache, hash_files
+from .gears import save_results, load_failed_container_ids
+from .instrumentation import trace
 from pprint import pprint
 from datetime import datetime
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import pickle
 import os
-from zipfile import ZipFile
 import shutil
 from warnings import warn
 import time
 from datetime import datetime
 import sys
-from zipfile import ZipFile
-from tempfile import TemporaryDirectory
+import io
+import queue
+import threading
+import struct
+import zlib
+from collections import deque
+from fnmatch import fnmatch, filter as fnmatch_filter
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP64_LIMIT
+from tempfile import TemporaryDirectory, SpooledTemporaryFile
 import backoff
 from OpenSSL.SSL import WantWriteError
 
@@ -56,61 +67,833 @@ def fetch_analysis(fw, container, analysis_label):
     return analysis, analysis_already_existed
 
 
-def list_files(root_dir, search_strings):
+def get_file_index(root_dir):
+    """
+    walks root_dir once with os.scandir
+    returns {directory: (subdirectories, files, symlinked subdirectories)} with directories relative to root_dir
+    ("" for root_dir), names are sorted
+    symlinks to directories are walked as well (unless they point to a directory above them), so that they can be
+    matched like with Path.glob (see find_indexed_files)
+    """
+    file_index = {}
+    # (directory, real paths of the directory and the directories above it)
+    to_walk = [("", (os.path.realpath(root_dir),))]
+    while to_walk:
+        rel_dir, parents = to_walk.pop()
+        dirs, files, links = [], [], []
+        with os.scandir(Path(root_dir) / rel_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                    if entry.is_symlink():
+                        links.append(entry.name)
+                        real_path = os.path.realpath(entry.path)
+                        if real_path in parents:
+                            continue
+                    else:
+                        real_path = os.path.join(parents[-1], entry.name)
+                    to_walk.append((f"{rel_dir}/{entry.name}" if rel_dir else entry.name, parents + (real_path,)))
+                elif entry.is_file():
+                    files.append(entry.name)
+        file_index[rel_dir] = (sorted(dirs), sorted(files), links)
+    return file_index
+
+
+def _walk_indexed(file_index, rel_dir):
+    """rel_dir and the directories below it, without following symlinks below rel_dir (like Path.rglob)"""
+    dirs = []
+    to_walk = [rel_dir]
+    while to_walk:
+        d = to_walk.pop()
+        dirs.append(d)
+        sub_dirs, _, links = file_index.get(d, ([], [], []))
+        prefix = f"{d}/" if d else ""
+        to_walk.extend(prefix + sd for sd in sub_dirs if sd not in links)
+    return dirs
+
+
+def _files_below(file_index, rel_dir):
+    files = []
+    for d in _walk_indexed(file_index, rel_dir):
+        files.extend(f"{d}/{f}" if d else f for f in file_index.get(d, ([], [], []))[1])
+    return files
+
+
+def _match_names(names, pattern):
+    """
+    names (sorted) matching the glob pattern, only the names that start with its literal prefix are matched
+    >>> _match_names(["sub-1", "sub-10", "sub-2", "sub-20"], "sub-2*")
+    ['sub-2', 'sub-20']
+    """
+    prefix = pattern
+    for i, c in enumerate(pattern):
+        if c in "*?[":
+            prefix = pattern[:i]
+            break
+    start = end = bisect_left(names, prefix)
+    while end < len(names) and names[end].startswith(prefix):
+        end += 1
+    return fnmatch_filter(names[start:end], pattern)
+
+
+def find_indexed_files(file_index, search_string):
+    """
+    files matching the glob pattern search_string (relative to root_dir), files in matching directories are
+    included recursively. "**" matches any number of directories
+    like Path.glob, symlinked directories are followed when they match a segment of search_string, but not by "**"
+    or when listing the files in a matching directory
+    >>> file_index = {"": (["sub-01", "sub-02"], ["README"], []), "sub-01": (["anat"], ["scans.tsv"], []),
+    ...               "sub-01/anat": ([], ["T1w.nii.gz"], []), "sub-02": ([], [], [])}
+    >>> sorted(find_indexed_files(file_index, "sub-01*"))
+    ['sub-01/anat/T1w.nii.gz', 'sub-01/scans.tsv']
+    >>> find_indexed_files(file_index, "*/anat")
+    ['sub-01/anat/T1w.nii.gz']
+    >>> find_indexed_files(file_index, "**/*.nii.gz")
+    ['sub-01/anat/T1w.nii.gz']
+    """
+    # (directory, is_dir) that match the pattern so far
+    matches = [("", True)]
+    for segment in PurePosixPath(search_string).parts:
+        new_matches = []
+        for rel_dir, is_dir in matches:
+            if not is_dir:
+                continue
+            if segment == "**":
+                new_matches.extend((d, True) for d in _walk_indexed(file_index, rel_dir))
+                continue
+            dirs, files, _ = file_index.get(rel_dir, ([], [], []))
+            prefix = f"{rel_dir}/" if rel_dir else ""
+            new_matches.extend((prefix + d, True) for d in _match_names(dirs, segment))
+            new_matches.extend((prefix + f, False) for f in _match_names(files, segment))
+        matches = list(dict.fromkeys(new_matches))
+
+    files = []
+    for path, is_dir in matches:
+        files.extend(_files_below(file_index, path) if is_dir else [path])
+    return files
+
+
+def list_files(root_dir, search_strings, file_index=None):
+    """
+    files (paths relative to root_dir) matching any of search_strings, see find_indexed_files
+    file_index: from get_file_index, if None root_dir is walked
+    """
+    if file_index is None:
+        file_index = get_file_index(root_dir)
     files = []
-    os.chdir(root_dir)
     for s in search_strings:
-        files_and_folders = Path(".").glob(s)
-        for ff in files_and_folders:
-            if ff.is_file():
-                files.append(ff)
-            else:
-                files.extend([f for f in ff.rglob("*") if f.is_file()])
-    files = list(set(files))
+        files.extend(find_indexed_files(file_index, s))
+    files = [Path(f) for f in sorted(set(files))]
     if not files:
         warn(f"No files found {root_dir} {search_strings}")
     return files
 
 
-def zip_files(files, zip_file_name, tmp_dir):
-    zip_file = Path(str(Path(tmp_dir) / zip_file_name) + ".zip")
-    with ZipFile(zip_file, mode='w', strict_timestamps=False) as z:
+# (glob, compress_type, compresslevel), matched against the path of a member, first match wins
+# already compressed data is stored, text is deflated, uncompressed binary data (surfaces, overlays, annotations,
+# .nii) is deflated with a fast level
+DEFAULT_COMPRESSION_POLICY = [
+    ("*.nii.gz", ZIP_STORED, None),
+    ("*.gz", ZIP_STORED, None),
+    ("*.mgz", ZIP_STORED, None),
+    ("*.zip", ZIP_STORED, None),
+    ("*.bz2", ZIP_STORED, None),
+    ("*.xz", ZIP_STORED, None),
+    ("*.png", ZIP_STORED, None),
+    ("*.jpg", ZIP_STORED, None),
+    ("*.stats", ZIP_DEFLATED, 6),
+    ("*.label", ZIP_DEFLATED, 6),
+    ("*.ctab", ZIP_DEFLATED, 6),
+    ("*.log", ZIP_DEFLATED, 6),
+    ("*.txt", ZIP_DEFLATED, 6),
+    ("*.csv", ZIP_DEFLATED, 6),
+    ("*.tsv", ZIP_DEFLATED, 6),
+    ("*.json", ZIP_DEFLATED, 6),
+    ("*.html", ZIP_DEFLATED, 6),
+    ("*.svg", ZIP_DEFLATED, 6),
+    ("*.nii", ZIP_DEFLATED, 1),
+    ("*.mgh", ZIP_DEFLATED, 1),
+    ("*.annot", ZIP_DEFLATED, 1),
+    ("*/surf/*", ZIP_DEFLATED, 1),
+]
+
+CHUNK_SIZE = 1024 * 1024
+# members compressed in parallel (write_zip with n_compress > 1) are kept in memory up to this size, larger ones are
+# spooled to a temporary file
+PARALLEL_SPOOL_SIZE = 16 * CHUNK_SIZE
+
+# key in the analysis info that holds [path, sha256, size] of all uploaded files (incremental uploads)
+MANIFEST_KEY = "file_manifest"
+# key in the analysis info that marks analyses uploaded in parts as "incomplete" or "complete"
+UPLOAD_STATUS_KEY = "upload_status"
+
+
+def get_compression_policy(compression, compresslevel=None):
+    """
+    compression: a policy (list of (glob, compress_type, compresslevel)) or a ZIP_* constant, which is used for all
+     members that are not already compressed (DEFAULT_COMPRESSION_POLICY with ZIP_STORED)
+    >>> get_compression_policy(ZIP_DEFLATED)[-1]
+    ('*', 8, None)
+    """
+    if isinstance(compression, int):
+        stored = [p for p in DEFAULT_COMPRESSION_POLICY if p[1] == ZIP_STORED]
+        return stored + [("*", compression, compresslevel)]
+    return compression
+
+
+def member_compression(file, policy):
+    """
+    returns (compress_type, compresslevel) for file, members that match no pattern are stored
+    >>> member_compression("sub-01/stats/aseg.stats", DEFAULT_COMPRESSION_POLICY)
+    (8, 6)
+    >>> member_compression("sub-01/mri/T1.mgz", DEFAULT_COMPRESSION_POLICY)
+    (0, None)
+    """
+    file = str(file).lower()
+    for pattern, compress_type, compresslevel in policy:
+        if fnmatch(file, pattern):
+            return compress_type, compresslevel
+    return ZIP_STORED, None
+
+
+def write_zip(fp, files, root_dir=".", compression=DEFAULT_COMPRESSION_POLICY, compresslevel=None, size_only=False,
+              n_compress=1):
+    """
+    writes a zip of files (paths relative to root_dir) into the file object fp (which does not need to be seekable)
+    compression: policy or ZIP_* constant, see get_compression_policy
+    size_only: stored members are written as zeros without reading them (the zip has the same size as the real one)
+    n_compress: compress members in n_compress threads (see _ParallelZipWriter). the zip has the same members, but
+     not exactly the same bytes (and size) as with n_compress=1
+    """
+    policy = get_compression_policy(compression, compresslevel)
+    if n_compress > 1:
+        _write_zip_parallel(fp, files, root_dir, policy, size_only, n_compress)
+        return
+    with ZipFile(fp, mode='w', strict_timestamps=False) as z:
+        for file in files:
+            compress_type, level = member_compression(file, policy)
+            if compress_type == ZIP_STORED:
+                info = ZipInfo.from_file(Path(root_dir) / file, arcname=file, strict_timestamps=False)
+                info.compress_type = ZIP_STORED
+                with z.open(info, mode="w") as dst:
+                    if size_only:
+                        for start in range(0, info.file_size, CHUNK_SIZE):
+                            dst.write(bytes(min(CHUNK_SIZE, info.file_size - start)))
+                    else:
+                        with open(Path(root_dir) / file, "rb") as src:
+                            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            else:
+                z.write(Path(root_dir) / file, arcname=file, compress_type=compress_type, compresslevel=level)
+
+
+def _compress_member(path, arcname, compress_type, compresslevel):
+    """single-member zip of path (in a SpooledTemporaryFile), written by a worker thread of _write_zip_parallel"""
+    spool = SpooledTemporaryFile(max_size=PARALLEL_SPOOL_SIZE)
+    with ZipFile(spool, mode="w", strict_timestamps=False) as z:
+        z.write(path, arcname=arcname, compress_type=compress_type, compresslevel=compresslevel)
+    spool.seek(0)
+    return spool
+
+
+def _write_zip_parallel(fp, files, root_dir, policy, size_only, n_compress):
+    """
+    write_zip with n_compress threads: each member that gets compressed is zipped on its own (_compress_member),
+    the members are written into fp in the order of files. stored members are copied by the calling thread, while
+    the threads compress the following members. at most 2 * n_compress compressed members are waiting
+    """
+    writer = _ParallelZipWriter(fp)
+    pending = deque()
+
+    def write_next():
+        file, future = pending.popleft()
+        if future is None:
+            writer.write_stored(Path(root_dir) / file, file, size_only)
+        else:
+            with future.result() as spool:
+                writer.write_member_zip(spool)
+
+    with ThreadPoolExecutor(max_workers=n_compress) as pool:
         for file in files:
-            z.write(file)
+            compress_type, level = member_compression(file, policy)
+            future = None
+            if compress_type != ZIP_STORED:
+                future = pool.submit(_compress_member, Path(root_dir) / file, file, compress_type, level)
+            pending.append((file, future))
+            while len(pending) > 2 * n_compress:
+                write_next()
+        while pending:
+            write_next()
+    writer.close()
+
+
+class _ParallelZipWriter:
+    """
+    assembles a zip in a file object that does not need to be seekable, from the local records of single-member zips
+    (written with ZipFile) and from stored members (local header and data descriptor written here), followed by the
+    central directory. uses zip64 records where sizes or offsets exceed ZIP64_LIMIT, like ZipFile
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offset = 0
+        self.entries = []
+
+    def _write(self, b):
+        self.fp.write(b)
+        self.offset += len(b)
+
+    def write_member_zip(self, spool):
+        """copies the local record of the member of the single-member zip spool (header and data) verbatim"""
+        with ZipFile(spool) as z:
+            info, = z.infolist()
+        assert not info.flag_bits & 0x08, "single-member zips are written without data descriptor"
+        spool.seek(0)
+        header = spool.read(30)
+        name_length, extra_length = struct.unpack("<2H", header[26:30])
+        self.entries.append((info, self.offset))
+        self._write(header)
+        remaining = name_length + extra_length + info.compress_size
+        while remaining:
+            chunk = spool.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise EOFError(f"truncated zip of {info.filename}")
+            self._write(chunk)
+            remaining -= len(chunk)
+
+    def write_stored(self, path, arcname, size_only=False):
+        """writes path as stored member, the CRC follows the data in a data descriptor (read once, like ZipFile)"""
+        info = ZipInfo.from_file(path, arcname=arcname, strict_timestamps=False)
+        info.compress_type = ZIP_STORED
+        info.flag_bits |= 0x08
+        name = self._encode_name(info)
+        zip64 = info.file_size > ZIP64_LIMIT
+        extra = struct.pack("<2H2Q", 1, 16, 0, 0) if zip64 else b""
+        size_field = 0xFFFFFFFF if zip64 else 0
+        self.entries.append((info, self.offset))
+        self._write(struct.pack("<4s2B4HL2L2H", b"PK\x03\x04", 45 if zip64 else 20, 0, info.flag_bits, ZIP_STORED,
+                                *self._dos_time(info), 0, size_field, size_field, len(name), len(extra)) + name + extra)
+        crc = 0
+        if size_only:
+            for start in range(0, info.file_size, CHUNK_SIZE):
+                self._write(bytes(min(CHUNK_SIZE, info.file_size - start)))
+        else:
+            with open(path, "rb") as src:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                    crc = zlib.crc32(chunk, crc)
+                    self._write(chunk)
+        info.CRC = crc
+        info.compress_size = info.file_size
+        fmt = "<4sL2Q" if zip64 else "<4s3L"
+        self._write(struct.pack(fmt, b"PK\x07\x08", crc, info.file_size, info.file_size))
+
+    @staticmethod
+    def _encode_name(info):
+        try:
+            return info.filename.encode("ascii")
+        except UnicodeEncodeError:
+            info.flag_bits |= 0x800
+            return info.filename.encode("utf-8")
+
+    @staticmethod
+    def _dos_time(info):
+        year, month, day, hour, minute, second = info.date_time
+        return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+    @staticmethod
+    def _strip_zip64_extra(extra):
+        kept, i = b"", 0
+        while i + 4 <= len(extra):
+            header_id, size = struct.unpack("<2H", extra[i:i + 4])
+            if header_id != 1:
+                kept += extra[i:i + 4 + size]
+            i += 4 + size
+        return kept
+
+    def _central_dir_entry(self, info, offset):
+        zip64_fields = []
+        file_size, compress_size = info.file_size, info.compress_size
+        if file_size > ZIP64_LIMIT or compress_size > ZIP64_LIMIT:
+            zip64_fields += [file_size, compress_size]
+            file_size = compress_size = 0xFFFFFFFF
+        if offset > ZIP64_LIMIT:
+            zip64_fields.append(offset)
+            offset = 0xFFFFFFFF
+        extra = self._strip_zip64_extra(info.extra)
+        if zip64_fields:
+            extra = struct.pack(f"<2H{len(zip64_fields)}Q", 1, 8 * len(zip64_fields), *zip64_fields) + extra
+        min_version = 45 if zip64_fields else 20
+        name = info.filename.encode("utf-8" if info.flag_bits & 0x800 else "cp437")
+        return struct.pack("<4s4B4HL2L5H2L", b"PK\x01\x02", max(min_version, info.create_version),
+                           info.create_system, max(min_version, info.extract_version), 0, info.flag_bits,
+                           info.compress_type, *self._dos_time(info), info.CRC, compress_size, file_size, len(name),
+                           len(extra), 0, 0, info.internal_attr, info.external_attr, offset) + name + extra
+
+    def close(self):
+        """writes the central directory and the end of central directory record(s)"""
+        start = self.offset
+        for info, offset in self.entries:
+            self._write(self._central_dir_entry(info, offset))
+        count, size = len(self.entries), self.offset - start
+        if count >= 0xFFFF or size > ZIP64_LIMIT or start > ZIP64_LIMIT:
+            zip64_end = self.offset
+            self._write(struct.pack("<4sQ2H2L4Q", b"PK\x06\x06", 44, 45, 45, 0, 0, count, count, size, start))
+            self._write(struct.pack("<4sLQL", b"PK\x06\x07", 0, zip64_end, 1))
+            count, size, start = min(count, 0xFFFF), min(size, 0xFFFFFFFF), min(start, 0xFFFFFFFF)
+        self._write(struct.pack("<4s4H2LH", b"PK\x05\x06", 0, 0, count, count, size, start, 0))
+        self.fp.flush()
+
+
+class _ByteCounter:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, b):
+        self.size += len(b)
+        return len(b)
+
+    def flush(self):
+        pass
+
+
+def zip_size(files, root_dir=".", compression=DEFAULT_COMPRESSION_POLICY, compresslevel=None, n_compress=1):
+    """
+    size of the zip written by write_zip, without writing it. only members that get compressed are read
+    """
+    counter = _ByteCounter()
+    write_zip(counter, files, root_dir, compression, compresslevel, size_only=True, n_compress=n_compress)
+    return counter.size
+
+
+class ZipStream(io.RawIOBase):
+    """
+    readable file object producing the zip of files on the fly
+    a background thread writes the zip into a queue of at most spool_size bytes, nothing is written to disk
+    """
+
+    def __init__(self, files, root_dir=".", compression=DEFAULT_COMPRESSION_POLICY, compresslevel=None,
+                 spool_size=64 * CHUNK_SIZE, n_compress=1):
+        super().__init__()
+        self._chunks = queue.Queue(maxsize=max(1, spool_size // CHUNK_SIZE))
+        self._buffer = b""
+        self._done = False
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(files, root_dir, compression, compresslevel,
+                                                                    n_compress), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._closing.is_set():
+            try:
+                self._chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError("ZipStream closed")
+
+    def _produce(self, files, root_dir, compression, compresslevel, n_compress):
+        stream = self
+
+        class Writer:
+            def write(self, b):
+                stream._put(bytes(b))
+                return len(b)
+
+            def flush(self):
+                pass
+
+        try:
+            write_zip(Writer(), files, root_dir, compression, compresslevel, n_compress=n_compress)
+            self._put(None)
+        except Exception as e:
+            if not self._closing.is_set():
+                self._put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer and not self._done:
+            chunk = self._chunks.get()
+            if chunk is None:
+                self._done = True
+            elif isinstance(chunk, Exception):
+                raise chunk
+            else:
+                self._buffer = chunk
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        self._closing.set()
+        super().close()
+
+
+def zip_files(files, zip_file_name, tmp_dir, root_dir=".", compression=DEFAULT_COMPRESSION_POLICY, compresslevel=None,
+              n_compress=1):
+    """
+    zips files (paths relative to root_dir) into {tmp_dir}/{zip_file_name}.zip
+    compression: policy or ZIP_* constant, see get_compression_policy
+    """
+    zip_file = Path(str(Path(tmp_dir) / zip_file_name) + ".zip")
+    with open(zip_file, "wb") as fp:
+        write_zip(fp, files, root_dir, compression, compresslevel, n_compress=n_compress)
     return zip_file
 
 
-def zip_and_upload_data(fw, container, root_dir, analysis_label, search_strings, note=""):
-    assert isinstance(search_strings, list), "search_strings should be a list"
-    files = list_files(root_dir, search_strings)
+@backoff.on_exception(backoff.expo, WantWriteError, max_time=600)
+def upload_zip(analysis, zip_file):
+    analysis.upload_output(zip_file)
 
-    if files:
-        analysis, analysis_already_existed = fetch_analysis(fw, container, analysis_label)
 
-        if analysis_already_existed:
-            print(f"    analysis found for {container.label}. Assuming that it has all the data and skipping upload")
+@backoff.on_exception(backoff.expo, WantWriteError, max_time=600)
+def upload_zip_stream(analysis, files, zip_file_name, root_dir=".", compression=ZIP_STORED, compresslevel=None,
+                      spool_size=64 * CHUNK_SIZE, size=None, n_compress=1):
+    """
+    uploads the zip of files as {zip_file_name}.zip without creating it on disk (see ZipStream)
+    the size (which is needed for the upload) is computed beforehand with zip_size, if not given. members that are
+    compressed are compressed twice (for zip_size and for the upload), stored members are only read once
+    n_compress: see write_zip, a given size has to be computed with the same n_compress
+    """
+    if size is None:
+        size = zip_size(files, root_dir, compression, compresslevel, n_compress)
+    with ZipStream(files, root_dir, compression, compresslevel, spool_size, n_compress) as stream:
+        analysis.upload_output(flywheel.FileSpec(zip_file_name + ".zip", contents=stream, size=size,
+                                                 content_type="application/zip"))
+
+
+def get_remote_manifest(fw, analysis):
+    """
+    {path: (sha256, size)} of the files uploaded to analysis, from the manifest in the analysis info
+    for analyses uploaded without manifest, from the members of the analysis' zips (sha256 is None, so files are
+    compared by size)
+    """
+    analysis = fw.get_analysis(analysis.id)
+    if analysis.info.get(MANIFEST_KEY):
+        return {path: (sha256, size) for path, sha256, size in analysis.info[MANIFEST_KEY]}
+    manifest = {}
+    for f in analysis.files or []:
+        if f.name.endswith(".zip"):
+            for member in fw.get_analysis_output_zip_info(analysis.id, f.name).members:
+                if not member.path.endswith("/"):
+                    manifest[member.path] = (None, member.size)
+    return manifest
+
+
+def changed_files(local, remote):
+    """
+    files in local ({path: (sha256, size)}) that are missing or different in remote
+    >>> changed_files({"a": ("h1", 1), "b": ("h2", 2), "c": ("h3", 3), "d": ("h4", 4)},
+    ...               {"a": ("h1", 1), "b": ("hx", 2), "c": (None, 3)})
+    ['b', 'd']
+    """
+    return [path for path, (sha256, size) in local.items()
+            if path not in remote or remote[path][0] not in (None, sha256) or remote[path][1] != size]
 
-        else:  # upload data
+
+def split_into_parts(files, root_dir=".", part_size=None):
+    """
+    splits files into consecutive parts of at most part_size bytes (uncompressed), a larger file is a part of its own
+    part_size None: one part
+    """
+    if part_size is None:
+        return [list(files)]
+    parts, part, size = [], [], 0
+    for file in files:
+        file_size = (Path(root_dir) / file).stat().st_size
+        if part and size + file_size > part_size:
+            parts.append(part)
+            part, size = [], 0
+        part.append(file)
+        size += file_size
+    return parts + [part] if part else parts
+
+
+def prepare_upload(fw, container, files, root_dir, analysis_label, note="", hash_cache=None, part_size=None):
+    """
+    returns None if nothing needs to be uploaded, otherwise a dict with
+     analysis, parts (list of (zip_file_name, files) to upload), created (analysis is new),
+     hashes ({path: (sha256, size)} of the files to upload) and
+     manifest ({path: (sha256, size)} of the uploaded files, updated after each part. None if not incremental)
+
+    part_size: files are uploaded in zips of at most part_size bytes (uncompressed, see split_into_parts), named
+     {analysis_label}_{container}_partXXXofYYY.zip. a new analysis is marked as incomplete (info.upload_status)
+     until all its parts are uploaded. Parts that are missing in an incomplete analysis are uploaded on the next
+     run, complete analyses are skipped.
+
+    hash_cache: connection from open_hash_cache. if given, the upload is incremental: files are compared against the
+     manifest of an existing analysis (see get_remote_manifest) and only new or changed files are uploaded
+     (as {analysis_label}_{container}_{timestamp}.zip).
+
+    if preparing fails, a new analysis is removed again and the exception is raised
+    """
+    analysis, analysis_already_existed = fetch_analysis(fw, container, analysis_label)
+    try:
+        zip_file_name = f"{analysis_label}_{container.label}"
+        manifest, hashes, uploaded = None, {}, set()
+
+        if analysis_already_existed and hash_cache is None:
+            analysis = fw.get_analysis(analysis.id)
+            if analysis.info.get(UPLOAD_STATUS_KEY) != "incomplete":
+                print(f"    analysis found for {container.label}. Assuming that it has all the data and skipping "
+                      f"upload")
+                return None
+            uploaded = {f.name for f in analysis.files or []}
+            print(f"    incomplete analysis found for {container.label}. Uploading missing parts")
+
+        if hash_cache is not None:
+            local = {str(f): h for f, h in hash_files(hash_cache, root_dir, files).items()}
+            manifest = get_remote_manifest(fw, analysis) if analysis_already_existed else {}
+            to_upload = changed_files(local, manifest)
+            if not to_upload:
+                print(f"    {container.label} is up to date")
+                return None
+            if analysis_already_existed:
+                print(f"    {len(to_upload)} of {len(files)} files of {container.label} are new or changed")
+                zip_file_name += datetime.now().strftime("_%Y%m%d-%H%M%S")
+            files = [Path(f) for f in to_upload]
+            hashes = {f: local[f] for f in to_upload}
+
+        parts = split_into_parts(files, root_dir, part_size)
+        if len(parts) > 1:
+            names = [f"{zip_file_name}_part{i + 1:03d}of{len(parts):03d}" for i in range(len(parts))]
+        else:
+            names = [zip_file_name]
+        parts = [(name, part) for name, part in zip(names, parts) if f"{name}.zip" not in uploaded]
+
+        if not analysis_already_existed:
             if note:
                 analysis.add_note(note)
-            with TemporaryDirectory() as tmp_dir:
-                print(f"    zip and upload {len(files)} files")
-                zip_file_name = f"{analysis_label}_{container.label}"
-                zip_file = zip_files(files, zip_file_name, tmp_dir)
-
-                @backoff.on_exception(backoff.expo, WantWriteError, max_time=600)
-                def upload_(analysis, zip_file):
-                    analysis.upload_output(zip_file)
-                try:
-                    upload_(analysis, zip_file)
-                except Exception:
-                    fw.delete_container_analysis(container.id, analysis.id)
-                    raise RuntimeError(f"Upload for {container.label} failed. Removed analysis and stopping")
+            if len(parts) > 1 and hash_cache is None:
+                analysis.update_info({UPLOAD_STATUS_KEY: "incomplete"})
+    except Exception:
+        # a new analysis would be skipped as complete on the next run
+        if not analysis_already_existed:
+            fw.delete_container_analysis(container.id, analysis.id)
+        raise
+    return {"analysis": analysis, "parts": parts, "created": not analysis_already_existed, "hashes": hashes,
+            "manifest": manifest}
+
+
+def save_manifest(analysis, manifest):
+    analysis.update_info({MANIFEST_KEY: [[path, sha256, size] for path, (sha256, size) in sorted(manifest.items())]})
+
+
+def default_compression(compression, streaming):
+    """
+    compression, if None the default: DEFAULT_COMPRESSION_POLICY, or ZIP_STORED when streaming (see upload_zip_stream)
+    """
+    if compression is None:
+        return ZIP_STORED if streaming else DEFAULT_COMPRESSION_POLICY
+    return compression
+
+
+def upload_part(upload, zip_file_name, files, root_dir, tmp_dir=None, zip_file=None, streaming=False,
+                compression=None, compresslevel=None, n_compress=1, max_tries=5, retry_delay=10):
+    """
+    zips (unless zip_file is given) and uploads one part of upload (from prepare_upload)
+    compression: see default_compression
+    n_compress: number of threads compressing members, see write_zip
+    the upload is retried up to max_tries times with exponential backoff and jitter (retry_delay, 2 * retry_delay,
+     ... seconds, max. 5 minutes). when streaming, the size of the zip is only computed once for all tries.
+    after the upload, the files are added to the manifest (incremental uploads)
+    """
+    analysis = upload["analysis"]
+    compression = default_compression(compression, streaming)
+
+    def on_backoff(details):
+        print(f"    upload of {zip_file_name} failed. Wait {details['wait']:.0f} seconds and retry {datetime.now()}")
+
+    @backoff.on_exception(backoff.expo, Exception, max_tries=max_tries, factor=retry_delay, max_value=300,
+                          jitter=backoff.full_jitter, on_backoff=on_backoff)
+    def upload_():
+        if streaming:
+            upload_zip_stream(analysis, files, zip_file_name, root_dir, compression, compresslevel, size=size,
+                              n_compress=n_compress)
+        else:
+            upload_zip(analysis, zip_file)
+
+    if streaming:
+        size = zip_size(files, root_dir, compression, compresslevel, n_compress)
+    elif zip_file is None:
+        zip_file = zip_files(files, zip_file_name, tmp_dir, root_dir, compression, compresslevel, n_compress)
+    try:
+        upload_()
+    finally:
+        if zip_file:
+            Path(zip_file).unlink()
+
+    if upload["manifest"] is not None:
+        upload["manifest"].update({str(f): upload["hashes"][str(f)] for f in files})
+        save_manifest(analysis, upload["manifest"])
+
+
+def prepare_failed(container, error):
+    """result dict (see finish_upload) for a container whose upload could not be prepared"""
+    error = str(error).replace("\n", " ")
+    print(f"    upload for {container.label} failed. {error}")
+    return {"container_id": container.id, "container_label": container.label, "analysis_id": "",
+            "status": "failed", "error": error}
+
+
+def finish_upload(fw, container, upload, errors):
+    """
+    marks the analysis as complete or, if parts failed, removes a new analysis without uploaded parts
+    returns a result dict with container_id, container_label, status ("uploaded" or "failed"), analysis_id, error
+    """
+    analysis = upload["analysis"]
+    result = {"container_id": container.id, "container_label": container.label, "analysis_id": analysis.id,
+              "status": "uploaded", "error": ""}
+    if not errors:
+        if upload["manifest"] is None and (len(upload["parts"]) > 1 or not upload["created"]):
+            analysis.update_info({UPLOAD_STATUS_KEY: "complete"})
+        print(f"    {container.label} uploaded")
+        return result
+
+    if upload["created"] and len(errors) == len(upload["parts"]):
+        fw.delete_container_analysis(container.id, analysis.id)
+        result["analysis_id"] = ""
+        msg = "Removed analysis"
+    else:
+        msg = "Kept analysis, missing parts are uploaded on the next run"
+    result["status"] = "failed"
+    result["error"] = "; ".join(errors).replace("\n", " ")
+    print(f"    upload for {container.label} failed. {msg}. {result['error']}")
+    return result
+
+
+def upload_container(fw, container, files, root_dir, analysis_label, note="", streaming=False,
+                     compression=None, compresslevel=None, n_compress=1, hash_cache=None,
+                     part_size=None, max_tries=5, retry_delay=10):
+    """
+    uploads files of container into the analysis analysis_label, one part after the other (see prepare_upload and
+     upload_part). a failed part does not stop the other parts
+    returns a result dict (see finish_upload), None if nothing needed to be uploaded
+    """
+    try:
+        with trace(fw, "prepare_upload"):
+            upload = prepare_upload(fw, container, files, root_dir, analysis_label, note, hash_cache, part_size)
+    except Exception as e:
+        return prepare_failed(container, e)
+    if not upload:
+        return None
+    errors = []
+    with TemporaryDirectory() as tmp_dir:
+        for zip_file_name, part in upload["parts"]:
+            print(f"    zip and upload {len(part)} files ({zip_file_name})")
+            try:
+                with trace(fw, "upload_part"):
+                    upload_part(upload, zip_file_name, part, root_dir, tmp_dir, streaming=streaming,
+                                compression=compression, compresslevel=compresslevel, n_compress=n_compress,
+                                max_tries=max_tries, retry_delay=retry_delay)
+            except Exception as e:
+                errors.append(f"{zip_file_name}: {e}")
+    return finish_upload(fw, container, upload, errors)
+
+
+def zip_and_upload_data(fw, container, root_dir, analysis_label, search_strings, note="", streaming=False,
+                        compression=None, compresslevel=None, n_compress=1, file_index=None,
+                        hash_cache=None, part_size=None, max_tries=5, retry_delay=10):
+    """
+    file_index: from get_file_index, if None root_dir is walked
+    streaming: zip on the fly into the upload instead of into a temporary file (see upload_zip_stream)
+    compression, compresslevel: policy or ZIP_* constant, see get_compression_policy and default_compression
+    n_compress: number of threads compressing members, see write_zip
+    hash_cache: for incremental uploads, see prepare_upload
+    part_size: upload in zips of at most part_size bytes, see prepare_upload
+    max_tries, retry_delay: retries per part, see upload_part
+    raises a RuntimeError if the upload failed
+    """
+    assert isinstance(search_strings, list), "search_strings should be a list"
+    files = list_files(root_dir, search_strings, file_index)
+
+    if files:
+        result = upload_container(fw, container, files, root_dir, analysis_label, note, streaming, compression,
+                                  compresslevel, n_compress, hash_cache, part_size, max_tries, retry_delay)
+        if result and result["status"] == "failed":
+            raise RuntimeError(f"Upload for {container.label} failed. {result['error']}")
     return files
 
 
+def zip_and_upload_pipelined(fw, containers_files, root_dir, analysis_label, note="", n_zip=2, n_upload=4,
+                             max_zips=4, streaming=False, compression=None, compresslevel=None, n_compress=1,
+                             hash_cache=None, part_size=None, max_tries=5, retry_delay=10):
+    """
+    like upload_container for many containers, with zipping and uploading overlapping:
+    a process pool (n_zip processes) builds the zips, a thread pool (n_upload threads) uploads finished zips
+    max_zips: max. number of zips on disk at the same time (being built, waiting or uploading)
+    containers_files: list of (container, files)
+    failed uploads (or failures while preparing them) do not stop the other uploads
+    streaming: no temporary zips, each upload thread zips on the fly (n_zip and max_zips are not used)
+    compression, compresslevel: see get_compression_policy and default_compression
+    n_compress: number of threads compressing members of a zip (in each of the n_zip processes), see write_zip
+    hash_cache, part_size: see prepare_upload
+    max_tries, retry_delay: retries per part, see upload_part
+    returns a list of result dicts (see finish_upload), one per container that needed an upload
+    """
+    compression = default_compression(compression, streaming)
+    slots = threading.BoundedSemaphore(max_zips)
+
+    def upload_parts(container, upload, part_queue):
+        """uploads the parts of a container, in the order in which their zips are submitted"""
+        errors = []
+        for zip_file_name, part, zip_future in iter(part_queue.get, None):
+            zip_file = None
+            try:
+                if not streaming:
+                    with trace(fw, "wait_for_zip"):
+                        zip_file = zip_future.result()
+                with trace(fw, "upload_part"):
+                    upload_part(upload, zip_file_name, part, root_dir, zip_file=zip_file, streaming=streaming,
+                                compression=compression, compresslevel=compresslevel, n_compress=n_compress,
+                                max_tries=max_tries, retry_delay=retry_delay)
+            except Exception as e:
+                errors.append(f"{zip_file_name}: {e}")
+            finally:
+                if zip_file and Path(zip_file).exists():
+                    Path(zip_file).unlink()
+                if not streaming:
+                    slots.release()
+        return finish_upload(fw, container, upload, errors)
+
+    with TemporaryDirectory() as tmp_dir, ProcessPoolExecutor(max_workers=n_zip) as zip_pool, \
+            ThreadPoolExecutor(max_workers=n_upload) as upload_pool:
+        futures, failed = [], []
+        for container, files in containers_files:
+            if not files:
+                continue
+            try:
+                with trace(fw, "prepare_upload"):
+                    upload = prepare_upload(fw, container, files, root_dir, analysis_label, note, hash_cache,
+                                            part_size)
+            except Exception as e:
+                failed.append(prepare_failed(container, e))
+                continue
+            if not upload:
+                continue
+            print(f"{container.label}: zip and upload {sum(len(p) for _, p in upload['parts'])} files")
+            part_queue = queue.Queue()
+            futures.append(upload_pool.submit(upload_parts, container, upload, part_queue))
+            for zip_file_name, part in upload["parts"]:
+                zip_future = None
+                if not streaming:
+                    # blocks if max_zips zips are on disk, until an upload is done
+                    slots.acquire()
+                    zip_future = zip_pool.submit(zip_files, part, zip_file_name, tmp_dir, root_dir, compression,
+                                                 compresslevel, n_compress)
+                part_queue.put((zip_file_name, part, zip_future))
+            part_queue.put(None)
+        results = failed + [f.result() for f in futures]
+    return results
+
+
 def upload_analysis(group_id, project_label, root_dir, api_key=None, level="subject", subjects=[],
-                    search_strings_template=["{subject}*"], note="", check_ignored_files=True):
+                    search_strings_template=["{subject}*"], note="", check_ignored_files=True, pipelined=False,
+                    n_zip=2, n_upload=4, max_zips=4, streaming=False, compression=None,
+                    compresslevel=None, n_compress=1, incremental=False, hash_cache_file=DEFAULT_HASH_CACHE,
+                    part_size=2 * 1024 ** 3, max_tries=5, retry_delay=10, save_dir="~/fw_jobs",
+                    retry_results_file=None, stats=None, context=None):
     """
     :param group_id:
     :param project_label:
@@ -118,44 +901,91 @@ def upload_analysis(group_id, project_label, root_dir, api_key=None, level="subj
     :param api_key:
     :param level:
     :param subjects:
+    :param pipelined: if True, subject data is zipped and uploaded in parallel (see zip_and_upload_pipelined)
+    :param n_zip: number of zip processes (pipelined)
+    :param n_upload: number of upload threads (pipelined)
+    :param max_zips: max. number of temporary zips on disk (pipelined)
+    :param streaming: zip on the fly into the upload, without temporary zips on disk
+    :param compression: compression policy, list of (glob, compress_type, compresslevel), first match wins
+        (default: DEFAULT_COMPRESSION_POLICY, ZIP_STORED when streaming, as compressed members are compressed twice
+        when streaming, see upload_zip_stream). a ZIP_* constant is used for all members that are not already
+        compressed (.nii.gz, .mgz,...)
+    :param compresslevel: compresslevel if compression is a ZIP_* constant
+    :param n_compress: number of threads compressing members of a zip
+    :param incremental: if True, containers with an existing analysis are not skipped; only files that are new or
+        changed (by sha256) compared to the uploaded files are uploaded (see prepare_upload)
+    :param hash_cache_file: local cache of file hashes (incremental)
+    :param part_size: data of a container is uploaded in zips of at most part_size bytes (uncompressed). parts of
+        incomplete analyses that are missing are uploaded on the next run
+    :param max_tries: tries per part, with exponential backoff starting at retry_delay seconds
+    :param retry_delay:
+    :param save_dir: one line per uploaded container is saved in {save_dir}/{timestamp}__upload_{analysis_label}.tsv
+        (container_id, container_label, status, analysis_id, error). failed uploads do not stop the other containers
+    :param retry_results_file: results file of an earlier upload_analysis call. If given, only the containers whose
+        upload failed are uploaded again
+    :param stats:
+    :param context:
     :return:
     """
     assert level in ["subject", "project"], f'level needs to be "subject" or "project", not {level}'
 
-    api_key = get_fw_api(api_key)
-    fw = flywheel.Client(api_key)
+    fw = get_client(api_key, stats, context, n_upload)
     project = fw.lookup(f"{group_id}/{project_label}")
 
     root_dir = Path(root_dir)
-    os.chdir(root_dir)
     analysis_label = root_dir.name
+    file_index = get_file_index(root_dir)
+    hash_cache = open_hash_cache(hash_cache_file) if incremental else None
 
-    files_uploaded = []
     if level == "subject":
         containers = get_subject_containers(project, subjects)
-        print(f"Uploading {root_dir} into {project_label} for {len(containers)} subject.")
-        cont()
-
-        for container in containers:
-            subject = container.label
-            print(subject)
-            search_strings = [s.format(subject=subject) for s in search_strings_template]
-            files_uploaded += zip_and_upload_data(fw, container, root_dir, analysis_label,
-                                                  search_strings=search_strings, note=note)
     elif level == "project":
-        container = project
-        search_strings = search_strings_template
-        print(f"Uploading {root_dir} into {project_label} for group data.")
-        cont()
+        containers = [project]
 
-        files_uploaded += zip_and_upload_data(fw, container, root_dir, analysis_label,
-                                              search_strings=search_strings, note=note)
+    if retry_results_file:
+        failed_ids = load_failed_container_ids(retry_results_file)
+        containers = [c for c in containers if c.id in failed_ids]
+        print(f"Retrying {len(containers)} failed uploads from {retry_results_file}")
+
+    print(f"Uploading {root_dir} into {project_label} for {len(containers)} {level}.")
+    cont()
+
+    containers_files = []
+    for container in containers:
+        search_strings = search_strings_template
+        if level == "subject":
+            search_strings = [s.format(subject=container.label) for s in search_strings_template]
+        containers_files.append((container, list_files(root_dir, search_strings, file_index)))
+    files_uploaded = [f for _, files in containers_files for f in files]
+    upload_kwargs = dict(note=note, streaming=streaming, compression=compression, compresslevel=compresslevel,
+                         n_compress=n_compress, hash_cache=hash_cache, part_size=part_size, max_tries=max_tries,
+                         retry_delay=retry_delay)
+    if pipelined:
+        results = zip_and_upload_pipelined(fw, containers_files, root_dir, analysis_label, n_zip=n_zip,
+                                           n_upload=n_upload, max_zips=max_zips, **upload_kwargs)
+    else:
+        results = []
+        for container, files in containers_files:
+            print(container.label)
+            if files:
+                results.append(upload_container(fw, container, files, root_dir, analysis_label, **upload_kwargs))
+        results = [r for r in results if r]
 
     print("Upload done")
 
+    if results:
+        save_dir = Path(save_dir).expanduser()
+        save_dir.mkdir(parents=True, exist_ok=True)
+        results_file = save_dir / f'{datetime.now().strftime("%Y-%m-%d_%H%M%S")}__upload_{analysis_label}.tsv'
+        save_results(results, results_file)
+        n_failed = sum(r["status"] == "failed" for r in results)
+        print(f"{len(results) - n_failed} containers uploaded, {n_failed} failed. Results saved to {results_file}")
+        if n_failed:
+            warn(f"{n_failed} uploads failed. Retry them with retry_results_file='{results_file}'")
+
     # check for files that have not been uploaded
     if check_ignored_files:
-        all_files = set(list_files(root_dir, ["*"]))
+        all_files = set(list_files(root_dir, ["*"], file_index))
         files_not_uploaded = all_files - set(files_uploaded)
         if files_not_uploaded:
             files_not_uploaded_ = [str(f) for f in files_not_uploaded]
@@ -158,6 +158,45 @@ def compare_info_dicts(current_info, new_info):
     return changes, new
 
 
+def diff_info_frames(current_df, new_df):
+    """
+    DataFrame version of compare_info_dicts for many rows at once
+    columns are flat keys, rows are aligned on the index (e.g., one row per subject/session)
+    NaN cells count as missing keys (fill them with "" before, if empty entries should be uploaded)
+    strings are compared as strings, numbers by value
+    Returns boolean DataFrames shaped like new_df (changes, new)
+
+    >>> c = pd.DataFrame({"a": [1, 1], "b": [2, np.nan]})
+    >>> n = pd.DataFrame({"b": [3, 2], "c": [5, np.nan]})
+    >>> changes, new = diff_info_frames(c, n)
+    >>> changes
+           b      c
+    0   True  False
+    1  False  False
+    >>> new
+           b      c
+    0  False   True
+    1   True  False
+
+    >>> c = pd.DataFrame({"a": [1, 1, 1], "b": [2, "a", ""]})
+    >>> n = pd.DataFrame({"b": [2.0, "a", ""], "c": [2, 2, 2]})
+    >>> changes, new = diff_info_frames(c, n)
+    >>> changes.b.tolist(), new.c.tolist()
+    ([False, False, False], [True, True, True])
+
+    >>> c = pd.DataFrame({"b": ["a", "1"]})
+    >>> n = pd.DataFrame({"b": ["x", 1]})
+    >>> diff_info_frames(c, n)[0].b.tolist()
+    [True, True]
+    """
+    current_df = current_df.reindex(index=new_df.index, columns=new_df.columns)
+    new_present = new_df.notna()
+    current_present = current_df.notna()
+    new = new_present & ~current_present
+    changes = new_present & current_present & new_df.ne(current_df)
+    return changes, new
+
+
 def load_tabular_file(filename, subject_col, session_col):
     f = Path(filename)
     ext = f.suffix
@@ -171,9 +210,37 @@ def load_tabular_file(filename, subject_col, session_col):
     else:
         raise Exception("Cannot infer filetype {}".format(f))
 
+    return check_tabular_columns(df, f, subject_col, session_col)
+
+
+def iter_tabular_file(filename, subject_col, session_col, chunksize=10000, dtype=None):
+    """
+    like load_tabular_file, but yields the table in DataFrames of chunksize rows
+    .csv and .tsv files are read chunk by chunk, .xlsx files cannot be streamed and are split after reading
+    dtype: dtype hints for pandas (e.g., {"cog.ps": float}), subject and session columns are always read as str
+    """
+    f = Path(filename)
+    ext = f.suffix
+    dtype = {**(dtype or {}), subject_col: str, session_col: str}
+
+    if ext == ".xlsx":
+        df = pd.read_excel(f, dtype=dtype)
+        chunks = (df.iloc[i:i + chunksize] for i in range(0, len(df), chunksize))
+    elif ext == ".csv":
+        chunks = pd.read_csv(f, dtype=dtype, chunksize=chunksize)
+    elif ext == ".tsv":
+        chunks = pd.read_csv(f, sep="\t", dtype=dtype, chunksize=chunksize)
+    else:
+        raise Exception("Cannot infer filetype {}".format(f))
+
+    for df in chunks:
+        yield check_tabular_columns(df, f, subject_col, session_col)
+
+
+def check_tabular_columns(df, f, subject_col, session_col):
     if subject_col not in df.columns:
         raise Exception(
-            "A '{subject_col}' column is required in the tabular data, but cannot be found in {}".format(f))
+            "A '{}' column is required in the tabular data, but cannot be found in {}".format(subject_col, f))
 
     if session_col not in df.columns:
         df[session_col] = ""
@@ -192,6 +259,27 @@ def clean_nan(d, clean_val=""):
     return d
 
 
+def compact_frame(df, max_density=0.5):
+    """
+    reduces the memory footprint of wide, mostly empty tables
+    numeric columns with less than max_density non-missing values become sparse,
+    other columns with at most one distinct value per two rows become categorical
+
+    >>> df = pd.DataFrame({"a": [1., np.nan, np.nan, np.nan], "b": ["x", "y", "x", "x"], "c": [1, 2, 3, 4]})
+    >>> compact_frame(df).dtypes.astype(str).tolist()
+    ['Sparse[float64, nan]', 'category', 'int64']
+    """
+    dtypes = {}
+    for c in df.columns:
+        col = df[c]
+        if pd.api.types.is_numeric_dtype(col):
+            if col.notna().mean() < max_density:
+                dtypes[c] = pd.SparseDtype(col.dtype, np.nan)
+        elif col.nunique() <= len(col) / 2:
+            dtypes[c] = "category"
+    return df.astype(dtypes)
+
+
 def join_wide_files(input_files, missing_input_files, out_file, missings_out_file):
     """
     concatenates wide lhab tables and rename columns to {domain}.{subdomain}.{colName}
@@ -3,7 +3,7 @@
 import argparse
 from pathlib import Path
 from dynagefw.utils import join_wide_files
-from dynagefw.fw_utils import upload_tabular_file_wrapper
+from dynagefw.fw_utils import upload_tabular_file_wrapper, FlywheelContext, InfoBuffer
 from tempfile import TemporaryDirectory
 
 if __name__ == "__main__":
@@ -29,11 +29,18 @@ if __name__ == "__main__":
 
     join_wide_files(input_files, missing_input_files, out_file, missings_out_file)
 
+    # one client for both uploads, values of both files are uploaded with one request per container
+    context = FlywheelContext(args.api_key)
+    buffer = InfoBuffer()
+
     # upload data
-    upload_tabular_file_wrapper(out_file, project_label=args.project_label, group_id=args.group_id)
+    upload_tabular_file_wrapper(out_file, project_label=args.project_label, group_id=args.group_id, context=context,
+                                buffer=buffer)
 
     # upload missings info
-    upload_tabular_file_wrapper(missings_out_file, project_label=args.project_label, group_id=args.group_id)
+    upload_tabular_file_wrapper(missings_out_file, project_label=args.project_label, group_id=args.group_id,
+                                context=context, buffer=buffer)
+    buffer.flush(context)
 
     tmp_dir.cleanup()
     print(f"{tmp_dir.name} removed")
@@ -1,11 +1,33 @@
 from dynagefw.gears import cancle_jobs
+from dynagefw.job_ledger import DEFAULT_LEDGER
 import argparse
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='cancel all jobs')
+    parser = argparse.ArgumentParser(description='cancel pending and running jobs (all jobs, if no scope is given)')
 
+    parser.add_argument('--gear', dest='gear_name', action='store', required=False,
+                        help='Only cancel jobs of this gear')
+    parser.add_argument('--group', dest='group_id', action='store', required=False,
+                        help='Group ID of the project (see --project)')
+    parser.add_argument('--project', dest='project_label', action='store', required=False,
+                        help='Only cancel jobs of this project (requires --group)')
+    parser.add_argument('--label', dest='analysis_label', action='store', required=False,
+                        help='Only cancel jobs of analyses with this label in the job ledger')
+    parser.add_argument('--from-ledger', dest='from_ledger', action='store_true', required=False,
+                        help='Only cancel jobs in the job ledger')
+    parser.add_argument('--ledger', dest='ledger_file', action='store', default=DEFAULT_LEDGER,
+                        help=f'Job ledger file. Default={DEFAULT_LEDGER}')
+    parser.add_argument('--no-pending', dest='pending', action='store_false', help='Do not cancel pending jobs')
+    parser.add_argument('--no-running', dest='running', action='store_false', help='Do not cancel running jobs')
+    parser.add_argument('--n-jobs', dest='n_jobs', action='store', type=int, default=8,
+                        help='Number of parallel cancellations. Default=8')
     parser.add_argument('--api-key', dest='api_key', action='store', required=False,
                         help='API key. If not passed, looks for env var "FWAPI"')
     args = parser.parse_args()
 
-    cancle_jobs(api_key=args.api_key)
+    if args.project_label and not args.group_id:
+        parser.error("--project requires --group")
+
+    cancle_jobs(pending=args.pending, running=args.running, api_key=args.api_key, gear_name=args.gear_name,
+                group_id=args.group_id, project_label=args.project_label, analysis_label=args.analysis_label,
+                from_ledger=args.from_ledger, ledger_file=args.ledger_file, n_jobs=args.n_jobs)
@@ -1,12 +1,31 @@
 from dynagefw.gears import check_jobs
+from dynagefw.job_ledger import DEFAULT_LEDGER
 import argparse
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='checks jobs in analysis')
 
-    parser.add_argument('analysis_id_file', help='pickle file')
+    parser.add_argument('analysis_id_file', nargs='?', default=None,
+                        help='pickle file (from older versions of run_gear). If not passed, jobs are selected from '
+                             'the job ledger')
+    parser.add_argument('--ledger', dest='ledger_file', action='store', default=DEFAULT_LEDGER,
+                        help=f'Job ledger file. Default={DEFAULT_LEDGER}')
+    parser.add_argument('--label', dest='analysis_label', action='store', required=False,
+                        help='Only check jobs with this analysis label')
+    parser.add_argument('--gear', dest='gear_name', action='store', required=False,
+                        help='Only check jobs of this gear')
+    parser.add_argument('--state', dest='state', action='store', nargs='+', required=False,
+                        help='Only check jobs with this last known state(s)')
+    parser.add_argument('--subject', dest='subject_label', action='store', required=False,
+                        help='Only check jobs of this subject')
+    parser.add_argument('--watch', dest='watch', action='store_true', required=False,
+                        help='Poll job states until all jobs are done')
+    parser.add_argument('--interval', dest='interval', action='store', type=int, default=60,
+                        help='Seconds between polls in watch mode. Default=60')
     parser.add_argument('--api-key', dest='api_key', action='store', required=False,
                         help='API key. If not passed, looks for env var "FWAPI"')
     args = parser.parse_args()
 
-    check_jobs(args.analysis_id_file, api_key=args.api_key)
+    check_jobs(args.analysis_id_file, api_key=args.api_key, watch=args.watch, interval=args.interval,
+               ledger_file=args.ledger_file, analysis_label=args.analysis_label, gear_name=args.gear_name,
+               state=args.state, subject_label=args.subject_label)
@@ -1,13 +1,23 @@
 import argparse
 from dynagefw.gears import delete_canceled_analysis
+from dynagefw.job_ledger import DEFAULT_LEDGER
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Removes analysis that have been canceled or have failed')
 
     parser.add_argument('group_id', help='Group ID on Flywheel instance.')
     parser.add_argument('project_label', action='store', help='Project Label on Flywheel instance')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', required=False,
+                        help='Only print what would be deleted')
+    parser.add_argument('--n-jobs', dest='n_jobs', action='store', type=int, default=8,
+                        help='Number of parallel deletions. Default=8')
+    parser.add_argument('--from-ledger', dest='from_ledger', action='store_true', required=False,
+                        help='Only analyses of the project in the job ledger')
+    parser.add_argument('--ledger', dest='ledger_file', action='store', default=DEFAULT_LEDGER,
+                        help=f'Job ledger file. Default={DEFAULT_LEDGER}')
     parser.add_argument('--api-key', dest='api_key', action='store', required=False,
                         help='API key. If not passed, looks for env var "FWAPI"')
     args = parser.parse_args()
 
-    delete_canceled_analysis(args.group_id, args.project_label, api_key=args.api_key)
+    delete_canceled_analysis(args.group_id, args.project_label, api_key=args.api_key, dry_run=args.dry_run,
+                             n_jobs=args.n_jobs, from_ledger=args.from_ledger, ledger_file=args.ledger_file)
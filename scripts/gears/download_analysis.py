@@ -1,5 +1,6 @@
 import argparse
 from dynagefw.gears import download_analysis
+from dynagefw.job_ledger import DEFAULT_LEDGER
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Download and unzip gear analysis outputs for an entire project')
@@ -12,9 +13,19 @@ if __name__ == "__main__":
     parser.add_argument('--file-starts-with', dest='file_starts_with', action='store', required=False,
                         help='string for filtering files in output. Only downloads files that startwith string.\
                              Download all files if empty')
+    parser.add_argument('--member-filter', dest='member_filter', action='store', nargs='+', required=False,
+                        help='glob patterns for files to extract from the zips (e.g., "*/stats/*"). \
+                             Extract all files if empty')
+    parser.add_argument('--n-jobs', dest='n_jobs', action='store', type=int, default=4,
+                        help='Number of parallel downloads. Default=4')
+    parser.add_argument('--from-ledger', dest='from_ledger', action='store_true', required=False,
+                        help='Only analyses of the project in the job ledger')
+    parser.add_argument('--ledger', dest='ledger_file', action='store', default=DEFAULT_LEDGER,
+                        help=f'Job ledger file. Default={DEFAULT_LEDGER}')
     parser.add_argument('--api-key', dest='api_key', action='store', required=False,
                         help='API key. If not passed, looks for env var "FWAPI"')
     args = parser.parse_args()
 
     download_analysis(args.group_id, args.project_label, args.analysis_label, args.save_dir, args.file_starts_with,
-                      api_key=args.api_key)
+                      api_key=args.api_key, n_jobs=args.n_jobs, member_filter=args.member_filter,
+                      from_ledger=args.from_ledger, ledger_file=args.ledger_file)
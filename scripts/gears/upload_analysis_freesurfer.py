@@ -1,4 +1,5 @@
 from dynagefw.upload_analysis import upload_analysis
+from dynagefw.fw_utils import FlywheelContext
 import os
 
 group_id = "lhab"
@@ -11,10 +12,12 @@ freesurfer bids-app v6.0.1-5 (https://github.com/bids-apps/freesurfer)
 run on the science cloud with bidswrapps
 """
 
+context = FlywheelContext()
+
 search_strings = ["00_group*"]
 upload_analysis(group_id, project_label, root_dir, level="project", note=note, search_strings_template=search_strings,
-                check_ignored_files=False)
+                check_ignored_files=False, context=context)
 
 search_strings = ["{subject}*"]
 upload_analysis(group_id, project_label, root_dir, level="subject", note=note,
-                search_strings_template=search_strings, check_ignored_files=True)
+                search_strings_template=search_strings, check_ignored_files=True, pipelined=True, context=context)
@@ -41,6 +41,16 @@ if __name__ == '__main__':
                         default='session_id', help='name of the session '
                                                    'column in the tabular '
                                                    'file')
+    parser.add_argument('--prefetch', dest='prefetch', action='store_true',
+                        required=False, help='Fetch all sessions of the project once before uploading and only '
+                                             'contact the db for sessions with new or changed values. '
+                                             'Default=False')
+    parser.add_argument('-j', '--n-jobs', dest='n_jobs', action='store', type=int,
+                        default=1, help='Number of parallel upload threads. With more than one thread, failing rows '
+                                        'do not stop the upload but are reported at the end. Default=1')
+    parser.add_argument('--chunksize', dest='chunksize', action='store', type=int,
+                        default=None, help='Read and upload the file in chunks of this many rows, '
+                                           'so that large files do not have to be held in memory. Default=None')
     args = parser.parse_args()
 
     upload_tabular_file_wrapper(args.filename, args.project_label,
@@ -51,5 +61,8 @@ if __name__ == '__main__':
                                 update_values=args.update_values,
                                 create_emtpy_entry=args.create_emtpy_entry,
                                 subject_col=args.subject_col,
-                                session_col=args.session_col
+                                session_col=args.session_col,
+                                prefetch=args.prefetch,
+                                n_jobs=args.n_jobs,
+                                chunksize=args.chunksize
                                 )
@@ -0,0 +1,56 @@
+from io import BytesIO
+from zipfile import ZipFile
+
+import pytest
+
+from dynagefw.gears import download_analysis
+from dynagefw.upload_analysis import upload_analysis
+from tests.benchmarks.conftest import GROUP_ID, PROJECT_LABEL, run
+
+pytest.importorskip("pytest_benchmark")
+
+ANALYSIS_LABEL = "freesurfer"
+MEMBERS = ["stats/aseg.stats", "stats/lh.aparc.stats", "scripts/recon-all.log"]
+
+
+def subject_labels(n_subjects):
+    return [f"sub-s{i:05d}" for i in range(n_subjects)]
+
+
+def setup_subjects(fake_client, n_subjects):
+    fw = fake_client()
+    for subject in subject_labels(n_subjects):
+        fw.add_fake_subject(fw.project_id, subject)
+    return fw
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_upload_analysis(benchmark, fake_client, tmp_path, n_containers, pipelined):
+    root_dir = tmp_path / ANALYSIS_LABEL
+    for subject in subject_labels(n_containers):
+        for member in MEMBERS:
+            (root_dir / subject / member).parent.mkdir(parents=True, exist_ok=True)
+            (root_dir / subject / member).write_text(f"{subject} {member}\n" * 100)
+
+    def upload(fw):
+        upload_analysis(GROUP_ID, PROJECT_LABEL, root_dir, pipelined=pipelined, save_dir=tmp_path / "jobs")
+
+    fw = run(benchmark, lambda: (setup_subjects(fake_client, n_containers), ()), upload)
+    assert len(fw.analyses) == n_containers
+
+
+def test_download_analysis(benchmark, fake_client, tmp_path, n_containers):
+    def setup():
+        fw = setup_subjects(fake_client, n_containers)
+        for subject_id, subject in fw.subjects.items():
+            zip_file = BytesIO()
+            with ZipFile(zip_file, "w") as z:
+                for member in MEMBERS:
+                    z.writestr(f"{subject_id}/{subject['label']}/{member}", f"{subject['label']} {member}\n" * 100)
+            analysis_id = fw.add_fake_analysis("subject", subject_id, ANALYSIS_LABEL)
+            fw.add_fake_file(analysis_id, f"{ANALYSIS_LABEL}_{subject['label']}.zip", zip_file.getvalue())
+        return fw, ()
+
+    save_dir = tmp_path / "download"
+    run(benchmark, setup, lambda fw: download_analysis(GROUP_ID, PROJECT_LABEL, ANALYSIS_LABEL, save_dir))
+    assert len(list((save_dir / ANALYSIS_LABEL).glob("sub-*/stats/*"))) == 2 * n_containers
@@ -0,0 +1,32 @@
+import pytest
+
+from dynagefw.gears import run_gear, check_jobs
+from tests.benchmarks.conftest import GROUP_ID, PROJECT_LABEL, run
+
+pytest.importorskip("pytest_benchmark")
+
+
+def setup_project(fake_client, n_subjects):
+    fw = fake_client()
+    fw.add_fake_gear("freesurfer", "6.0.1-5", {"n_cpus": 1})
+    for i in range(n_subjects):
+        fw.add_fake_session(fw.project_id, f"sub-s{i:05d}", "ses-tp1")
+    return fw
+
+
+@pytest.mark.parametrize("n_jobs", [1, 4])
+def test_run_gear(benchmark, fake_client, tmp_path, n_containers, n_jobs):
+    def submit(fw):
+        run_gear(GROUP_ID, PROJECT_LABEL, "freesurfer", save_dir=tmp_path, n_jobs=n_jobs,
+                 ledger_file=tmp_path / "jobs.sqlite")
+
+    fw = run(benchmark, lambda: (setup_project(fake_client, n_containers), ()), submit)
+    assert len(fw.all_jobs) == n_containers
+
+
+def test_check_jobs(benchmark, fake_client, tmp_path, n_containers):
+    fw = setup_project(fake_client, n_containers)
+    ledger_file = tmp_path / "jobs.sqlite"
+    run_gear(GROUP_ID, PROJECT_LABEL, "freesurfer", save_dir=tmp_path, ledger_file=ledger_file)
+
+    run(benchmark, lambda: (fw, ()), lambda fw: check_jobs(ledger_file=ledger_file))
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dynagefw.fw_utils import upload_tabular_file_wrapper, download_tabular_file_wrapper, InfoBuffer
+from tests.benchmarks.conftest import GROUP_ID, PROJECT_LABEL, run
+
+pytest.importorskip("pytest_benchmark")
+
+N_COLUMNS = 20
+
+
+def make_table(n_sessions, seed=0):
+    """two sessions per subject, N_COLUMNS numeric columns in two domains"""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.normal(size=(n_sessions, N_COLUMNS)).round(3),
+                      columns=[f"{d}.v{i}" for d in ["cognition", "health"] for i in range(N_COLUMNS // 2)])
+    df.insert(0, "subject_id", [f"s{i // 2:05d}" for i in range(n_sessions)])
+    df.insert(1, "session_id", [f"tp{i % 2 + 1}" for i in range(n_sessions)])
+    return df
+
+
+@pytest.mark.parametrize("prefetch,n_jobs,buffered", [(True, 1, False), (True, 4, False), (True, 4, True)])
+def test_upload_tabular(benchmark, fake_client, tmp_path, n_containers, prefetch, n_jobs, buffered):
+    filename = tmp_path / "data.tsv"
+    make_table(n_containers).to_csv(filename, sep="\t", index=False)
+
+    def upload(fw):
+        buffer = InfoBuffer() if buffered else None
+        upload_tabular_file_wrapper(filename, PROJECT_LABEL, GROUP_ID, raise_on="missing", prefetch=prefetch,
+                                    n_jobs=n_jobs, buffer=buffer)
+        if buffered:
+            buffer.flush(fw, n_jobs)
+
+    fw = run(benchmark, lambda: (fake_client(), ()), upload)
+    assert len(fw.sessions) == n_containers
+
+
+def test_download_tabular(benchmark, fake_client, tmp_path, n_containers):
+    df = make_table(n_containers)
+    cols = df.columns[2:]
+
+    def setup():
+        fw = fake_client()
+        for _, row in df.iterrows():
+            info = {"cognition": {}, "health": {}}
+            for c in cols:
+                domain, var = c.split(".")
+                info[domain][var] = row[c]
+            info["BIDS"] = {"Label": row.session_id, "Subject": row.subject_id}
+            fw.add_fake_session(fw.project_id, "sub-" + row.subject_id, "ses-" + row.session_id, info=info)
+        return fw, ()
+
+    filename = tmp_path / "out.tsv"
+    run(benchmark, setup, lambda fw: download_tabular_file_wrapper(filename, PROJECT_LABEL, GROUP_ID, None))
+    assert len(pd.read_csv(filename, sep="\t")) == n_containers
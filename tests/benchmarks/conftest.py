@@ -0,0 +1,83 @@
+"""
+Offline benchmarks of the public entry points against FakeFlywheel (needs pytest-benchmark):
+    python -m pytest tests/benchmarks/bench_*.py
+benchmark files are not collected by the normal test run. with the default sizes the suite takes about 1.5 minutes,
+mostly for 10,000 containers (DYNAGEFW_BENCH_SIZES=100,1000 takes a few seconds).
+environment variables:
+    DYNAGEFW_BENCH_SIZES: comma separated number of containers (default 100,1000,10000)
+    DYNAGEFW_BENCH_LATENCY: injected latency per request in seconds (default 0)
+    DYNAGEFW_BENCH_FAILURE_RATE: probability of an injected failure per request (default 0)
+    DYNAGEFW_BENCH_FAIL_ENDPOINTS: comma separated endpoints that fail (default all), e.g. upload_output,run_gear
+     to only hit requests that are retried
+    DYNAGEFW_BENCH_ROUNDS: rounds per benchmark (default 1)
+request counts and transferred bytes per endpoint are saved in the extra_info of each benchmark
+"""
+import os
+
+import flywheel
+import pytest
+
+from tests.fake_fw import FakeFlywheel
+
+SIZES = [int(n) for n in os.environ.get("DYNAGEFW_BENCH_SIZES", "100,1000,10000").split(",")]
+LATENCY = float(os.environ.get("DYNAGEFW_BENCH_LATENCY", 0))
+FAILURE_RATE = float(os.environ.get("DYNAGEFW_BENCH_FAILURE_RATE", 0))
+FAIL_ENDPOINTS = os.environ.get("DYNAGEFW_BENCH_FAIL_ENDPOINTS")
+FAIL_ENDPOINTS = FAIL_ENDPOINTS.split(",") if FAIL_ENDPOINTS else None
+ROUNDS = int(os.environ.get("DYNAGEFW_BENCH_ROUNDS", 1))
+
+GROUP_ID = "lhab"
+PROJECT_LABEL = "LHAB"
+
+
+def pytest_generate_tests(metafunc):
+    if "n_containers" in metafunc.fixturenames:
+        metafunc.parametrize("n_containers", SIZES)
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    """
+    returns new_fake(), which creates a FakeFlywheel with the project GROUP_ID/PROJECT_LABEL and makes it the client
+    that flywheel.Client (and flywheel.Flywheel) return. prompts are answered with "y".
+    latency and failures are only switched on by run(), so that populating the fake is not slowed down
+    """
+    current = {}
+    monkeypatch.setattr(flywheel, "Client", lambda *args, **kwargs: current["fw"])
+    monkeypatch.setattr(flywheel, "Flywheel", lambda *args, **kwargs: current["fw"])
+    monkeypatch.setattr("builtins.input", lambda *args: "y")
+    monkeypatch.setenv("FWAPI", "fake")
+
+    def new_fake():
+        fw = FakeFlywheel()
+        fw.project_id = fw.add_fake_project(GROUP_ID, PROJECT_LABEL)
+        current["fw"] = fw
+        return fw
+
+    return new_fake
+
+
+def run(benchmark, setup, func):
+    """
+    benchmarks func(fw, *args) with the fake from setup() -> (fw, args), called before every round
+    only the requests of func are counted, returns the fake of the last round
+    """
+    state = {}
+
+    def setup_round():
+        fw, args = setup()
+        fw.latency, fw.failure_rate, fw.fail_endpoints = LATENCY, FAILURE_RATE, FAIL_ENDPOINTS
+        for counter in [fw.requests, fw.failures, fw.bytes]:
+            counter.clear()
+        state["fw"] = fw
+        return (fw, *args), {}
+
+    benchmark.pedantic(func, setup=setup_round, rounds=ROUNDS, iterations=1)
+    fw = state["fw"]
+    benchmark.extra_info["latency"] = LATENCY
+    benchmark.extra_info["failure_rate"] = FAILURE_RATE
+    benchmark.extra_info["n_requests"] = fw.n_requests
+    benchmark.extra_info["requests"] = dict(fw.requests)
+    benchmark.extra_info["failures"] = dict(fw.failures)
+    benchmark.extra_info["bytes"] = dict(fw.bytes)
+    return fw
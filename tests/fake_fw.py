@@ -0,0 +1,484 @@
+"""
+In-process stand-in for the parts of flywheel.Client that dynagefw uses.
+Counts requests (and transferred bytes) per endpoint, so tests can check how many round-trips a function needs.
+latency (seconds per request) and failure_rate (probability of an ApiException with status 503, only for
+fail_endpoints if given) can be injected to profile functions offline and to exercise their retries.
+"""
+import random
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from copy import deepcopy
+from datetime import datetime, timezone
+from io import BytesIO
+from itertools import count
+from pathlib import Path
+from zipfile import ZipFile
+
+import pandas as pd
+from flywheel import ApiException
+from flywheel.finder import Finder
+
+
+class FakeContainer(dict):
+    """dict that also allows attribute access, like the sdk models"""
+
+    def __getattr__(self, item):
+        try:
+            return self[item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def to_dict(self):
+        return deepcopy(dict(self))
+
+    @property
+    def age_years(self):
+        if self.get("age"):
+            return self["age"] / (365.25 * 24 * 60 * 60)
+        return self.get("age")
+
+
+def merge_info(info, update):
+    """deep-merges update into info, like the server does for info bodies"""
+    for k, v in update.items():
+        if isinstance(v, dict) and isinstance(info.get(k), dict):
+            merge_info(info[k], v)
+        else:
+            info[k] = deepcopy(v)
+    return info
+
+
+def get_path(d, path):
+    """d["a"]["b"] for path "a.b", None if missing"""
+    for k in path.split("."):
+        if not isinstance(d, dict) or k not in d:
+            return None
+        d = d[k]
+    return d
+
+
+class FakeFlywheel:
+    def __init__(self, latency=0., failure_rate=0., fail_endpoints=None, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.fail_endpoints = fail_endpoints
+        self.requests = Counter()
+        self.failures = Counter()
+        self.bytes = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = count()
+        self.projects = {}
+        self.subjects = {}
+        self.sessions = {}
+        self.analyses = {}
+        self.all_jobs = {}
+        self.gears = {}
+        self.views = {}
+        self.jobs = Finder(self, "get_all_jobs")
+        # client that returned containers call (e.g. subject.sessions()), like ApiClient.set_context of the sdk
+        self._context = self
+        # indices, so that the fake stays fast for projects with many containers
+        self._subject_ids = {}
+        self._subject_sessions = defaultdict(list)
+        self._container_analyses = defaultdict(list)
+
+    @property
+    def n_requests(self):
+        return sum(self.requests.values())
+
+    def _request(self, endpoint, n_bytes=0):
+        with self._lock:
+            self.requests[endpoint] += 1
+            self.bytes[endpoint] += n_bytes
+            fail = bool(self.failure_rate) and (self.fail_endpoints is None or endpoint in self.fail_endpoints) \
+                and self._random.random() < self.failure_rate
+            if fail:
+                self.failures[endpoint] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise ApiException(503, f"Injected failure ({endpoint})")
+
+    def set_context(self, context):
+        self._context = context
+
+    def _new_id(self):
+        with self._lock:
+            return f"{next(self._ids):024x}"
+
+    def _session_output(self, session):
+        s = FakeParent(self._context, "session", deepcopy(session))
+        s["subject"] = FakeContainer(deepcopy(self.subjects[session["subject"]]))
+        return s
+
+    def _analysis_output(self, analysis):
+        a = FakeAnalysis(self._context, deepcopy({k: v for k, v in analysis.items() if k != "files"}))
+        a["parent"] = FakeContainer(a["parent"])
+        a["files"] = [FakeContainer({k: v for k, v in f.items() if k != "data"}) for f in analysis["files"]]
+        return a
+
+    # helpers to populate the fake db without counting requests
+    def add_fake_project(self, group, label):
+        project_id = self._new_id()
+        self.projects[project_id] = {"id": project_id, "group": group, "label": label, "info": {}}
+        return project_id
+
+    def add_fake_subject(self, project_id, code, info=None, sex=None):
+        subject_id = self._new_id()
+        self.subjects[subject_id] = {"id": subject_id, "project": project_id, "code": code, "label": code,
+                                     "info": info or {}, "sex": sex}
+        self._subject_ids[(project_id, code)] = subject_id
+        return subject_id
+
+    def add_fake_session(self, project_id, subject_code, label, info=None, age=None):
+        subject_id = self._subject_ids.get((project_id, subject_code))
+        if subject_id is None:
+            subject_id = self.add_fake_subject(project_id, subject_code)
+        session_id = self._new_id()
+        self.sessions[session_id] = {"id": session_id, "project": project_id, "label": label,
+                                     "subject": subject_id, "info": info or {}, "age": age}
+        self._subject_sessions[subject_id].append(session_id)
+        return session_id
+
+    def add_fake_analysis(self, parent_type, parent_id, label, job_state=None):
+        analysis_id = self._new_id()
+        job_id = None
+        if job_state:
+            job_id = self.add_fake_job(analysis_id, job_state)
+        self.analyses[analysis_id] = {"id": analysis_id, "label": label, "job": job_id,
+                                      "parent": {"type": parent_type, "id": parent_id}, "files": [], "info": {}}
+        self._container_analyses[parent_id].append(analysis_id)
+        return analysis_id
+
+    def add_fake_file(self, analysis_id, name, data):
+        """stores data as output of the analysis (created now), for zips also the members and their sizes"""
+        file = {"name": name, "size": len(data), "data": data, "created": datetime.now(timezone.utc)}
+        if name.endswith(".zip"):
+            with ZipFile(BytesIO(data)) as z:
+                assert z.testzip() is None
+                file["members"] = sorted(z.namelist())
+                file["sizes"] = {i.filename: i.file_size for i in z.infolist()}
+        files = self.analyses[analysis_id]["files"]
+        files[:] = [f for f in files if f["name"] != name] + [file]
+
+    def add_fake_job(self, analysis_id, state, attempt=1, gear_name="gear", project_id=None):
+        job_id = self._new_id()
+        self.all_jobs[job_id] = {"id": job_id, "state": state, "attempt": attempt,
+                                 "destination": {"type": "analysis", "id": analysis_id},
+                                 "gear_info": {"name": gear_name}, "parents": {"project": project_id}}
+        return job_id
+
+    def add_fake_gear(self, name, version="0.1.0", config=None):
+        self.gears[(name, version)] = {"name": name, "version": version, "config": config or {}}
+
+    def _project_of(self, container_type, container_id):
+        if container_type == "project":
+            return container_id
+        if container_type == "subject":
+            return self.subjects[container_id]["project"]
+        return self.sessions[container_id]["project"]
+
+    @staticmethod
+    def _page(items, limit=None, after_id=None):
+        if after_id is not None:
+            items = items[[i.id for i in items].index(after_id) + 1:]
+        if limit is not None:
+            items = items[:limit]
+        return items
+
+    # sdk subset
+    def lookup(self, path):
+        """group/project or gears/name[/version] (latest version if not given)"""
+        self._request("lookup")
+        parts = path.split("/")
+        if parts[0] == "gears":
+            versions = sorted(v for name, v in self.gears if name == parts[1])
+            version = parts[2] if len(parts) > 2 else (versions[-1] if versions else None)
+            if (parts[1], version) in self.gears:
+                return FakeGear(self._context, deepcopy(self.gears[(parts[1], version)]))
+        else:
+            for project in self.projects.values():
+                if [project["group"], project["label"]] == parts:
+                    return FakeParent(self._context, "project", deepcopy(project))
+        raise ApiException(404, f"Not found: {path}")
+
+    def get_all_projects(self):
+        self._request("get_all_projects")
+        return [FakeParent(self._context, "project", deepcopy(p)) for p in self.projects.values()]
+
+    def get_project(self, project_id):
+        self._request("get_project")
+        return FakeParent(self._context, "project", deepcopy(self.projects[project_id]))
+
+    def add_project(self, body):
+        self._request("add_project")
+        return self.add_fake_project(body["group"], body["label"])
+
+    def get_project_subjects(self, project_id, include_all_info=False, limit=None, after_id=None, **kwargs):
+        self._request("get_project_subjects")
+        out = []
+        for subject in self.subjects.values():
+            if subject["project"] == project_id:
+                s = FakeParent(self._context, "subject", deepcopy(subject))
+                if not include_all_info:
+                    s["info"] = {}
+                out.append(s)
+        return self._page(out, limit, after_id)
+
+    def get_project_sessions(self, project_id, include_all_info=False, limit=None, after_id=None, **kwargs):
+        self._request("get_project_sessions")
+        out = []
+        for session in self.sessions.values():
+            if session["project"] == project_id:
+                s = self._session_output(session)
+                if not include_all_info:
+                    s["info"] = {}
+                    s["subject"]["info"] = {}
+                out.append(s)
+        return self._page(out, limit, after_id)
+
+    def get_subject_sessions(self, subject_id, **kwargs):
+        self._request("get_subject_sessions")
+        return [self._session_output(self.sessions[i]) for i in self._subject_sessions[subject_id]]
+
+    def get_session(self, session_id):
+        self._request("get_session")
+        return self._session_output(self.sessions[session_id])
+
+    def add_session(self, body):
+        self._request("add_session")
+        session_id = self.add_fake_session(body["project"], body["subject"]["code"], body["label"],
+                                           info=deepcopy(body.get("info")))
+        return session_id
+
+    def modify_session(self, session_id, body):
+        self._request("modify_session")
+        session = self.sessions[session_id]
+        if "info" in body:
+            merge_info(session["info"], body["info"])
+        if "subject" in body and "info" in body["subject"]:
+            merge_info(self.subjects[session["subject"]]["info"], body["subject"]["info"])
+        for k in body.keys() - {"info", "subject"}:
+            session[k] = deepcopy(body[k])
+
+    def modify_subject(self, subject_id, body):
+        self._request("modify_subject")
+        if "info" in body:
+            merge_info(self.subjects[subject_id]["info"], body["info"])
+
+    def get_analyses(self, container_name, container_id, subcontainer_name, **kwargs):
+        self._request("get_analyses")
+        out = []
+        for analysis in self.analyses.values():
+            parent = analysis["parent"]
+            if parent["type"] + "s" == subcontainer_name and \
+                    self._project_of(parent["type"], parent["id"]) == container_id:
+                out.append(self._analysis_output(analysis))
+        return out
+
+    def get_analysis(self, analysis_id):
+        self._request("get_analysis")
+        if analysis_id not in self.analyses:
+            raise ApiException(404, f"Analysis not found: {analysis_id}")
+        return self._analysis_output(self.analyses[analysis_id])
+
+    def get_analysis_output_zip_info(self, analysis_id, filename):
+        self._request("get_analysis_output_zip_info")
+        file = next(f for f in self.analyses[analysis_id]["files"] if f["name"] == filename)
+        return FakeContainer(members=[FakeContainer(path=p, size=s) for p, s in file["sizes"].items()])
+
+    def get_container_analyses(self, container_id, filter=None):
+        self._request("get_container_analyses")
+        out = [self._analysis_output(self.analyses[i]) for i in self._container_analyses[container_id]
+               if i in self.analyses]
+        if filter:
+            label = filter.split("=", 1)[1].strip('"')
+            out = [a for a in out if a["label"] == label]
+        return out
+
+    def delete_container_analysis(self, container_id, analysis_id):
+        self._request("delete_container_analysis")
+        assert self.analyses[analysis_id]["parent"]["id"] == container_id
+        del self.analyses[analysis_id]
+
+    def _add_analysis(self, container_type, container_id, body):
+        self._request("add_analysis")
+        analysis_id = self.add_fake_analysis(container_type, container_id, body["label"])
+        if "job" in body:  # analysis gear run
+            self.analyses[analysis_id]["job"] = self.add_fake_job(
+                analysis_id, "pending", gear_name=body["job"]["gear_name"],
+                project_id=self._project_of(container_type, container_id))
+        return analysis_id
+
+    def add_project_analysis(self, project_id, body):
+        return self._add_analysis("project", project_id, body)
+
+    def add_subject_analysis(self, subject_id, body):
+        return self._add_analysis("subject", subject_id, body)
+
+    def add_session_analysis(self, session_id, body):
+        return self._add_analysis("session", session_id, body)
+
+    def add_analysis_note(self, analysis_id, note):
+        self._request("add_note")
+
+    def set_analysis_info(self, analysis_id, info):
+        self._request("update_analysis_info")
+        self.analyses[analysis_id]["info"].update(deepcopy(info))
+
+    def upload_output_to_analysis(self, analysis_id, file):
+        if hasattr(file, "contents"):  # FileSpec
+            data = file.contents.read()
+            assert len(data) == file.size, "FileSpec size does not match contents"
+            name = file.name
+        else:
+            name, data = Path(file).name, Path(file).read_bytes()
+        self._request("upload_output", len(data))
+        self.add_fake_file(analysis_id, name, data)
+
+    def download_file_from_analysis(self, analysis_id, file_name, dest_file):
+        file = next(f for f in self.analyses[analysis_id]["files"] if f["name"] == file_name)
+        self._request("download_file", file["size"])
+        Path(dest_file).write_bytes(file["data"])
+
+    def change_job_state(self, job_id, state):
+        self._request("change_job_state")
+        self.all_jobs[job_id]["state"] = state
+
+    def get_all_jobs(self, filter=None, limit=250, after_id=None, **kwargs):
+        """
+        one page of jobs after after_id, for fw.jobs (flywheel.finder.Finder, which requests pages until one is empty)
+        supports filters like 'state=failed' and '_id=|[id1,id2]'
+        """
+        self._request("get_all_jobs")
+
+        def get_field(job, field):
+            for k in field.split("."):
+                job = job[k]
+            return job
+
+        # filter before copying, so that a page only copies the jobs it returns
+        jobs = [j for j in self.all_jobs.values() if after_id is None or j["id"] > after_id]
+        for f in re.split(r",(?![^\[]*\])", filter) if filter else []:
+            if "=|[" in f:
+                field, values = f.split("=|[")
+                values = set(values[:-1].split(","))
+                jobs = [j for j in jobs if get_field(j, field.replace("_id", "id")) in values]
+            else:
+                field, value = f.split("=")
+                jobs = [j for j in jobs if get_field(j, field) == value]
+
+        jobs = [FakeJob(self._context, deepcopy(j)) for j in jobs[:limit]]
+        for job in jobs:
+            for k in ["destination", "gear_info", "parents"]:
+                job[k] = FakeContainer(job[k])
+        return jobs
+
+    # data views
+    @staticmethod
+    def View(label, columns, include_labels=True, **kwargs):
+        return FakeContainer(label=label, columns=columns, include_labels=include_labels)
+
+    def get_views(self, container_id):
+        self._request("get_views")
+        return [FakeContainer(deepcopy(v)) for v in self.views.values() if v["parent"] == container_id]
+
+    def add_view(self, container_id, view):
+        self._request("add_view")
+        view_id = self._new_id()
+        self.views[view_id] = {"id": view_id, "parent": container_id, **deepcopy(dict(view))}
+        return view_id
+
+    def delete_view(self, view_id):
+        self._request("delete_view")
+        del self.views[view_id]
+
+    def read_view_dataframe(self, view, container_id):
+        """one row per session of the project, columns are "src" or (src, alias), e.g. ("session.info.cog", "cog")"""
+        self._request("read_view_dataframe")
+        names = [c[1] if isinstance(c, tuple) else c for c in view["columns"]]
+        rows = []
+        for session in self.sessions.values():
+            if session["project"] != container_id:
+                continue
+            containers = {"session": dict(session, age_years=FakeContainer(session).age_years),
+                          "subject": self.subjects[session["subject"]]}
+            row = []
+            for column in view["columns"]:
+                src = column[0] if isinstance(column, tuple) else column
+                container, path = src.split(".", 1)
+                row.append(deepcopy(get_path(containers[container], path)))
+            rows.append(row)
+        return pd.DataFrame(rows, columns=names)
+
+
+class FakeParent(FakeContainer):
+    """project/subject/session with child listings and add_analysis"""
+
+    def __init__(self, fw, container_type, container):
+        super().__init__(container)
+        self._fw = fw
+        self._type = container_type
+
+    def subjects(self):
+        return self._fw.get_project_subjects(self["id"])
+
+    def sessions(self):
+        return self._fw.get_subject_sessions(self["id"])
+
+    def add_analysis(self, label):
+        analysis_id = getattr(self._fw, f"add_{self._type}_analysis")(self["id"], {"label": label})
+        return self._fw.get_analysis(analysis_id)
+
+    def update(self, *args, **kwargs):
+        """container.update(body) of the sdk, only for sessions"""
+        assert self._type == "session"
+        self._fw.modify_session(self["id"], dict(*args, **kwargs))
+
+
+class FakeAnalysis(FakeContainer):
+    """analysis with upload_output and download_file, uploaded zips are stored with their members"""
+
+    def __init__(self, fw, analysis):
+        super().__init__(analysis)
+        self._fw = fw
+
+    def add_note(self, note):
+        self._fw.add_analysis_note(self["id"], note)
+
+    def update_info(self, info):
+        self._fw.set_analysis_info(self["id"], info)
+
+    def upload_output(self, file):
+        self._fw.upload_output_to_analysis(self["id"], file)
+
+    def download_file(self, file_name, dest_file):
+        self._fw.download_file_from_analysis(self["id"], file_name, dest_file)
+
+
+class FakeGear(FakeContainer):
+    """gear from fw.lookup("gears/..."), run creates an analysis with a pending job"""
+
+    def __init__(self, fw, gear):
+        super().__init__(gear)
+        self._fw = fw
+        self["gear"] = FakeContainer(name=gear["name"], version=gear["version"])
+
+    def get_default_config(self):
+        return deepcopy(self["config"])
+
+    def run(self, analysis_label=None, config=None, inputs=None, destination=None, **kwargs):
+        body = {"label": analysis_label, "job": {"gear_name": self["name"], "config": config, "inputs": inputs}}
+        return getattr(self._fw, f"add_{destination._type}_analysis")(destination.id, body)
+
+
+class FakeJob(FakeContainer):
+    def __init__(self, fw, job):
+        super().__init__(job)
+        self._fw = fw
+
+    def change_state(self, state):
+        self._fw.change_job_state(self["id"], state)
@@ -0,0 +1,106 @@
+"""
+Compares zip compression settings on a synthetic FreeSurfer-like tree: bytes to upload vs. CPU and wall time.
+    python tests/run_bench_zip_compression.py [n_subjects]
+"""
+import gzip
+import os
+import sys
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from zipfile import ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
+
+import numpy as np
+import pandas as pd
+
+from dynagefw.upload_analysis import DEFAULT_COMPRESSION_POLICY, list_files, write_zip
+
+N_VERTICES = 100000
+
+
+class ByteCounter:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, b):
+        self.size += len(b)
+        return len(b)
+
+    def flush(self):
+        pass
+
+
+def make_freesurfer_tree(root_dir, subjects, seed=0):
+    """
+    writes files with names, formats and roughly the compressibility of a FreeSurfer subjects dir
+    (gzipped volumes, binary surfaces and overlays, text stats, labels and logs)
+    """
+    rng = np.random.default_rng(seed)
+    for subject in subjects:
+        sub_dir = Path(root_dir) / subject
+        for d in ["mri", "surf", "label", "stats", "scripts"]:
+            (sub_dir / d).mkdir(parents=True, exist_ok=True)
+
+        for vol in ["T1", "orig", "nu", "norm", "brain", "brainmask", "aseg", "aparc+aseg", "wm"]:
+            data = np.cumsum(rng.integers(-2, 3, size=96 ** 3), dtype=np.int32).astype(np.uint8)
+            (sub_dir / "mri" / f"{vol}.mgz").write_bytes(gzip.compress(data.tobytes(), compresslevel=6))
+
+        for hemi in ["lh", "rh"]:
+            for surf in ["white", "pial", "smoothwm", "inflated", "sphere", "sphere.reg"]:
+                vertices = np.cumsum(rng.normal(0, .1, size=(N_VERTICES, 3)), axis=0).astype(np.float32)
+                faces = np.arange(2 * N_VERTICES * 3, dtype=np.int32) // 3
+                (sub_dir / "surf" / f"{hemi}.{surf}").write_bytes(vertices.tobytes() + faces.tobytes())
+            for overlay in ["thickness", "curv", "area", "sulc", "volume"]:
+                values = rng.gamma(2, 1, size=N_VERTICES).astype(np.float32)
+                (sub_dir / "surf" / f"{hemi}.{overlay}").write_bytes(values.tobytes())
+
+            (sub_dir / "label" / f"{hemi}.aparc.annot").write_bytes(
+                rng.integers(0, 35, size=N_VERTICES, dtype=np.int32).tobytes())
+            for label in ["BA1_exvivo", "BA2_exvivo", "V1_exvivo", "entorhinal_exvivo", "cortex"]:
+                idx = np.sort(rng.choice(N_VERTICES, size=N_VERTICES // 10, replace=False))
+                lines = [f"{i}  {x:.3f}  {y:.3f}  {z:.3f} 0.0000000000" for i, (x, y, z) in
+                         zip(idx, rng.normal(0, 30, size=(len(idx), 3)))]
+                (sub_dir / "label" / f"{hemi}.{label}.label").write_text(
+                    f"#!ascii label , from subject {subject} vox2ras=TkReg\n{len(idx)}\n" + "\n".join(lines))
+
+            rows = [f"{r:<20} {rng.integers(1000, 9999):>6} {rng.integers(1000, 99999):>7} "
+                    f"{rng.normal(2.5, .3):.3f} {rng.normal(.5, .1):.3f}" for r in range(70)]
+            (sub_dir / "stats" / f"{hemi}.aparc.stats").write_text("# Table of FreeSurfer cortical parcellation "
+                                                                   "anatomical statistics\n" + "\n".join(rows))
+        rows = [f"{i:>3} {i:>5} {rng.integers(100, 9999):>9} {rng.normal(80, 10):.1f} Structure-{i}"
+                for i in range(45)]
+        (sub_dir / "stats" / "aseg.stats").write_text("# Title Segmentation Statistics\n" + "\n".join(rows))
+        log = [f"#@# Step {i % 30} {subject} {time.ctime(1e9 + i)}\n  mri_ca_register -nobigventricles -T "
+               f"transforms/talairach.lta -align-after nu.mgz\n  #VMPC# mri_ca_register VmPeak  {i * 7}"
+               for i in range(5000)]
+        (sub_dir / "scripts" / "recon-all.log").write_text("\n".join(log))
+
+
+def run_bench_zip_compression(n_subjects=2):
+    # (name, compression, n_compress)
+    configurations = [("stored", ZIP_STORED, 1),
+                      ("deflate all", ZIP_DEFLATED, 1),
+                      ("bzip2 all", ZIP_BZIP2, 1),
+                      ("lzma all", ZIP_LZMA, 1),
+                      ("default policy", DEFAULT_COMPRESSION_POLICY, 1),
+                      ("default policy, 4 threads", DEFAULT_COMPRESSION_POLICY, 4),
+                      ]
+    with TemporaryDirectory() as root_dir:
+        subjects = [f"sub-{i:03d}" for i in range(n_subjects)]
+        make_freesurfer_tree(root_dir, subjects)
+        files = list_files(root_dir, ["sub-*"])
+        input_size = sum((Path(root_dir) / f).stat().st_size for f in files)
+
+        results = []
+        for name, compression, n_compress in configurations:
+            counter = ByteCounter()
+            cpu, wall = time.process_time(), time.perf_counter()
+            write_zip(counter, files, root_dir, compression, n_compress=n_compress)
+            results.append({"compression": name, "MB": counter.size / 1e6, "ratio": counter.size / input_size,
+                            "cpu_s": time.process_time() - cpu, "wall_s": time.perf_counter() - wall})
+    print(f"{n_subjects} subjects, {len(files)} files, {input_size / 1e6:.1f} MB, {os.cpu_count()} cores")
+    print(pd.DataFrame(results).round(3).to_string(index=False))
+
+
+if __name__ == "__main__":
+    run_bench_zip_compression(*[int(a) for a in sys.argv[1:]])
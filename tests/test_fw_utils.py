@@ -0,0 +1,241 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from flywheel.configuration import Configuration
+from flywheel.rest import RESTClientObject
+
+from dynagefw.fw_bids_utils import handle_project
+from dynagefw.fw_utils import upload_tabular_file, get_info_for_all, create_views, FlywheelContext, get_client, \
+    get_session_index, get_indexed_subject_session, InfoBuffer
+from tests.fake_fw import FakeFlywheel
+
+test_data = Path(__file__).parent / "test_data"
+project_id = "p1"
+
+
+def db_state(fw):
+    sessions = {}
+    for s in fw.sessions.values():
+        subject = fw.subjects[s["subject"]]
+        sessions[(subject["code"], s["label"])] = (s["info"], subject["info"])
+    return sessions
+
+
+def test_upload_tabular_file_prefetch():
+    fw, fw_prefetch = FakeFlywheel(), FakeFlywheel()
+    for f in ["session_data_1.csv", "subject_data.xlsx", "session_data_2.csv"]:
+        upload_tabular_file(fw, test_data / f, project_id, subject_col="subject", session_col="session",
+                            create_emtpy_entry=True)
+        upload_tabular_file(fw_prefetch, test_data / f, project_id, subject_col="subject",
+                            session_col="session", create_emtpy_entry=True, prefetch=True)
+    assert db_state(fw) == db_state(fw_prefetch)
+    assert fw_prefetch.n_requests < fw.n_requests
+
+    # nothing changed, only the two listings are needed
+    n_requests = fw_prefetch.n_requests
+    upload_tabular_file(fw_prefetch, test_data / "session_data_1.csv", project_id, subject_col="subject",
+                        session_col="session", create_emtpy_entry=True, prefetch=True)
+    assert fw_prefetch.n_requests - n_requests == 2
+
+
+def test_upload_tabular_file_prefetch_sees_own_writes(tmp_path):
+    fw = FakeFlywheel()
+    filename = tmp_path / "data.csv"
+    filename.write_text("subject,session,a,b\ns1,tp1,1,\ns1,tp1,1,2\n")
+    upload_tabular_file(fw, filename, project_id, subject_col="subject", session_col="session", prefetch=True)
+    assert db_state(fw) == {("sub-s1", "ses-tp1"): ({"BIDS": {"Subject": "s1", "Label": "tp1", "ignore": False},
+                                                     "a": 1, "b": 2}, {})}
+    assert fw.requests["modify_session"] == 2
+
+    # second row changes a value that was uploaded by the first row
+    filename.write_text("subject,session,a\ns2,tp1,1\ns2,tp1,3\n")
+    with pytest.raises(Exception, match="update_values is False"):
+        upload_tabular_file(fw, filename, project_id, subject_col="subject", session_col="session",
+                            prefetch=True)
+
+
+def test_upload_tabular_file_parallel():
+    fw, fw_parallel = FakeFlywheel(), FakeFlywheel()
+    for f in ["session_data_1.csv", "subject_data.xlsx", "session_data_2.csv"]:
+        upload_tabular_file(fw, test_data / f, project_id, subject_col="subject", session_col="session")
+        upload_tabular_file(fw_parallel, test_data / f, project_id, subject_col="subject",
+                            session_col="session", prefetch=True, n_jobs=4)
+    assert db_state(fw) == db_state(fw_parallel)
+
+
+def test_upload_tabular_file_parallel_reports_failures():
+    fw = FakeFlywheel()
+    upload_tabular_file(fw, test_data / "session_data_1.csv", project_id, subject_col="subject",
+                        session_col="session")
+    # changes value of sub-s2 ses-tp2, all other rows are uploaded
+    with pytest.raises(RuntimeError, match="Upload failed for 1 rows"):
+        upload_tabular_file(fw, test_data / "session_data_3.csv", project_id, subject_col="subject",
+                            session_col="session", n_jobs=2)
+
+
+def test_upload_tabular_file_prefetch_only_changed_rows():
+    fw = FakeFlywheel()
+    upload_tabular_file(fw, test_data / "session_data_1.csv", project_id, subject_col="subject",
+                        session_col="session", create_emtpy_entry=True, prefetch=True)
+    n_modified = fw.requests["modify_session"]
+    # only sub-s2 ses-tp2 differs
+    upload_tabular_file(fw, test_data / "session_data_3.csv", project_id, subject_col="subject",
+                        session_col="session", create_emtpy_entry=True, update_values=True, prefetch=True)
+    assert fw.requests["modify_session"] - n_modified == 1
+    assert fw.sessions[list(fw.sessions)[-1]]["info"]["cog"]["mem"] == 77777
+
+
+def test_get_info_for_all():
+    fw = FakeFlywheel()
+    upload_tabular_file(fw, test_data / "session_data_1.csv", project_id, subject_col="subject",
+                        session_col="session", create_emtpy_entry=True)
+    df_in = pd.read_csv(test_data / "session_data_1.csv").fillna("")
+    df_out = get_info_for_all(fw, project_id, add_age_sex=False)
+    assert df_out.columns.tolist() == ["subject", "session", "BIDS.Label", "BIDS.Subject", "BIDS.ignore",
+                                       "cog.mem", "cog.ps", "status"]
+    df_out = df_out.drop(columns=["BIDS.Label", "BIDS.Subject", "BIDS.ignore"])
+    pd.testing.assert_frame_equal(df_in.sort_index(axis=1), df_out.sort_index(axis=1), check_dtype=False)
+
+    df_compact = get_info_for_all(fw, project_id, compact=True)
+    assert df_compact.columns[:4].tolist() == ["subject", "session", "sex", "age"]
+    assert df_compact["session"].dtype == "category"
+
+
+@pytest.mark.parametrize("n_sessions", [10, 1000, 2500])
+def test_get_info_for_all_request_count(n_sessions):
+    fw = FakeFlywheel()
+    for i in range(n_sessions):
+        fw.add_fake_session(project_id, f"sub-{i // 2}", f"ses-tp{i % 2}", info={"cog": {"ps": i}})
+    df = get_info_for_all(fw, project_id)
+    assert len(df) == n_sessions
+    # one request per 1000 sessions, independent of the number of sessions otherwise
+    assert fw.n_requests == n_sessions // 1000 + 1
+
+
+def test_upload_tabular_file_chunks():
+    fw, fw_chunks = FakeFlywheel(), FakeFlywheel()
+    for f in ["session_data_1.csv", "subject_data.xlsx", "session_data_2.csv"]:
+        upload_tabular_file(fw, test_data / f, project_id, subject_col="subject", session_col="session")
+        upload_tabular_file(fw_chunks, test_data / f, project_id, subject_col="subject", session_col="session",
+                            prefetch=True, chunksize=3)
+    assert db_state(fw) == db_state(fw_chunks)
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_upload_tabular_file_buffer(prefetch):
+    fw, fw_buffer = FakeFlywheel(), FakeFlywheel()
+    buffer = InfoBuffer()
+    for f in ["session_data_1.csv", "subject_data.xlsx", "session_data_2.csv"]:
+        upload_tabular_file(fw, test_data / f, project_id, subject_col="subject", session_col="session",
+                            update_values=True)
+        upload_tabular_file(fw_buffer, test_data / f, project_id, subject_col="subject", session_col="session",
+                            update_values=True, prefetch=prefetch, buffer=buffer)
+    assert fw_buffer.requests["modify_session"] == fw_buffer.requests["modify_subject"] == 0
+
+    n_containers = len(buffer)
+    assert buffer.flush(fw_buffer) == n_containers
+    assert db_state(fw) == db_state(fw_buffer)
+    # one request per modified container
+    assert fw_buffer.requests["modify_session"] + fw_buffer.requests["modify_subject"] == n_containers
+    assert fw_buffer.requests["modify_session"] < fw.requests["modify_session"]
+    assert len(buffer) == 0
+
+
+def test_info_buffer_coalesces_and_keeps_failed(tmp_path):
+    fw = FakeFlywheel()
+    fw.add_fake_session(project_id, "sub-s1", "ses-tp1", info={"a": 1})
+    filename = tmp_path / "data.csv"
+    filename.write_text("subject,session,a,b\ns1,tp1,1,2\ns1,ses-,,3\n")
+    missings = tmp_path / "missings.csv"
+    missings.write_text("subject,session,c\ns1,tp1,4\ns1,ses-,5\n")
+    buffer = InfoBuffer()
+    upload_tabular_file(fw, filename, project_id, subject_col="subject", session_col="session", buffer=buffer)
+    # pending values count as current values
+    filename.write_text("subject,session,b\ns1,tp1,9\n")
+    with pytest.raises(Exception, match="update_values is False"):
+        upload_tabular_file(fw, filename, project_id, subject_col="subject", session_col="session", buffer=buffer,
+                            prefetch=True)
+    upload_tabular_file(fw, missings, project_id, subject_col="subject", session_col="session", buffer=buffer,
+                        prefetch=True)
+    assert len(buffer) == 2
+
+    fw.failure_rate, fw.fail_endpoints = 1, ["modify_subject"]
+    with pytest.raises(RuntimeError, match="Upload failed for 1 containers"):
+        buffer.flush(fw)
+    assert len(buffer) == 1
+    fw.failure_rate = 0
+    assert buffer.flush(fw) == 1
+    assert db_state(fw)[("sub-s1", "ses-tp1")] == ({"a": 1, "b": 2, "c": 4}, {"b": 3, "c": 5})
+    assert fw.requests["modify_session"] == 1 and fw.requests["modify_subject"] == 2
+
+
+def test_upload_subject_rows_list_sessions_once(tmp_path):
+    fw = FakeFlywheel()
+    for i in range(20):
+        fw.add_fake_session(project_id, f"sub-{i}", "ses-tp1")
+    filename = tmp_path / "data.csv"
+    filename.write_text("subject,session,a\n" + "".join(f"{i},ses-,{i}\n" for i in range(20)) +
+                        "new,tp1,1\nnew,ses-,2\n")
+    upload_tabular_file(fw, filename, project_id, subject_col="subject", session_col="session")
+
+    # one listing for all subject rows, one more for the subject that was created during the upload and two for
+    # the session row (upload_bids.handle_session), independent of the number of subject rows
+    assert fw.requests["get_project_sessions"] == 4
+    assert fw.requests["modify_session"] == 22
+    assert {k: v[1] for k, v in db_state(fw).items()}[("sub-new", "ses-tp1")] == {"a": 2}
+    assert fw.subjects[fw._subject_ids[(project_id, "sub-3")]]["info"] == {"a": 3}
+
+
+def test_get_indexed_subject_session():
+    fw = FakeFlywheel()
+    for i in range(5):
+        fw.add_fake_session(project_id, f"sub-{i // 2}", f"ses-tp{i % 2}")
+    session_index = get_session_index(fw, project_id)
+    assert get_indexed_subject_session(session_index, "sub-1")["label"] == "ses-tp0"
+    assert get_indexed_subject_session(session_index, "sub-2")["label"] == "ses-tp0"
+    assert get_indexed_subject_session(session_index, "sub-3") is None
+    assert get_indexed_subject_session(dict(session_index), "sub-1") is session_index[("sub-1", "ses-tp0")]
+
+
+def test_handle_project():
+    fw = FakeFlywheel()
+    fw.add_fake_project("lhab", "LHAB")
+    assert handle_project(fw, "LHAB", "lhab", raise_on="missing")["label"] == "LHAB"
+    with pytest.raises(Exception, match="raise_on='existing'"):
+        handle_project(fw, "LHAB", "lhab", create=True, raise_on="existing")
+    with pytest.raises(Exception, match="not found"):
+        handle_project(fw, "NEW", "lhab", raise_on="missing")
+    assert handle_project(fw, "NEW", "lhab", create=True)["group"] == "lhab"
+    assert len(fw.projects) == 2
+    assert fw.requests["get_all_projects"] == 0
+
+
+def test_flywheel_context_reuses_client_and_lookups():
+    fw = FakeFlywheel()
+    project_id = fw.add_fake_project("lhab", "LHAB")
+    fw.add_fake_session(project_id, "sub-1", "ses-tp1", info={"cognition": {"mem": 1}})
+    context = FlywheelContext(fw=fw)
+
+    create_views("LHAB", "lhab", context=context)
+    create_views("LHAB", "lhab", context=context)
+    assert fw.requests["lookup"] == 1
+    assert sorted(v["label"] for v in fw.views.values()) == sorted(
+        ["all", "cognition", "health", "demographics", "motorskills", "questionnaires", "missing_info"])
+    assert get_client(context=context) is context
+
+
+def test_flywheel_context_pool_size():
+    rest_client = RESTClientObject(Configuration())
+    fw = SimpleNamespace(api_client=SimpleNamespace(rest_client=rest_client))
+    context = FlywheelContext(fw=fw)
+    max_retries = rest_client.session.get_adapter("https://fw").max_retries
+    assert rest_client.session.get_adapter("https://fw").poolmanager.connection_pool_kw["maxsize"] == 10
+
+    get_client(context=context, pool_size=32)
+    adapter = rest_client.session.get_adapter("https://fw")
+    assert adapter.poolmanager.connection_pool_kw["maxsize"] == 32
+    assert adapter.max_retries is max_retries
+    get_client(context=context, pool_size=4)
+    assert context.pool_size == 32
@@ -0,0 +1,324 @@
+import json
+from collections import Counter
+from io import BytesIO
+from types import SimpleNamespace
+from zipfile import ZipFile
+
+import pytest
+
+from dynagefw.fw_utils import FlywheelContext
+from dynagefw.gears import extract_zip, submit_gear_runs, save_results, load_failed_container_ids, \
+    drop_analysed_containers, get_analysis_jobs, find_jobs_to_cancel, cancel_jobs_parallel, cleanup_analyses, \
+    download_analysis, watch_jobs, check_jobs, cancle_jobs, delete_analyses, upload_order, load_manifest, \
+    save_manifest, add_manifest_entry
+from dynagefw import gears
+from dynagefw.job_ledger import open_ledger, add_jobs, get_state_history
+from tests.fake_fw import FakeFlywheel, FakeContainer
+
+
+def make_zip(zip_file, names):
+    with ZipFile(zip_file, "w") as z:
+        for name in names:
+            z.writestr(name, name)
+    return zip_file
+
+
+def test_extract_zip(tmp_path):
+    zip_1 = make_zip(tmp_path / "1.zip", ["5f34/sub-1/stats/aseg.stats", "5f34/sub-1/mri/T1.mgz", "5f34/"])
+    zip_2 = make_zip(tmp_path / "2.zip", ["5f35/sub-1/stats/aseg.stats", "5f35/sub-2/stats/aseg.stats"])
+    out_dir = tmp_path / "out"
+    extracted = {}
+
+    assert extract_zip(zip_1, out_dir, ["*/stats/*"], extracted) == []
+    assert (out_dir / "sub-1/stats/aseg.stats").read_text() == "5f34/sub-1/stats/aseg.stats"
+    assert not (out_dir / "sub-1/mri").exists()
+
+    assert extract_zip(zip_2, out_dir, None, extracted) == [out_dir / "sub-1/stats/aseg.stats"]
+    assert (out_dir / "sub-1/stats/aseg.stats").read_text() == "5f35/sub-1/stats/aseg.stats"
+    assert len(extracted) == 2
+
+    # files extracted before by the same owner (e.g. an older zip of the same analysis) are not reported
+    extracted = {}
+    assert extract_zip(zip_1, out_dir, None, extracted, "a1") == []
+    assert extract_zip(zip_2, out_dir, None, extracted, "a1") == []
+    assert extract_zip(zip_1, out_dir, ["*/stats/*"], extracted, "a2") == [out_dir / "sub-1/stats/aseg.stats"]
+    assert extracted[out_dir / "sub-1/stats/aseg.stats"] == "a2"
+
+
+def test_extract_zip_rejects_parent_paths(tmp_path):
+    zip_file = make_zip(tmp_path / "1.zip", ["5f34/../../x.txt"])
+    with pytest.raises(RuntimeError):
+        extract_zip(zip_file, tmp_path / "out")
+
+
+class FakeGear:
+    def __init__(self, n_fails):
+        self.n_fails = n_fails
+        self.calls = Counter()
+
+    def run(self, analysis_label, config, inputs, destination):
+        self.calls[destination.id] += 1
+        if self.calls[destination.id] <= self.n_fails.get(destination.id, 0):
+            raise RuntimeError("server hiccup")
+        return f"analysis_{destination.id}"
+
+
+def test_submit_gear_runs(tmp_path):
+    containers = [SimpleNamespace(id=f"c{i}", label=f"sub-{i}") for i in range(10)]
+    gear = FakeGear({"c1": 2, "c2": 10})
+    results = submit_gear_runs(gear, "label", {}, containers, n_jobs=4, max_tries=3, retry_delay=0.001)
+
+    assert [r["container_id"] for r in results] == [c.id for c in containers]
+    assert results[1]["status"] == "submitted" and results[1]["analysis_id"] == "analysis_c1"
+    assert results[2]["status"] == "failed" and results[2]["error"] == "server hiccup"
+    assert gear.calls["c2"] == 3
+
+    results_file = tmp_path / "results.tsv"
+    save_results(results, results_file)
+    assert load_failed_container_ids(results_file) == ["c2"]
+
+
+def test_drop_analysed_containers():
+    fw = FakeFlywheel()
+    project = SimpleNamespace(id="p1")
+    subject_ids = [fw.add_fake_subject("p1", f"sub-{i}") for i in range(5)]
+    fw.add_fake_analysis("subject", subject_ids[0], "mriqc", "complete")
+    fw.add_fake_analysis("subject", subject_ids[1], "mriqc", "failed")
+    fw.add_fake_analysis("subject", subject_ids[2], "mriqc", "cancelled")
+    fw.add_fake_analysis("subject", subject_ids[2], "mriqc", "running")
+    fw.add_fake_analysis("subject", subject_ids[3], "other_label", "complete")
+    containers = [SimpleNamespace(id=i) for i in subject_ids]
+
+    remaining, skipped = drop_analysed_containers(fw, project, "subject", "mriqc", containers)
+    assert [c.id for c in remaining] == [subject_ids[1], subject_ids[3], subject_ids[4]]
+    assert skipped == {"complete": 1, "running": 1}
+    # the analyses and one job query (a page and the empty page that ends fw.jobs.iter_find)
+    assert fw.requests["get_all_jobs"] == 2 and fw.n_requests == 3
+
+
+def test_get_analysis_jobs():
+    fw = FakeFlywheel()
+    subject_id = fw.add_fake_subject("p1", "sub-1")
+    analysis_ids = [fw.add_fake_analysis("subject", subject_id, "mriqc", state)
+                    for state in ["complete", "running", "failed"]]
+    retry_job_id = fw.add_fake_job(analysis_ids[2], "pending", attempt=2)
+
+    jobs = get_analysis_jobs(fw, analysis_ids)
+    assert [jobs[a].state for a in analysis_ids] == ["complete", "running", "pending"]
+    assert jobs[analysis_ids[2]].id == retry_job_id
+    assert fw.n_requests == fw.requests["get_all_jobs"] == 2
+
+
+def make_watched_jobs(monkeypatch, states_per_poll):
+    """
+    analyses a0, a1, ... with pending jobs, their job states are set to the next states_per_poll entry
+    ({analysis index: state}) whenever watch_jobs sleeps
+    """
+    fw = FakeFlywheel()
+    subject_id = fw.add_fake_subject("p1", "sub-1")
+    analysis_ids = [fw.add_fake_analysis("subject", subject_id, "mriqc", "pending")
+                    for _ in range(max(i for s in states_per_poll for i in s) + 1)]
+    job_ids = [fw.analyses[a]["job"] for a in analysis_ids]
+    polls = iter(states_per_poll)
+
+    def sleep(seconds):
+        for i, state in next(polls).items():
+            fw.all_jobs[job_ids[i]]["state"] = state
+
+    monkeypatch.setattr(gears.time, "sleep", sleep)
+    return fw, analysis_ids, job_ids
+
+
+def test_watch_jobs(monkeypatch):
+    states_per_poll = [{0: "running"}, {}, {0: "complete", 1: "failed"}]
+    fw, analysis_ids, job_ids = make_watched_jobs(monkeypatch, states_per_poll)
+    states = {job_id: "pending" for job_id in job_ids}
+    changes = []
+    watch_jobs(fw, states, interval=0, on_change=lambda job_id, state: changes.append((job_id, state)))
+
+    assert changes == [(job_ids[0], "running"), (job_ids[0], "complete"), (job_ids[1], "failed")]
+    assert states == {job_ids[0]: "complete", job_ids[1]: "failed"}
+    # one job query per poll, each a page and the empty page that ends fw.jobs.iter_find
+    assert fw.requests["get_all_jobs"] == 3 * 2
+
+
+def test_check_jobs_watch_updates_ledger(tmp_path, monkeypatch):
+    states_per_poll = [{0: "running", 1: "running"}, {0: "complete", 2: "cancelled"}, {1: "complete"}]
+    fw, analysis_ids, job_ids = make_watched_jobs(monkeypatch, states_per_poll)
+    ledger_file = tmp_path / "jobs.sqlite"
+    con = open_ledger(ledger_file)
+    add_jobs(con, [{"analysis_id": a, "analysis_label": "mriqc"} for a in analysis_ids])
+    add_jobs(con, [{"analysis_id": "other", "analysis_label": "fmriprep"}])
+
+    check_jobs(watch=True, interval=0, ledger_file=ledger_file, analysis_label="mriqc",
+               context=FlywheelContext(fw=fw))
+    assert [s for s, _ in get_state_history(con, analysis_ids[0])] == ["submitted", "pending", "running", "complete"]
+    assert [s for s, _ in get_state_history(con, analysis_ids[1])] == ["submitted", "pending", "running", "complete"]
+    assert [s for s, _ in get_state_history(con, analysis_ids[2])] == ["submitted", "pending", "cancelled"]
+    assert [s for s, _ in get_state_history(con, "other")] == ["submitted"]
+    assert {r["job_id"] for r in con.execute("SELECT job_id FROM jobs WHERE analysis_label = 'mriqc'")} == \
+           set(job_ids)
+
+
+def test_cancel_jobs():
+    fw = FakeFlywheel()
+    for state in ["pending", "running", "complete"]:
+        fw.add_fake_job("a", state, gear_name="bids-mriqc", project_id="p1")
+        fw.add_fake_job("b", state, gear_name="bids-fmriprep", project_id="p1")
+        fw.add_fake_job("c", state, gear_name="bids-mriqc", project_id="p2")
+
+    jobs = find_jobs_to_cancel(fw, ["pending", "running"], gear_name="bids-mriqc", project_id="p1")
+    cancelled, failed = cancel_jobs_parallel(jobs, n_jobs=2)
+    assert cancelled == {"pending": 1, "running": 1} and failed == []
+    assert Counter(j["state"] for j in fw.all_jobs.values()) == {"cancelled": 2, "pending": 2, "running": 2,
+                                                                 "complete": 3}
+
+    jobs = find_jobs_to_cancel(fw, ["pending"], analysis_ids=["b"])
+    assert [j.destination.id for j in jobs] == ["b"]
+
+
+def test_cleanup_analyses():
+    fw = FakeFlywheel()
+    project = SimpleNamespace(id="p1")
+    subject_id = fw.add_fake_subject("p1", "sub-1")
+    session_id = fw.add_fake_session("p1", "sub-1", "ses-tp1")
+    fw.add_fake_analysis("subject", subject_id, "mriqc", "complete")
+    fw.add_fake_analysis("subject", subject_id, "mriqc", "failed")
+    fw.add_fake_analysis("session", session_id, "mriqc", "cancelled")
+    fw.add_fake_analysis("session", session_id, "fmriprep", "failed")
+    fw.add_fake_analysis("session", session_id, "upload")
+
+    analyses = cleanup_analyses(fw, project, states=["cancelled", "failed"], dry_run=True)
+    assert len(analyses) == 3 and len(fw.analyses) == 5
+
+    cleanup_analyses(fw, project, analysis_label="mriqc", states=["cancelled", "failed"])
+    assert sorted(a["label"] for a in fw.analyses.values()) == ["fmriprep", "mriqc", "upload"]
+
+    cleanup_analyses(fw, project, analysis_label="upload")
+    assert len(fw.analyses) == 2
+
+
+def test_delete_analyses_from_ledger(tmp_path):
+    fw = FakeFlywheel()
+    project_id = fw.add_fake_project("lhab", "LHAB")
+    subject_id = fw.add_fake_subject(project_id, "sub-1")
+    analysis_ids = [fw.add_fake_analysis("subject", subject_id, "mriqc", "complete") for _ in range(3)]
+    ledger_file = tmp_path / "jobs.sqlite"
+    add_jobs(open_ledger(ledger_file), [{"analysis_id": a, "project_label": "LHAB", "analysis_label": "mriqc"}
+                                        for a in analysis_ids[:2]])
+
+    delete_analyses("lhab", "LHAB", "mriqc", from_ledger=True, ledger_file=ledger_file, context=FlywheelContext(fw=fw))
+    assert list(fw.analyses) == analysis_ids[2:]
+
+
+def make_download_project(n_subjects):
+    """project lhab/LHAB with one fs analysis per subject, with a zip and a log file"""
+    fw = FakeFlywheel()
+    project_id = fw.add_fake_project("lhab", "LHAB")
+    for i in range(n_subjects):
+        subject_id = fw.add_fake_subject(project_id, f"sub-{i}")
+        analysis_id = fw.add_fake_analysis("subject", subject_id, "fs")
+        zip_file = BytesIO()
+        with ZipFile(zip_file, "w") as z:
+            for member in ["stats/aseg.stats", "mri/T1.mgz"]:
+                z.writestr(f"{analysis_id}/sub-{i}/{member}", f"sub-{i} {member}")
+        fw.add_fake_file(analysis_id, f"fs_sub-{i}.zip", zip_file.getvalue())
+        fw.add_fake_file(analysis_id, "job.log", b"log")
+    return fw
+
+
+def test_download_analysis(tmp_path):
+    fw = make_download_project(6)
+    download_analysis("lhab", "LHAB", "fs", tmp_path, n_jobs=4, context=FlywheelContext(fw=fw))
+
+    out_dir = tmp_path / "fs"
+    assert sorted(p.relative_to(out_dir).as_posix() for p in out_dir.rglob("*") if p.is_file()) == \
+           ["00_manifest.json"] + [f"sub-{i}/{m}" for i in range(6) for m in ["mri/T1.mgz", "stats/aseg.stats"]]
+    assert (out_dir / "sub-3/stats/aseg.stats").read_text() == "sub-3 stats/aseg.stats"
+    assert fw.requests["download_file"] == 12
+    manifest = json.loads((out_dir / "00_manifest.json").read_text())
+    assert len(manifest) == 12
+    entries = {k.split("/")[1]: v for k, v in manifest.items() if k.endswith("_sub-0.zip") or k.endswith(".log")}
+    assert sorted(entries["fs_sub-0.zip"]["outputs"]) == ["sub-0/mri/T1.mgz", "sub-0/stats/aseg.stats"]
+    assert entries["job.log"]["outputs"] == {}
+
+    # everything is recorded and unchanged, nothing is downloaded
+    download_analysis("lhab", "LHAB", "fs", tmp_path, n_jobs=4, context=FlywheelContext(fw=fw))
+    assert fw.requests["download_file"] == 12
+
+    # analyses with deleted or modified outputs are downloaded again
+    (out_dir / "sub-1/mri/T1.mgz").unlink()
+    (out_dir / "sub-2/stats/aseg.stats").write_text("corrupted")
+    download_analysis("lhab", "LHAB", "fs", tmp_path, n_jobs=4, context=FlywheelContext(fw=fw))
+    assert fw.requests["download_file"] == 16
+    assert (out_dir / "sub-1/mri/T1.mgz").is_file()
+    assert (out_dir / "sub-2/stats/aseg.stats").read_text() == "sub-2 stats/aseg.stats"
+
+
+def test_cancle_jobs_project_requires_group():
+    fw = FakeFlywheel()
+    with pytest.raises(ValueError, match="group_id"):
+        cancle_jobs(project_label="LHAB", context=FlywheelContext(fw=fw))
+    assert fw.n_requests == 0
+
+
+def test_upload_order():
+    names = ["fs_sub-0_20240102-000000.zip", "fs_sub-0_part002of002.zip", "fs_sub-0_20240101-000000_part001of001.zip",
+             "fs_sub-0_part001of002.zip", "job.log"]
+    files = [FakeContainer(name=n) for n in names]
+    assert [f.name for f in upload_order(files)] == [
+        "fs_sub-0_part001of002.zip", "fs_sub-0_part002of002.zip", "job.log",
+        "fs_sub-0_20240101-000000_part001of001.zip", "fs_sub-0_20240102-000000.zip"]
+    files = [FakeContainer(name=n, created=i) for i, n in enumerate(names)]
+    assert [f.name for f in upload_order(files)] == names
+
+
+def test_manifest_journal(tmp_path):
+    manifest_file = tmp_path / "00_manifest.json"
+    manifest = load_manifest(manifest_file)
+    add_manifest_entry(manifest, "a1/fs.zip", {"size": 1}, manifest_file)
+    save_manifest(manifest, manifest_file)
+    add_manifest_entry(manifest, "a2/fs.zip", {"size": 2}, manifest_file)
+    add_manifest_entry(manifest, "a1/fs.zip", {"size": 3}, manifest_file)
+    assert json.loads(manifest_file.read_text()) == {"a1/fs.zip": {"size": 1}}
+
+    # an interruption while appending leaves a cut off last line
+    with open(tmp_path / "00_manifest.jsonl", "a") as f:
+        f.write('["a3/fs.zip", {"si')
+    assert load_manifest(manifest_file) == {"a1/fs.zip": {"size": 3}, "a2/fs.zip": {"size": 2}}
+    save_manifest(load_manifest(manifest_file), manifest_file)
+    assert not (tmp_path / "00_manifest.jsonl").exists()
+    assert load_manifest(manifest_file) == {"a1/fs.zip": {"size": 3}, "a2/fs.zip": {"size": 2}}
+
+
+def test_download_analysis_resume(tmp_path):
+    fw = make_download_project(6)
+    fw.failure_rate, fw.fail_endpoints = 0.5, ["download_file"]
+    with pytest.warns(UserWarning, match="could not be downloaded"):
+        download_analysis("lhab", "LHAB", "fs", tmp_path, n_jobs=4, context=FlywheelContext(fw=fw))
+    n_failed = fw.failures["download_file"]
+    assert 0 < n_failed < 12
+
+    # the second run only downloads the analyses with failed files
+    fw.failure_rate = 0
+    n_requests = fw.requests["download_file"]
+    manifest = json.loads((tmp_path / "fs/00_manifest.json").read_text())
+    incomplete = {a["id"] for a in fw.analyses.values() for f in a["files"] if f"{a['id']}/{f['name']}" not in manifest}
+    download_analysis("lhab", "LHAB", "fs", tmp_path, n_jobs=4, context=FlywheelContext(fw=fw))
+    assert fw.requests["download_file"] - n_requests == 2 * len(incomplete)
+    assert len(list((tmp_path / "fs").glob("sub-*/stats/aseg.stats"))) == 6
+    assert not (tmp_path / "fs/00_zip").exists()
+
+
+def test_download_analysis_from_ledger(tmp_path):
+    fw = make_download_project(4)
+    ledger_file = tmp_path / "jobs.sqlite"
+    analysis_ids = list(fw.analyses)
+    add_jobs(open_ledger(ledger_file), [{"analysis_id": a, "project_label": "LHAB", "analysis_label": "fs"}
+                                        for a in analysis_ids[1:3] + ["deleted"]])
+
+    download_analysis("lhab", "LHAB", "fs", tmp_path, file_starts_with="fs_", from_ledger=True,
+                      ledger_file=ledger_file, context=FlywheelContext(fw=fw))
+    assert sorted(p.parts[-3] for p in (tmp_path / "fs").glob("sub-*/stats/aseg.stats")) == ["sub-1", "sub-2"]
+    # the analyses are fetched by id, subjects are not listed
+    assert fw.requests["get_analysis"] == 3 and fw.requests["get_project_subjects"] == 0
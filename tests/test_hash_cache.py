@@ -0,0 +1,28 @@
+import os
+
+from dynagefw import hash_cache
+from dynagefw.hash_cache import open_hash_cache, hash_files, file_sha256
+
+
+def test_hash_files(tmp_path, monkeypatch):
+    root_dir = tmp_path / "data"
+    root_dir.mkdir()
+    for f in ["a.txt", "b.txt"]:
+        (root_dir / f).write_text(f)
+    con = open_hash_cache(tmp_path / "cache.sqlite")
+
+    n_hashed = []
+    monkeypatch.setattr(hash_cache, "file_sha256", lambda f: n_hashed.append(f) or file_sha256(f))
+    hashes = hash_files(con, root_dir, ["a.txt", "b.txt"])
+    assert hashes["a.txt"] == (file_sha256(root_dir / "a.txt"), 5)
+    assert len(n_hashed) == 2
+
+    # unchanged files are not rehashed
+    assert hash_files(con, root_dir, ["a.txt", "b.txt"]) == hashes
+    assert len(n_hashed) == 2
+
+    (root_dir / "b.txt").write_text("changed")
+    os.utime(root_dir / "b.txt", ns=(0, 10 ** 9))
+    hashes_new = hash_files(con, root_dir, ["a.txt", "b.txt"])
+    assert len(n_hashed) == 3
+    assert hashes_new["b.txt"] == (file_sha256(root_dir / "b.txt"), 7)
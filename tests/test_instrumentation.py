@@ -0,0 +1,98 @@
+import json
+from types import SimpleNamespace
+
+from dynagefw.fw_utils import upload_tabular_file
+from dynagefw.gears import submit_gear_runs, get_job_states
+from dynagefw.instrumentation import RequestStats, instrument_client, instrument_http, LATENCY_BUCKETS
+from tests.fake_fw import FakeFlywheel
+
+
+def test_instrumented_client_records_requests_and_spans(tmp_path):
+    fw = FakeFlywheel()
+    project_id = fw.add_fake_project("lhab", "LHAB")
+    spans = []
+    stats = RequestStats(on_span=spans.append)
+    fw_instrumented = instrument_client(fw, stats)
+
+    filename = tmp_path / "data.csv"
+    filename.write_text("subject,session,a\ns1,tp1,1\ns1,tp2,2\ns2,tp1,3\n")
+    upload_tabular_file(fw_instrumented, filename, project_id, subject_col="subject", session_col="session",
+                        prefetch=True)
+
+    summary = stats.summary().set_index("name")
+    assert summary.loc["modify_session", "calls"] == fw.requests["modify_session"] == 3
+    assert summary.loc["upload_row", "kind"] == "span" and summary.loc["upload_row", "calls"] == 3
+    assert summary.loc["get_session_index", "calls"] == 1
+    assert len(spans) == summary.calls.sum()
+    assert sum(stats.histogram("modify_session").values()) == 3
+    assert list(stats.histogram("modify_session")) == LATENCY_BUCKETS
+
+    stats.save_json(tmp_path / "stats.json")
+    saved = json.loads((tmp_path / "stats.json").read_text())
+    assert saved["modify_session"]["calls"] == 3 and saved["modify_session"]["kind"] == "sdk"
+
+
+def test_instrumented_client_records_container_methods(tmp_path):
+    fw = FakeFlywheel()
+    fw.add_fake_session(fw.add_fake_project("lhab", "LHAB"), "sub-1", "ses-tp1")
+    stats = RequestStats()
+    fw_instrumented = instrument_client(fw, stats)
+
+    project = fw_instrumented.lookup("lhab/LHAB")
+    subject = project.subjects()[0]
+    assert len(subject.sessions()) == 1
+    analysis = subject.add_analysis("label")
+    (tmp_path / "out.txt").write_text("12345")
+    analysis.upload_output(tmp_path / "out.txt")
+
+    summary = stats.summary().set_index("name")
+    for name in ["lookup", "get_project_subjects", "get_subject_sessions", "add_subject_analysis", "get_analysis",
+                 "upload_output_to_analysis"]:
+        assert summary.loc[name, "calls"] == 1
+    assert summary.loc["upload_output_to_analysis", "bytes"] == 5
+    assert instrument_client(fw_instrumented, stats) is fw_instrumented
+    assert instrument_client(fw, None) is fw
+
+
+def test_instrumented_client_records_finders():
+    fw = FakeFlywheel()
+    job_ids = [fw.add_fake_job(f"a{i}", "running") for i in range(300)]
+    stats = RequestStats()
+    fw_instrumented = instrument_client(fw, stats)
+
+    # two chunks, the first has two pages (the finder requests 250 jobs per page)
+    assert get_job_states(fw_instrumented, job_ids, chunk_size=260) == {j: "running" for j in job_ids}
+    summary = stats.summary().set_index("name")
+    assert summary.loc["get_all_jobs", "calls"] == fw.requests["get_all_jobs"] == 5
+
+
+def test_instrumented_client_counts_retries():
+    fw = FakeFlywheel(failure_rate=0.3, fail_endpoints=["add_analysis"], seed=1)
+    fw.add_fake_gear("gear")
+    project_id = fw.add_fake_project("lhab", "LHAB")
+    for i in range(20):
+        fw.add_fake_subject(project_id, f"sub-{i}")
+    stats = RequestStats()
+    fw_instrumented = instrument_client(fw, stats)
+
+    gear = fw_instrumented.lookup("gears/gear")
+    subjects = fw_instrumented.get_project_subjects(project_id)
+    results = submit_gear_runs(gear, "label", {}, subjects, max_tries=20, retry_delay=0.0001)
+
+    assert all(r["status"] == "submitted" for r in results)
+    row = stats.summary().set_index("name").loc["add_subject_analysis"]
+    assert fw.failures["add_analysis"] > 0
+    assert row.errors == row.retries == fw.failures["add_analysis"]
+    assert row.calls == 20 + row.errors
+
+
+def test_instrument_http():
+    api_client = SimpleNamespace(request=lambda method, url, **kwargs: SimpleNamespace(data=b"abc", status=200))
+    stats = RequestStats()
+    instrument_http(api_client, stats)
+    for project_id in ["5e7c7e6bbd0a3d0028c0e9ad", "5e7c7e6bbd0a3d0028c0e9ae"]:
+        api_client.request("GET", f"https://fw/api/projects/{project_id}/sessions",
+                           headers={"Content-Length": "10"})
+
+    row = stats.summary().iloc[0]
+    assert (row["name"], row.kind, row.calls, row.bytes) == ("GET /api/projects/{id}/sessions", "http", 2, 26)
@@ -0,0 +1,22 @@
+from dynagefw.job_ledger import open_ledger, add_jobs, update_states, select_jobs, get_state_history
+
+
+def test_job_ledger(tmp_path):
+    ledger_file = tmp_path / "jobs.sqlite"
+    con = open_ledger(ledger_file)
+    add_jobs(con, [{"analysis_id": f"a{i}", "subject_label": f"sub-{i % 2}", "analysis_label": "mriqc",
+                    "gear_name": "bids-mriqc"} for i in range(4)])
+    add_jobs(con, [{"analysis_id": "b0", "subject_label": "sub-0", "analysis_label": "fmriprep"}])
+    con.close()
+
+    con = open_ledger(ledger_file)
+    assert len(select_jobs(con)) == 5
+    assert [j["analysis_id"] for j in select_jobs(con, analysis_label="mriqc", subject_label="sub-0")] == \
+           ["a0", "a2"]
+
+    update_states(con, {"a0": ("j0", "running"), "a1": ("j1", "failed")})
+    update_states(con, {"a0": ("j0", "running")})
+    update_states(con, {"a0": ("j0", "complete")})
+    assert [j["analysis_id"] for j in select_jobs(con, state=["failed", "complete"])] == ["a0", "a1"]
+    assert select_jobs(con, state="complete")[0]["job_id"] == "j0"
+    assert [s for s, _ in get_state_history(con, "a0")] == ["submitted", "running", "complete"]
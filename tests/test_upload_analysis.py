@@ -0,0 +1,404 @@
+import os
+import time
+import warnings
+from collections import Counter
+from io import BytesIO
+from pathlib import Path
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+
+import pytest
+from flywheel import ApiException
+
+from dynagefw import upload_analysis as ua
+from dynagefw.fw_utils import FlywheelContext
+from dynagefw.gears import download_analysis
+from dynagefw.hash_cache import open_hash_cache
+from dynagefw.upload_analysis import get_file_index, list_files, zip_and_upload_data, zip_and_upload_pipelined, \
+    zip_files, zip_size, ZipStream, split_into_parts, upload_container
+from tests.fake_fw import FakeFlywheel
+
+project_id = "p1"
+
+
+def make_tree(root_dir, subjects):
+    for subject in subjects:
+        for f in ["mri/T1.mgz", "stats/aseg.stats", "scripts/recon-all.log"]:
+            file = root_dir / subject / f
+            file.parent.mkdir(parents=True, exist_ok=True)
+            file.write_text(f"{subject} {f}")
+
+
+def uploaded(fw):
+    return sorted((a["label"], f["name"], tuple(f["members"])) for a in fw.analyses.values() for f in a["files"])
+
+
+def test_zip_and_upload_pipelined(tmp_path):
+    subjects = [f"sub-{i}" for i in range(6)]
+    make_tree(tmp_path, subjects)
+    fw, fw_pipelined = FakeFlywheel(), FakeFlywheel()
+    for f in [fw, fw_pipelined]:
+        for subject in subjects:
+            f.add_fake_subject(project_id, subject)
+
+    for container in fw.get_project_subjects(project_id):
+        zip_and_upload_data(fw, container, tmp_path, "fs", [f"{container.label}*"])
+    containers_files = [(c, list_files(tmp_path, [f"{c.label}*"]))
+                        for c in fw_pipelined.get_project_subjects(project_id)]
+    zip_and_upload_pipelined(fw_pipelined, containers_files, tmp_path, "fs", n_zip=2, n_upload=2, max_zips=2)
+
+    assert uploaded(fw) == uploaded(fw_pipelined)
+    assert len(uploaded(fw)) == len(subjects)
+    assert ("fs", "fs_sub-0.zip", ("sub-0/mri/T1.mgz", "sub-0/scripts/recon-all.log", "sub-0/stats/aseg.stats")) \
+           in uploaded(fw)
+
+    # existing analyses are skipped
+    n_uploads = fw_pipelined.requests["upload_output"]
+    zip_and_upload_pipelined(fw_pipelined, containers_files, tmp_path, "fs")
+    assert fw_pipelined.requests["upload_output"] == n_uploads
+
+
+def test_zip_and_upload_pipelined_failure(tmp_path, monkeypatch):
+    subjects = [f"sub-{i}" for i in range(4)]
+    make_tree(tmp_path, subjects)
+    fw = FakeFlywheel()
+    for subject in subjects:
+        fw.add_fake_subject(project_id, subject)
+
+    upload_zip = ua.upload_zip
+
+    def failing_upload_zip(analysis, zip_file):
+        if "sub-2" in zip_file.name:
+            raise OSError("connection lost")
+        upload_zip(analysis, zip_file)
+
+    monkeypatch.setattr(ua, "upload_zip", failing_upload_zip)
+    containers_files = [(c, list_files(tmp_path, [f"{c.label}*"])) for c in fw.get_project_subjects(project_id)]
+    results = zip_and_upload_pipelined(fw, containers_files, tmp_path, "fs", n_zip=2, n_upload=2, max_tries=2,
+                                       retry_delay=0)
+    assert [(r["container_label"], r["status"]) for r in results] == \
+           [("sub-0", "uploaded"), ("sub-1", "uploaded"), ("sub-2", "failed"), ("sub-3", "uploaded")]
+    assert "connection lost" in results[2]["error"]
+    # the failed analysis is removed, the others are uploaded
+    assert sorted(f["name"] for a in fw.analyses.values() for f in a["files"]) == \
+           ["fs_sub-0.zip", "fs_sub-1.zip", "fs_sub-3.zip"]
+    assert len(fw.analyses) == 3
+
+
+@pytest.mark.parametrize("compression", [ZIP_STORED, ZIP_DEFLATED])
+def test_zip_stream(tmp_path, compression):
+    make_tree(tmp_path, ["sub-0"])
+    (tmp_path / "sub-0" / "anat.nii.gz").write_bytes(os.urandom(3 * 1024 * 1024 + 5))
+    files = list_files(tmp_path, ["sub-0*"])
+    zip_file = zip_files(files, "sub-0", tmp_path, tmp_path, compression)
+
+    with ZipStream(files, tmp_path, compression, spool_size=1) as stream:
+        data = stream.read()
+    assert len(data) == zip_size(files, tmp_path, compression)
+    with ZipFile(BytesIO(data)) as z, ZipFile(zip_file) as z_file:
+        assert {m: z.read(m) for m in z.namelist()} == {m: z_file.read(m) for m in z_file.namelist()}
+        assert z.getinfo("sub-0/anat.nii.gz").compress_type == ZIP_STORED
+        assert z.getinfo("sub-0/stats/aseg.stats").compress_type == compression
+
+
+def test_zip_and_upload_streaming(tmp_path):
+    subjects = [f"sub-{i}" for i in range(4)]
+    make_tree(tmp_path, subjects)
+    fw, fw_streaming = FakeFlywheel(), FakeFlywheel()
+    for f in [fw, fw_streaming]:
+        for subject in subjects:
+            f.add_fake_subject(project_id, subject)
+
+    for container in fw.get_project_subjects(project_id):
+        zip_and_upload_data(fw, container, tmp_path, "fs", [f"{container.label}*"])
+    containers_files = [(c, list_files(tmp_path, [f"{c.label}*"]))
+                        for c in fw_streaming.get_project_subjects(project_id)]
+    zip_and_upload_pipelined(fw_streaming, containers_files, tmp_path, "fs", n_upload=2, streaming=True)
+    assert uploaded(fw) == uploaded(fw_streaming)
+
+
+@pytest.mark.parametrize("compression", [None, ZIP_DEFLATED])
+def test_zip_and_upload_streaming_compression(tmp_path, monkeypatch, compression):
+    make_tree(tmp_path, ["sub-0"])
+    fw = FakeFlywheel()
+    fw.add_fake_subject(project_id, "sub-0")
+    container = fw.get_project_subjects(project_id)[0]
+
+    # the first try fails, the size is computed only once
+    upload_zip_stream, zip_size, calls = ua.upload_zip_stream, ua.zip_size, Counter()
+
+    def flaky_upload_zip_stream(*args, **kwargs):
+        calls["upload"] += 1
+        if calls["upload"] == 1:
+            raise OSError("connection lost")
+        upload_zip_stream(*args, **kwargs)
+
+    def counted_zip_size(*args, **kwargs):
+        calls["zip_size"] += 1
+        return zip_size(*args, **kwargs)
+
+    monkeypatch.setattr(ua, "upload_zip_stream", flaky_upload_zip_stream)
+    monkeypatch.setattr(ua, "zip_size", counted_zip_size)
+    zip_and_upload_data(fw, container, tmp_path, "fs", ["sub-0*"], streaming=True, compression=compression,
+                        retry_delay=0)
+    assert calls == {"upload": 2, "zip_size": 1}
+    data = list(fw.analyses.values())[0]["files"][0]["data"]
+    with ZipFile(BytesIO(data)) as z:
+        assert z.testzip() is None
+        assert z.getinfo("sub-0/stats/aseg.stats").compress_type == (compression or ZIP_STORED)
+
+
+def test_write_zip_policy(tmp_path):
+    make_tree(tmp_path, ["sub-0", "sub-1"])
+    (tmp_path / "sub-0" / "surf").mkdir()
+    (tmp_path / "sub-0" / "surf" / "lh.white").write_bytes(bytes(100000))
+    files = list_files(tmp_path, ["sub-*"])
+
+    zip_file = zip_files(files, "policy", tmp_path, tmp_path)
+    with ZipStream(files, tmp_path) as stream:
+        data = stream.read()
+    assert len(data) == zip_size(files, tmp_path)
+
+    with ZipFile(BytesIO(data)) as z, ZipFile(zip_file) as z_file:
+        assert z.testzip() is None
+        assert {m: z.read(m) for m in z.namelist()} == {m: z_file.read(m) for m in z_file.namelist()}
+        compress_types = {i.filename: i.compress_type for i in z.infolist()}
+    assert compress_types["sub-0/mri/T1.mgz"] == ZIP_STORED
+    assert compress_types["sub-0/stats/aseg.stats"] == ZIP_DEFLATED
+    assert compress_types["sub-0/surf/lh.white"] == ZIP_DEFLATED
+
+
+@pytest.mark.parametrize("zip64_limit", [ua.ZIP64_LIMIT, 1000])
+def test_write_zip_parallel(tmp_path, monkeypatch, zip64_limit):
+    # a small ZIP64_LIMIT forces zip64 records for sizes and offsets
+    monkeypatch.setattr(ua, "ZIP64_LIMIT", zip64_limit)
+    make_tree(tmp_path, [f"sub-{i}" for i in range(4)])
+    (tmp_path / "sub-0" / "surf").mkdir()
+    (tmp_path / "sub-0" / "surf" / "lh.white").write_bytes(os.urandom(1000) * 3000)
+    (tmp_path / "sub-0" / "anat.nii.gz").write_bytes(os.urandom(3 * 1024 * 1024 + 5))
+    (tmp_path / "sub-0" / "stats" / "ü.stats").write_text("ü")
+    files = list_files(tmp_path, ["sub-*"])
+
+    zip_file = zip_files(files, "serial", tmp_path, tmp_path)
+    with ZipStream(files, tmp_path, spool_size=1, n_compress=3) as stream:
+        data = stream.read()
+    assert len(data) == zip_size(files, tmp_path, n_compress=3)
+
+    with ZipFile(BytesIO(data)) as z, ZipFile(zip_file) as z_file:
+        assert z.testzip() is None
+        assert z.namelist() == z_file.namelist() == [str(f) for f in files]
+        assert {m: z.read(m) for m in z.namelist()} == {m: z_file.read(m) for m in z_file.namelist()}
+        assert [(i.compress_type, i.date_time, i.external_attr) for i in z.infolist()] == \
+               [(i.compress_type, i.date_time, i.external_attr) for i in z_file.infolist()]
+
+
+def glob_files(root_dir, search_strings):
+    """list_files as it was implemented with Path.glob"""
+    files = []
+    for s in search_strings:
+        for ff in Path(root_dir).glob(s):
+            if ff.is_file():
+                files.append(ff)
+            else:
+                files.extend([f for f in ff.rglob("*") if f.is_file()])
+    return sorted({f.relative_to(root_dir) for f in files})
+
+
+@pytest.mark.parametrize("search_strings", [["sub-1*"], ["*/sub-1*"], ["00_group*"], ["*"], ["sub-1", "sub-2*"],
+                                            ["**/*.stats"], ["sub-3/mri"], ["nothing*"], ["sub-12"],
+                                            ["*/sub-3/mri"]])
+def test_list_files(tmp_path, search_strings):
+    root_dir = tmp_path / "root"
+    make_tree(root_dir, [f"sub-{i}" for i in range(12)] + ["00_group"])
+    make_tree(root_dir / "tracts", ["sub-1", "sub-11"])
+    (root_dir / "00_group_table.tsv").write_text("a\tb")
+    # symlinked subject directories, one with a symlink back to the root
+    make_tree(tmp_path / "real", ["sub-12", "sub-3"])
+    (root_dir / "sub-12").symlink_to(Path("..") / "real" / "sub-12")
+    (root_dir / "tracts" / "sub-3").symlink_to(Path("..") / ".." / "real" / "sub-3")
+    (tmp_path / "real" / "sub-3" / "root").symlink_to(root_dir)
+    cwd = os.getcwd()
+    file_index = get_file_index(root_dir)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        assert list_files(root_dir, search_strings, file_index) == glob_files(root_dir, search_strings)
+    assert os.getcwd() == cwd
+
+
+def test_zip_and_upload_incremental(tmp_path):
+    root_dir = tmp_path / "fs"
+    make_tree(root_dir, ["sub-0", "sub-1"])
+    hash_cache = open_hash_cache(tmp_path / "hashes.sqlite")
+    fw = FakeFlywheel()
+    for subject in ["sub-0", "sub-1"]:
+        fw.add_fake_subject(project_id, subject)
+    containers = fw.get_project_subjects(project_id)
+
+    def upload_all(hash_cache):
+        for container in containers:
+            zip_and_upload_data(fw, container, root_dir, "fs", [f"{container.label}*"], hash_cache=hash_cache)
+
+    upload_all(hash_cache)
+    assert fw.requests["upload_output"] == 2
+    analysis = next(a for a in fw.analyses.values() if a["files"][0]["name"] == "fs_sub-0.zip")
+    assert [m[0] for m in analysis["info"]["file_manifest"]] == analysis["files"][0]["members"]
+
+    # nothing changed
+    upload_all(hash_cache)
+    assert fw.requests["upload_output"] == 2
+
+    # a changed and a new file are uploaded in a delta zip
+    (root_dir / "sub-0" / "stats" / "aseg.stats").write_text("fixed stats")
+    (root_dir / "sub-0" / "stats" / "wmparc.stats").write_text("new stats")
+    upload_all(hash_cache)
+    assert fw.requests["upload_output"] == 3
+    assert len(fw.analyses) == 2
+    assert analysis["files"][1]["name"].startswith("fs_sub-0_")
+    assert analysis["files"][1]["members"] == ["sub-0/stats/aseg.stats", "sub-0/stats/wmparc.stats"]
+    assert len(analysis["info"]["file_manifest"]) == 4
+    upload_all(hash_cache)
+    assert fw.requests["upload_output"] == 3
+
+
+def test_download_incremental_upload(tmp_path):
+    make_tree(tmp_path / "fs", ["sub-0"])
+    hash_cache = open_hash_cache(tmp_path / "hashes.sqlite")
+    fw = FakeFlywheel()
+    project_id = fw.add_fake_project("lhab", "LHAB")
+    fw.add_fake_subject(project_id, "sub-0")
+    container = fw.get_project_subjects(project_id)[0]
+    zip_and_upload_data(fw, container, tmp_path, "fs", ["fs/sub-0*"], hash_cache=hash_cache)
+    (tmp_path / "fs" / "sub-0" / "stats" / "aseg.stats").write_text("fixed stats")
+    zip_and_upload_data(fw, container, tmp_path, "fs", ["fs/sub-0*"], hash_cache=hash_cache)
+    assert len(list(fw.analyses.values())[0]["files"]) == 2
+
+    # the full zip finishes downloading after the delta zip, it still has to be extracted first
+    download_file = fw.download_file_from_analysis
+
+    def slow_download_file(analysis_id, file_name, dest_file):
+        if file_name == "fs_sub-0.zip":
+            time.sleep(.2)
+        download_file(analysis_id, file_name, dest_file)
+
+    fw.download_file_from_analysis = slow_download_file
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        download_analysis("lhab", "LHAB", "fs", tmp_path / "download", context=FlywheelContext(fw=fw))
+    out_dir = tmp_path / "download" / "fs" / "sub-0"
+    assert (out_dir / "stats" / "aseg.stats").read_text() == "fixed stats"
+    assert (out_dir / "mri" / "T1.mgz").read_text() == "sub-0 mri/T1.mgz"
+
+
+def test_zip_and_upload_incremental_without_manifest(tmp_path):
+    root_dir = tmp_path / "fs"
+    make_tree(root_dir, ["sub-0"])
+    fw = FakeFlywheel()
+    fw.add_fake_subject(project_id, "sub-0")
+    container = fw.get_project_subjects(project_id)[0]
+    zip_and_upload_data(fw, container, root_dir, "fs", ["sub-0*"])
+
+    # analyses uploaded without manifest are compared by the sizes of the zip members
+    hash_cache = open_hash_cache(tmp_path / "hashes.sqlite")
+    zip_and_upload_data(fw, container, root_dir, "fs", ["sub-0*"], hash_cache=hash_cache)
+    assert fw.requests["upload_output"] == 1
+    (root_dir / "sub-0" / "mri" / "T1.mgz").write_text("a longer T1")
+    zip_and_upload_data(fw, container, root_dir, "fs", ["sub-0*"], hash_cache=hash_cache)
+    analysis = list(fw.analyses.values())[0]
+    assert analysis["files"][1]["members"] == ["sub-0/mri/T1.mgz"]
+    assert len(analysis["info"]["file_manifest"]) == 3
+
+
+def test_split_into_parts(tmp_path):
+    for name, size in [("a", 5), ("b", 3), ("c", 12), ("d", 2), ("e", 2)]:
+        (tmp_path / name).write_bytes(bytes(size))
+    assert split_into_parts(list("abcde"), tmp_path, 8) == [["a", "b"], ["c"], ["d", "e"]]
+    assert split_into_parts(list("abcde"), tmp_path) == [list("abcde")]
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_upload_parts_resume(tmp_path, monkeypatch, pipelined):
+    root_dir = tmp_path / "fs"
+    make_tree(root_dir, ["sub-0", "sub-1"])
+    fw = FakeFlywheel()
+    for subject in ["sub-0", "sub-1"]:
+        fw.add_fake_subject(project_id, subject)
+    containers_files = [(c, list_files(root_dir, [f"{c.label}*"])) for c in fw.get_project_subjects(project_id)]
+
+    upload_zip = ua.upload_zip
+    attempts = Counter()
+
+    def flaky_upload_zip(analysis, zip_file):
+        attempts[zip_file.name] += 1
+        # sub-0 part 2 fails always, sub-1 part 3 fails once
+        if zip_file.name == "fs_sub-0_part002of003.zip" or \
+                (zip_file.name == "fs_sub-1_part003of003.zip" and attempts[zip_file.name] == 1):
+            raise OSError("connection lost")
+        upload_zip(analysis, zip_file)
+
+    def upload(containers_files):
+        if pipelined:
+            return zip_and_upload_pipelined(fw, containers_files, root_dir, "fs", part_size=15, retry_delay=0,
+                                            max_tries=2)
+        return [upload_container(fw, c, files, root_dir, "fs", part_size=15, retry_delay=0, max_tries=2)
+                for c, files in containers_files]
+
+    monkeypatch.setattr(ua, "upload_zip", flaky_upload_zip)
+    results = upload(containers_files)
+    assert [r["status"] for r in results] == ["failed", "uploaded"]
+    analyses = {fw.subjects[a["parent"]["id"]]["code"]: a for a in fw.analyses.values()}
+    assert [f["name"] for f in analyses["sub-0"]["files"]] == ["fs_sub-0_part001of003.zip",
+                                                               "fs_sub-0_part003of003.zip"]
+    assert analyses["sub-0"]["info"]["upload_status"] == "incomplete"
+    assert analyses["sub-1"]["info"]["upload_status"] == "complete"
+
+    # the next run only uploads the missing part
+    monkeypatch.setattr(ua, "upload_zip", upload_zip)
+    n_uploads = fw.requests["upload_output"]
+    results = upload(containers_files)
+    assert [r for r in results if r] == [{"container_id": results[0]["container_id"], "container_label": "sub-0",
+                                          "analysis_id": analyses["sub-0"]["id"], "status": "uploaded", "error": ""}]
+    assert fw.requests["upload_output"] - n_uploads == 1
+    assert analyses["sub-0"]["info"]["upload_status"] == "complete"
+    assert sorted(m for f in analyses["sub-0"]["files"] for m in f["members"]) == \
+           sorted(str(f) for f in containers_files[0][1])
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_upload_prepare_fails(tmp_path, pipelined):
+    root_dir = tmp_path / "fs"
+    subjects = ["sub-0", "sub-1", "sub-2"]
+    make_tree(root_dir, subjects)
+    fw = FakeFlywheel()
+    for subject in subjects:
+        fw.add_fake_subject(project_id, subject)
+    containers_files = [(c, list_files(root_dir, [f"{c.label}*"])) for c in fw.get_project_subjects(project_id)]
+    sub_1_id, sub_2_id = [c.id for c, _ in containers_files[1:]]
+
+    get_container_analyses, add_analysis_note = fw.get_container_analyses, fw.add_analysis_note
+
+    def flaky_get_container_analyses(container_id, filter=None):
+        if container_id == sub_1_id:
+            raise ApiException(502, "Bad Gateway")
+        return get_container_analyses(container_id, filter)
+
+    def flaky_add_analysis_note(analysis_id, note):
+        if fw.analyses[analysis_id]["parent"]["id"] == sub_2_id:
+            raise ApiException(502, "Bad Gateway")
+        add_analysis_note(analysis_id, note)
+
+    def upload(containers_files):
+        if pipelined:
+            return zip_and_upload_pipelined(fw, containers_files, root_dir, "fs", note="fs 7.1")
+        return [upload_container(fw, c, files, root_dir, "fs", note="fs 7.1") for c, files in containers_files]
+
+    fw.get_container_analyses, fw.add_analysis_note = flaky_get_container_analyses, flaky_add_analysis_note
+    results = sorted(upload(containers_files), key=lambda r: r["container_label"])
+    assert [(r["container_label"], r["status"]) for r in results] == \
+           [("sub-0", "uploaded"), ("sub-1", "failed"), ("sub-2", "failed")]
+    assert "Bad Gateway" in results[1]["error"] and results[1]["analysis_id"] == ""
+    # the analysis created for sub-2 is removed, so that it is not skipped as complete on the next run
+    assert [fw.subjects[a["parent"]["id"]]["code"] for a in fw.analyses.values()] == ["sub-0"]
+
+    fw.get_container_analyses, fw.add_analysis_note = get_container_analyses, add_analysis_note
+    results = [r for r in upload(containers_files) if r]
+    assert sorted((r["container_label"], r["status"]) for r in results) == [("sub-1", "uploaded"),
+                                                                             ("sub-2", "uploaded")]